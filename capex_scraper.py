@@ -1,13 +1,12 @@
-from math import inf
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import os
-from weakref import ref
-import requests
-from bs4 import BeautifulSoup
 import re
 import json
-import urllib.request as ur 
-import browser_cookie3
-from fake_useragent import UserAgent
+import sqlite3
+import time
+import urllib.error
+import urllib.request as ur
 import argparse
 import util
 import pandas as pd
@@ -26,6 +25,9 @@ CAPEX_ID_TO_TYPE = [('6ce881df-bfd9-4b15-b6d5-e2f2419729c6', PickType.CapexTotal
                     ('ed3f781c-f68a-4e54-9b9c-e59c3289766a', PickType.CapexClosed),
 ]
 
+#seconds before the first retry of a failed read, doubles with each retry
+CAPEX_FETCH_BACKOFF_SECS = 1.0
+
 def get_dict_tree_value_by_path(tree, path):
     current = tree
     for key in path:
@@ -36,67 +38,253 @@ def get_dict_tree_value_by_path(tree, path):
             return None
     return current
 
-def read_capex_portfolio_html(opener):
-        url = "https://capexinsider.com/login/portfolio/"
+CAPEX_PORTFOLIO_URL = "https://capexinsider.com/login/portfolio/"
+INFOGRAM_URL = "https://e.infogram.com/"
+LIVE_DATA_URL = "https://live-data.jifo.co/"
+
+#the infogram embeds in the portfolio page, ex. <div class="infogram-embed" data-id="abc-123" ...>
+DIV_TAG_RE = re.compile(rb'<div\b[^>]*>', re.IGNORECASE)
+INFOGRAM_EMBED_CLASS_RE = re.compile(rb'\bclass\s*=\s*["\'][^"\']*\binfogram-embed\b', re.IGNORECASE)
+DATA_ID_RE = re.compile(rb'\bdata-id\s*=\s*["\']([^"\']*)["\']', re.IGNORECASE)
+
+INFOGRAPHIC_DATA_MARKER = "window.infographicData="
+
+def find_infogram_ids(capex_html : bytes):
+    """Returns the data-id of each infogram embed div of the portfolio page, in page order"""
+    ids = []
+    for m in DIV_TAG_RE.finditer(capex_html):
+        tag = m.group(0)
+        if(INFOGRAM_EMBED_CLASS_RE.search(tag)):
+            id_match = DATA_ID_RE.search(tag)
+            if(id_match):
+                ids.append(id_match.group(1).decode())
+    return ids
+
+def extract_infographic_data(infogram_html : bytes):
+    """Returns the json assigned to window.infographicData in an infogram page. Only the json itself is parsed,
+    rather than the whole page
+    """
+    text = infogram_html.decode('utf-8',errors='replace')
+    start = text.find(INFOGRAPHIC_DATA_MARKER)
+    if(start == -1):
+        util.error("No window.infographicData in infogram page")
+    (data,_) = json.JSONDecoder().raw_decode(text,start + len(INFOGRAPHIC_DATA_MARKER))
+    return data
+
+def fetch_url(opener, url, timeout = ftypes.CAPEX_FETCH_TIMEOUT_SECS, retries = ftypes.CAPEX_FETCH_RETRIES,
+              backoff_secs = CAPEX_FETCH_BACKOFF_SECS, headers = None):
+    """Reads url, retrying failed reads with exponential backoff. Raises the last error if all of them fail
+
+    Args:
+        headers: optional dict of extra request headers, ex. from get_conditional_headers()
+
+    Returns:
+        (body, response headers). body is None if the server answered 304 Not Modified to a conditional request
+    """
+    for attempt in range(retries + 1):
+        try:
+            with opener.open(ur.Request(url,headers=headers or {}),timeout=timeout) as r:
+                return r.read(),r.headers
+        except urllib.error.HTTPError as e:
+            if(e.code == 304):
+                return None,e.headers
+            if(attempt == retries):
+                raise
+            print(f"Read of {url} failed, {e}, retrying")
+        except Exception as e:
+            if(attempt == retries):
+                raise
+            print(f"Read of {url} failed, {e}, retrying")
+        time.sleep(backoff_secs * 2**attempt)
+
+def get_conditional_headers(etag, last_modified):
+    """Returns the headers that ask the server to answer 304 Not Modified if a page hasn't changed since it was read"""
+    headers = {}
+    if(etag is not None):
+        headers['If-None-Match'] = etag
+    if(last_modified is not None):
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+def get_table_refreshed(td : bytes):
+    """Returns the refreshed timestamp of a live data table, or None if it has none"""
+    try:
+        return str(json.loads(td.decode())['refreshed'])
+    except Exception:
+        return None
+
+class CapexCache:
+    """Remembers the capex pages and tables read by download-capex in sqlite, kept in the main dir, so later
+    downloads can ask for them conditionally (ETag/Last-Modified), and tables that haven't changed can be hard linked
+    from the snapshot they were last saved to, rather than written again.
+
+    Infogram pages are kept whole, since they aren't saved anywhere else. For tables, only where the last copy was
+    saved is kept, along with its hash and refreshed timestamp.
+    """
+
+    def __init__(self, db_file):
+        self.conn = sqlite3.connect(db_file)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS pages (url TEXT NOT NULL PRIMARY KEY, etag TEXT, last_modified TEXT,
+                                body BLOB NOT NULL)""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS tables (live_key TEXT NOT NULL PRIMARY KEY, etag TEXT, last_modified TEXT,
+                                refreshed TEXT, sha256 TEXT NOT NULL, file_path TEXT NOT NULL)""")
+        self.conn.commit()
+        #live key -> (etag,last_modified) of tables read but not saved yet
+        self.read_tables = {}
+
+    def close(self):
+        self.conn.close()
+
+    def commit(self):
+        self.conn.commit()
+
+    def get_page(self, url):
+        """Returns (etag,last_modified,body) of the page, or None if it hasn't been read before"""
+        return self.conn.execute("SELECT etag, last_modified, body FROM pages WHERE url = ?", (url,)).fetchone()
+
+    def set_page(self, url, headers, body):
+        self.conn.execute("INSERT OR REPLACE INTO pages VALUES (?,?,?,?)", (url,headers.get('ETag'),headers.get('Last-Modified'),body))
+
+    def get_table(self, live_key):
+        """Returns (etag,last_modified,refreshed,sha256,file_path) of the last saved copy of the table, or None if there
+        is none, or it has since been changed or deleted
+        """
+        row = self.conn.execute("SELECT etag, last_modified, refreshed, sha256, file_path FROM tables WHERE live_key = ?",
+                                (live_key,)).fetchone()
+        if(row is None or not os.path.exists(row[4]) or util.get_file_sha256(row[4]) != row[3]):
+            return None
+        return row
+
+    def set_table_read(self, live_key, headers):
+        self.read_tables[live_key] = (headers.get('ETag'),headers.get('Last-Modified'))
+
+    def save_table(self, live_key, td : bytes, fp):
+        """Saves the table to fp. If it's the same as the last copy saved, that is hard linked to fp instead, or
+        copied if it can't be.
+
+        Returns:
+            True if the table changed since the last copy was saved
+        """
+        fp = os.path.abspath(fp)
+        sha256 = hashlib.sha256(td).hexdigest()
+        last = self.get_table(live_key)
+        changed = last is None or last[3] != sha256
+
+        if(changed or not os.path.exists(fp) or not os.path.samefile(last[4],fp)):
+            if(os.path.exists(fp)):
+                os.remove(fp)
+            linked = False
+            if(not changed):
+                try:
+                    os.link(last[4],fp)
+                    linked = True
+                except OSError:
+                    pass
+            if(not linked):
+                with open(fp,"wb") as f:
+                    f.write(td)
+
+        (etag,last_modified) = self.read_tables.pop(live_key,(None,None))
+        self.conn.execute("INSERT OR REPLACE INTO tables VALUES (?,?,?,?,?,?)",
+                          (live_key,etag,last_modified,get_table_refreshed(td),sha256,fp))
+
+        return changed
+
+def read_capex_portfolio_html(opener, workers = ftypes.CAPEX_FETCH_WORKERS, timeout = ftypes.CAPEX_FETCH_TIMEOUT_SECS,
+                              retries = ftypes.CAPEX_FETCH_RETRIES, backoff_secs = CAPEX_FETCH_BACKOFF_SECS,
+                              portfolio_url = CAPEX_PORTFOLIO_URL, infogram_url = INFOGRAM_URL, live_data_url = LIVE_DATA_URL,
+                              cache : CapexCache = None):
+        """Reads the portfolio page, then all the infogram pages it embeds, then all the tables those show.
+        The infogram pages, and then the tables, are read concurrently, at most workers at a time.
+
+        Args:
+            opener: urllib opener with the login cookies, see scraper_util.create_url_opener
+            timeout: seconds to wait for each read
+            retries: number of times a failed read is retried
+            portfolio_url, infogram_url, live_data_url: where to read from, so a local server can stand in for the sites
+            cache: if given, infogram pages and tables read before are only read again if they have changed, see CapexCache
+
+        Returns:
+            (portfolio html, list of infogram htmls, list of (index, live key, table json)) in page order. index is the
+            position of the table's entity among all the entities of the infogram pages, which is what the saved tables
+            have always been numbered by. Tables that couldn't be read, or have no live key, are left out but keep their
+            index, so the ones after them are numbered the same
+        """
+        def fetch(url_and_headers):
+            return fetch_url(opener,url_and_headers[0],timeout,retries,backoff_secs,url_and_headers[1])
 
-        capex_html = opener.open(url).read()
-        capex_soup = BeautifulSoup(capex_html, "html.parser")
+        (capex_html,_) = fetch((portfolio_url,None))
 
-        infogram_urls = [f'https://e.infogram.com/{ie["data-id"]}' for ie in capex_soup.find_all("div",{"class":"infogram-embed"})]
+        infogram_urls = [f'{infogram_url}{id}' for id in find_infogram_ids(capex_html)]
 
         print(f"Found {len(infogram_urls)} html urls")
 
-        infogram_html_list = []
-        for i,url in enumerate(infogram_urls):
-            print(f"Reading html data {i}")
-            infogram_html_list.append(opener.open(url).read())
-
-        data_urls = []
-
-        for ih in infogram_html_list:
-            soup = BeautifulSoup(ih, "html.parser")
-        
-            #grabs the first script with window.infographicData
-            script = [
-                t 
-                for t in soup.findAll("script") 
-                if "window.infographicData" in t.text
-                ][0].text
-            
-            #grab the window.infographicData which should json
-            extract = re.search(r".*window\.infographicData=(.*);$", script)
-
-            data = json.loads(extract.group(1))
-
-            entities = data["elements"]["content"]["content"]["entities"]
-
-            for key in entities.keys():
-                #co: the url seems to be wrong nowadays
-                #url = get_dict_tree_value_by_path(entities[key],["props","chartData","custom","live","url"])
-
-                live_key = get_dict_tree_value_by_path(entities[key],["props","chartData","custom","live","key"])
-                live_provider = get_dict_tree_value_by_path(entities[key],["props","chartData","custom","live","provider"])
-                #if(live_provider == "atlas_google_drive"):
-                if(live_key is not None):
-                    url = f"https://live-data.jifo.co/{live_key}"
-                else:
-                    print(f"No live key for live provider {live_provider}, url {url}")
-
-                if(url is not None):
-                    data_urls.append((live_key,url))
-
-        table_data = []
-
-        print(f"Found {len(data_urls)} table urls")
-
-        for i,(key,data_url) in enumerate(data_urls):
-            print(f"Reading table url {i}, {data_url}")
-
-            try:
-                table_data.append((key,opener.open(data_url).read()))
-            except Exception as e:
-                print(f"Read failed, {e}")
-        
+        #the cache is only used from this thread, the workers just read
+        cached_pages = [cache.get_page(url) if cache else None for url in infogram_urls]
+
+        with ThreadPoolExecutor(max_workers=max(workers,1)) as executor:
+            #map keeps page order, so the tables are numbered the same every time
+            pages = executor.map(fetch,[(url,get_conditional_headers(*cp[:2]) if cp else None)
+                                        for (url,cp) in zip(infogram_urls,cached_pages)])
+
+            infogram_html_list = []
+            for (url,cp,(ih,headers)) in zip(infogram_urls,cached_pages,pages):
+                if(ih is None):
+                    print(f"{url} is unchanged")
+                    ih = cp[2]
+                elif(cache):
+                    cache.set_page(url,headers,ih)
+                infogram_html_list.append(ih)
+
+            data_urls = []
+            #entities without a live key still take an index, as they did when they were saved as capex_data_N_None.json
+            index = 0
+
+            for ih in infogram_html_list:
+                data = extract_infographic_data(ih)
+
+                entities = data["elements"]["content"]["content"]["entities"]
+
+                for key in entities.keys():
+                    #co: the url seems to be wrong nowadays
+                    #url = get_dict_tree_value_by_path(entities[key],["props","chartData","custom","live","url"])
+
+                    live_key = get_dict_tree_value_by_path(entities[key],["props","chartData","custom","live","key"])
+                    live_provider = get_dict_tree_value_by_path(entities[key],["props","chartData","custom","live","provider"])
+                    #if(live_provider == "atlas_google_drive"):
+                    if(live_key is not None):
+                        data_urls.append((index,live_key,f"{live_data_url}{live_key}"))
+                    elif(live_provider is not None):
+                        print(f"No live key for live provider {live_provider}")
+                    index += 1
+
+            print(f"Found {len(data_urls)} table urls")
+
+            cached_tables = [cache.get_table(key) if cache else None for (_,key,_) in data_urls]
+
+            def fetch_table(url_and_headers):
+                try:
+                    return fetch(url_and_headers)
+                except Exception as e:
+                    print(f"Read of {url_and_headers[0]} failed, {e}")
+                    return None
+
+            tables = executor.map(fetch_table,[(data_url,get_conditional_headers(*ct[:2]) if ct else None)
+                                               for ((_,_,data_url),ct) in zip(data_urls,cached_tables)])
+
+            table_data = []
+            for ((index,key,data_url),ct,res) in zip(data_urls,cached_tables,tables):
+                if(res is None):
+                    continue
+                (td,headers) = res
+                if(td is None):
+                    print(f"{data_url} is unchanged since {ct[2]}")
+                    with open(ct[4],"rb") as f:
+                        td = f.read()
+                if(cache):
+                    cache.set_table_read(key,headers)
+                table_data.append((index,key,td))
+
         return(capex_html,infogram_html_list,table_data)
 
 
@@ -108,63 +296,67 @@ def extract_index_and_id_from_filepath(filename):
     return int(match.group(1)), match.group(2)
 
 
-def convert_capex_portfolio_data_to_pandas(fp,td_json):
-    subdir_datestr = util.extract_subdir_date_from_filepath(fp)
+def decode_capex_table(table):
+    """Decodes a table of live data, a list of rows with the headers first, into a dict of column name to list of
+    cell values. Each column is read in one go, rather than cell by cell.
 
-    version = 0 if subdir_datestr < "2025-05-01" else 1 
+    Cells may be link dicts, ex. {"type": "link", "value": "ABC", "href": "https://..."}, which give their value to the
+    column and their href to a "<column>_href" column. Rows may be shorter than the headers, their missing cells are
+    None, and cells past the headers are ignored. Columns are in the order their first cell appears, reading the table
+    row by row, and columns no row has cells for are left out.
+    """
+    headers = table[0]
+    rows = table[1:]
 
-    if(version > 0):
-        (index,id) = extract_index_and_id_from_filepath(fp)
-    
-    if(id == "None"):
-        return None
+    #(row of first cell, header index, is href) -> (column name, values), for ordering the columns
+    columns = {}
 
-    td = json.loads(td_json.decode())
-    #convert data to pandas
-    table = td['data'][0]
-    headers = table[0]
+    row_lens = list(map(len,rows))
+    num_columns = min(len(headers),max(row_lens,default=0))
 
-    out_table = {}
+    #short rows are padded with None, so every column can be read straight from the rows
+    if(min(row_lens,default=0) < num_columns):
+        rows = [r if len(r) >= num_columns else r + [None] * (num_columns - len(r)) for r in rows]
 
-    def add_cell(ri,c,ch):
-        """adds a new cell. creates row if necessary
+    for (hi,ch) in enumerate(headers[:num_columns]):
+        values = [r[hi] for r in rows]
+        first_ri = next(ri for ri,row_len in enumerate(row_lens) if row_len > hi)
 
-        Args:
-            ri : row index
-            c : cell value
-            ch : column header
-        """
+        if(dict in set(map(type,values))):
+            if(any(c['type'] != 'link' for c in values if isinstance(c,dict))):
+                #reports the first bad cell of the table, not just of this column
+                (bad_c,bad_r) = next((c,r) for r in table[1:] for c in r[:len(headers)] if isinstance(c,dict) and c['type'] != 'link')
+                util.error(f"Can't understand cell of row in table, got {bad_c} in row {bad_r}")
 
-        #get or create the column
-        column = out_table.get(ch,[])
+            first_href_ri = next((ri for ri,c in enumerate(values) if isinstance(c,dict) and 'href' in c),None)
+            if(first_href_ri is not None):
+                columns[(first_href_ri,hi,True)] = (ch+"_href",[c.get('href') if isinstance(c,dict) else None for c in values])
+            values = [c['value'] if isinstance(c,dict) else c for c in values]
 
-        #if the column isn't up to the current row index, we add blank values for 
-        #the previous rows so we are lined up to the current row properly
-        column += [None] * (ri-(len(column)))
-        
-        #add the value
-        column.append(c)
+        columns[(first_ri,hi,False)] = (ch,values)
 
-        #replace it back
-        out_table[ch] = column
+    res = {}
+    for (_,(ch,values)) in sorted(columns.items()):
+        if(ch in res):
+            util.error(f"Table has more than one column named {ch}")
+        res[ch] = values
 
-    for ri,r in enumerate(table[1:]):
-        for c,ch in zip(r,headers):
-            if(isinstance(c,dict)):
-                if(c['type'] != 'link'):
-                    util.error(f"Can't understand cell of row in table, got {c} in row {r}")
+    return res
 
-                add_cell(ri,c['value'],ch)
-                if('href' in c):
-                    add_cell(ri,c['href'],ch+"_href")
-            else:
-                add_cell(ri,c,ch)
+def convert_capex_portfolio_data_to_pandas(fp,td_json):
+    subdir_datestr = util.extract_subdir_date_from_filepath(fp)
 
-    #make sure all the columns are of equal length (if some rows don't have hrefs for some cells, they may not be the same length)
-    for col in out_table.values():
-        col += [None] * (len(table)-1-(len(col)))
+    version = 0 if subdir_datestr < "2025-05-01" else 1 
+
+    if(version > 0):
+        (index,id) = extract_index_and_id_from_filepath(fp)
+    
+    if(id == "None"):
+        return None
 
-    res =  pd.DataFrame(out_table)
+    td = json.loads(td_json.decode())
+    #convert data to pandas
+    res = pd.DataFrame(decode_capex_table(td['data'][0]))
 
     if(version == 0):
         fn = td['fileName']
@@ -184,18 +376,50 @@ def convert_capex_portfolio_data_to_pandas(fp,td_json):
 
     return res
 
-def read_capex_to_dir(browser : scraper_util.Browser, dir):
+def save_tables(table_data_json, dir, cache : CapexCache = None):
+    """Saves the tables read by read_capex_portfolio_html into dir. With a cache, unchanged tables are hard linked
+    from the last snapshot they were saved to.
+
+    Returns:
+        the number of tables that changed since they were last saved, or all of them without a cache
+    """
+    num_changed = 0
+    for (index,key,td) in table_data_json:
+        fp = os.path.join(dir,f"capex_data_{index}_{key}.json")
+        if(cache):
+            num_changed += cache.save_table(key,td,fp)
+        else:
+            open(fp,"wb").write(td)
+            num_changed += 1
+
+    if(cache):
+        cache.commit()
+
+    return num_changed
+
+def read_capex_to_dir(browser : scraper_util.Browser, dir, workers = ftypes.CAPEX_FETCH_WORKERS,
+                      timeout = ftypes.CAPEX_FETCH_TIMEOUT_SECS, cache_file = None):
+    """Downloads the capex tables into dir
+
+    Args:
+        cache_file: if given, the CapexCache to download conditionally with, and hard link unchanged tables from
+    """
     opener = scraper_util.create_url_opener(browser=browser)
 
-    (capex_html,infogram_htmls,table_data_json) = read_capex_portfolio_html(opener)
+    cache = CapexCache(cache_file) if cache_file else None
+    try:
+        (capex_html,infogram_htmls,table_data_json) = read_capex_portfolio_html(opener,workers,timeout,cache=cache)
 
-    if(len(table_data_json) == 0):
-        util.error("Could not read capex data. Make sure you selected the right browser and have logged into capexinsider.com")
+        if(len(table_data_json) == 0):
+            util.error("Could not read capex data. Make sure you selected the right browser and have logged into capexinsider.com")
 
-    #TODO 2 check that necessary tables are all there. Also check on load from cache
+        #TODO 2 check that necessary tables are all there. Also check on load from cache
 
-    for index,(key,td) in enumerate(table_data_json):
-        open(os.path.join(dir,f"capex_data_{index}_{key}.json"),"wb").write(td)
+        num_changed = save_tables(table_data_json,dir,cache)
+        print(f"{num_changed} of {len(table_data_json)} tables changed since they were last downloaded")
+    finally:
+        if(cache):
+            cache.close()
 
 
 if __name__ == '__main__':
@@ -221,7 +445,7 @@ if __name__ == '__main__':
             for index,ih in enumerate(infogram_htmls):
                 open(f"out_ih_{index}.html","wb").write(ih)
 
-            for index,(key,td) in enumerate(table_data_json):
+            for (index,key,td) in table_data_json:
                 open(f"out_table_data_{key}.json","wb").write(td)
     else:
         table_data_json = [open(ih,"rb").read() for ih in config.table_data_files]
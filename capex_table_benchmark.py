@@ -0,0 +1,149 @@
+"""Times capex_scraper.decode_capex_table on large made up closed positions tables, and checks that it gives the same
+frames as the cell by cell decoder it replaced, which is kept here as decode_capex_table_cellwise.
+
+The tables have link cells with and without hrefs, hrefs that only start part way down, rows shorter and longer than
+the headers, and mixed numbers, strings and blanks, like the real tables. Capex json files given on the command line
+are checked too.
+
+Exits with 1 if any table decodes differently.
+"""
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+
+import pandas as pd
+
+import capex_scraper
+
+CLOSED_POSITIONS_HEADERS = ['Company','Ticker','Exchange','Theme','Entry Date','Entry Price','Exit Date','Exit Price',
+                            'Return','Holding Period','Notes']
+
+def decode_capex_table_cellwise(table):
+    """The decoder convert_capex_portfolio_data_to_pandas used before decode_capex_table"""
+    headers = table[0]
+
+    out_table = {}
+
+    def add_cell(ri,c,ch):
+        column = out_table.get(ch,[])
+        column += [None] * (ri-(len(column)))
+        column.append(c)
+        out_table[ch] = column
+
+    for ri,r in enumerate(table[1:]):
+        for c,ch in zip(r,headers):
+            if(isinstance(c,dict)):
+                if(c['type'] != 'link'):
+                    raise ValueError(f"Can't understand cell of row in table, got {c} in row {r}")
+
+                add_cell(ri,c['value'],ch)
+                if('href' in c):
+                    add_cell(ri,c['href'],ch+"_href")
+            else:
+                add_cell(ri,c,ch)
+
+    for col in out_table.values():
+        col += [None] * (len(table)-1-(len(col)))
+
+    return out_table
+
+def make_closed_positions_table(num_rows, rng : random.Random):
+    rows = []
+    for ri in range(num_rows):
+        ticker = f"T{ri:05d}"
+        #hrefs only start part way down, so the href column isn't in the first row
+        company = { 'type' : 'link', 'value' : f"Company {ri}" }
+        if(ri > num_rows // 3 and rng.random() < 0.7):
+            company['href'] = f"https://example.com/{ticker}"
+        row = [company if rng.random() < 0.8 else f"Company {ri}",
+               ticker,
+               rng.choice(['NYSE','NASDAQ','TSE','LSE']),
+               rng.choice(['Uranium','Gold','Copper','Energy','AI']),
+               f"20{rng.randint(15,24)}-0{rng.randint(1,9)}-1{rng.randint(0,9)}",
+               round(rng.uniform(1,500),2),
+               f"2025-0{rng.randint(1,4)}-1{rng.randint(0,9)}",
+               round(rng.uniform(1,500),2) if rng.random() < 0.9 else '',
+               f"{rng.uniform(-90,400):.1f}%",
+               rng.randint(1,120),
+               { 'type' : 'link', 'value' : 'Article', 'href' : f"https://example.com/a/{ri}" } if rng.random() < 0.1 else None]
+        #some rows are cut short, and a few have extra cells past the headers
+        r = rng.random()
+        if(r < 0.05):
+            row = row[:rng.randint(1,len(row)-1)]
+        elif(r < 0.07):
+            row = row + ['extra']
+        rows.append(row)
+    return [CLOSED_POSITIONS_HEADERS] + rows
+
+def get_edge_case_tables():
+    link = { 'type' : 'link', 'value' : 'v' }
+    href_link = { 'type' : 'link', 'value' : 'v', 'href' : 'h' }
+    return [
+        [['A','B']],
+        [['A','B'],[]],
+        [['A','B'],['a']],
+        [['A','B','C'],['a'],['a','b'],[]],
+        [['A','B'],['a','b','c','d']],
+        [['A','B'],[link,1],[href_link,None]],
+        [['A','B'],[1,href_link],[link,link]],
+        [['A','B'],[1,2.5],[None,'x']],
+        [['A','A'],['a']],
+    ]
+
+def tables_match(table):
+    expected = pd.DataFrame(decode_capex_table_cellwise(table))
+    res = pd.DataFrame(capex_scraper.decode_capex_table(table))
+    return list(res.columns) == list(expected.columns) and list(res.dtypes) == list(expected.dtypes) and res.equals(expected)
+
+def time_decoder(decoder, table, runs):
+    """Returns the median number of seconds it takes to decode table into a frame"""
+    times = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        pd.DataFrame(decoder(table))
+        times.append(time.perf_counter() - start_time)
+    return statistics.median(times)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="times decoding large capex tables, and checks the results are the same as the cell by cell decoder",
+        exit_on_error=True,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--rows", type=int, nargs='+', default=[1000,10000,100000], help="sizes of closed positions tables to time")
+    parser.add_argument("--runs", type=int, default=5, help="times to decode each table, the median time is used")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("files", nargs='*', help="capex json files to check as well")
+
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+
+    errors = []
+    for i,table in enumerate(get_edge_case_tables()):
+        if(not tables_match(table)):
+            errors.append(f"edge case table {i}, {table}, decodes differently")
+
+    for fp in args.files:
+        with open(fp,'rb') as f:
+            table = json.loads(f.read().decode())['data'][0]
+        if(not tables_match(table)):
+            errors.append(f"{fp} decodes differently")
+
+    for num_rows in args.rows:
+        table = make_closed_positions_table(num_rows,rng)
+        if(not tables_match(table)):
+            errors.append(f"closed positions table of {num_rows} rows decodes differently")
+
+        secs_cellwise = time_decoder(decode_capex_table_cellwise,table,args.runs)
+        secs = time_decoder(capex_scraper.decode_capex_table,table,args.runs)
+        print(f"{num_rows:>8} rows: cellwise {secs_cellwise:.4f}s, decode_capex_table {secs:.4f}s, {secs_cellwise/secs:.1f}x faster")
+
+    for e in errors:
+        print(e)
+    print("ok" if not errors else f"{len(errors)} errors")
+
+    sys.exit(1 if errors else 0)
@@ -1,4 +1,6 @@
 import itertools
+import os
+import pickle
 import re
 import openpyxl as op
 import util
@@ -169,6 +171,8 @@ def parse_options(options_csv_iter):
                 config.currency_formats = parse_currency_formats(fi)
             case "HistoricalPerformanceSlippageDays":
                 config.hist_perf_slip_days = parse_int(row,ri,1)
+            case "ForexDate":
+                config.forex_date = util.csv_convert_to_enum(ftypes.ForexDateTypes,row,1,ri)
             case "ConfigVersion":
                 config.version = row[1]
             case _:
@@ -240,12 +244,78 @@ def parse_options(options_csv_iter):
 
 
 def parse_config_file(fp):
-    wb = op.load_workbook(fp)
-    system_rules = rules_parser.parse_override_file(util.read_standardized_csv(wb=wb,worksheet_name=SYSTEM_RULES_SHEETNAME), False)
-    custom_rules = rules_parser.parse_override_file(util.read_standardized_csv(wb=wb,worksheet_name=CUSTOM_RULES_SHEETNAME), True)
+    wb = op.load_workbook(fp, read_only=True)
+    try:
+        system_rules = rules_parser.parse_override_file(util.read_standardized_csv(wb=wb,worksheet_name=SYSTEM_RULES_SHEETNAME), False)
+        custom_rules = rules_parser.parse_override_file(util.read_standardized_csv(wb=wb,worksheet_name=CUSTOM_RULES_SHEETNAME), True)
+
+        options_csv_iter = util.read_standardized_csv(wb=wb,worksheet_name=OPTIONS_SHEETNAME)
+
+        config = parse_options(options_csv_iter)
+    finally:
+        wb.close()
 
-    options_csv_iter = util.read_standardized_csv(wb=wb,worksheet_name=OPTIONS_SHEETNAME)
+    return config,custom_rules,system_rules
 
-    config = parse_options(options_csv_iter)
 
-    return config,custom_rules,system_rules    
+#bump this whenever the parsed config classes or parsing logic change, so old cache files are ignored
+CONFIG_CACHE_VERSION = 2
+CONFIG_CACHE_FILENAME = 'parsed_config.pickle'
+
+def read_config_cache(cache_fp):
+    """Returns the cache entry stored in cache_fp, or None if it doesn't exist or can't be read"""
+    try:
+        with open(cache_fp,'rb') as f:
+            entry = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        util.warn(f"Ignoring unreadable config cache {cache_fp}: {e}")
+        return None
+
+    if(not isinstance(entry,dict) or entry.get('version') != CONFIG_CACHE_VERSION):
+        return None
+
+    return entry
+
+def write_config_cache(cache_fp,entry):
+    try:
+        os.makedirs(os.path.dirname(cache_fp),exist_ok=True)
+        #write to a temp file first so an interrupted run never leaves a partial cache behind
+        tmp_fp = f"{cache_fp}.{os.getpid()}.tmp"
+        with open(tmp_fp,'wb') as f:
+            pickle.dump(entry,f,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_fp,cache_fp)
+    except OSError as e:
+        util.warn(f"Could not write config cache {cache_fp}: {e}")
+
+def parse_config_file_cached(fp,cache_dir):
+    """Same as parse_config_file, but keeps the parsed result in cache_dir, so the workbook is only loaded
+    when it has changed.
+
+    The cache is used as is when the file's mtime and size match. Otherwise the file's sha256 is checked, so
+    a file that was only touched or copied doesn't need to be parsed again.
+
+    Args:
+        fp: path to theme_track_config.xlsx
+        cache_dir: directory to store the cache file in
+
+    Returns:
+        (config,custom_rules,system_rules), as parse_config_file
+    """
+    cache_fp = os.path.join(cache_dir,CONFIG_CACHE_FILENAME)
+    st = os.stat(fp)
+
+    entry = read_config_cache(cache_fp)
+    if(entry is not None and entry['mtime_ns'] == st.st_mtime_ns and entry['size'] == st.st_size):
+        return entry['parsed']
+
+    sha256 = util.get_file_sha256(fp)
+    if(entry is not None and entry['sha256'] == sha256):
+        parsed = entry['parsed']
+    else:
+        parsed = parse_config_file(fp)
+
+    write_config_cache(cache_fp,{ 'version' : CONFIG_CACHE_VERSION, 'mtime_ns' : st.st_mtime_ns, 'size' : st.st_size, 'sha256' : sha256, 'parsed' : parsed })
+
+    return parsed
@@ -1,6 +1,13 @@
+from bisect import bisect_right
 from datetime import datetime
+from functools import lru_cache
 from typing import Any, Dict, List, Tuple, Optional
 
+@lru_cache(maxsize=1024)
+def parse_date(date_str: str) -> datetime:
+    """Parses a 'YYYY-MM-DD' date. The same few snapshot dates are looked up over and over, so they're cached"""
+    return datetime.strptime(date_str, "%Y-%m-%d")
+
 class DateRegistry:
     """
     Registry for date-versioned objects.
@@ -9,7 +16,9 @@ class DateRegistry:
     """
 
     def __init__(self):
-        self._registry: Dict[str, List[Tuple[datetime, Any]]] = {}
+        #for each name, the start dates in ascending order, and the object registered at each
+        self._starts: Dict[str, List[datetime]] = {}
+        self._objs: Dict[str, List[Any]] = {}
         self._default_objs: Dict[str, Any] = {}
 
     def register(self, name: str, start: str, obj: Any):
@@ -23,9 +32,18 @@ class DateRegistry:
         """
         if(start is None):
             start = "1970-01-01"
-        start_dt = datetime.strptime(start, "%Y-%m-%d")
-        self._registry.setdefault(name, []).append((start_dt, obj))
-        self._registry[name].sort(reverse=True)
+        start_dt = parse_date(start)
+
+        starts = self._starts.setdefault(name, [])
+        objs = self._objs.setdefault(name, [])
+
+        #an object registered for the same date as an earlier one replaces it
+        i = bisect_right(starts, start_dt)
+        if(i > 0 and starts[i-1] == start_dt):
+            objs[i-1] = obj
+        else:
+            starts.insert(i, start_dt)
+            objs.insert(i, obj)
 
     def set_default(self, name: str, obj: Any):
         """
@@ -48,10 +66,9 @@ class DateRegistry:
         Returns:
             The registered object for the target date, or the default if none match.
         """
-        date = datetime.strptime(target_date, "%Y-%m-%d")
-        for start_dt, obj in self._registry.get(name, []):
-            if date >= start_dt:
-                return obj
+        i = bisect_right(self._starts.get(name, []), parse_date(target_date))
+        if(i > 0):
+            return self._objs[name][i-1]
         return self._default_objs.get(name)
 
     def run(self, name: str, target_date: str, *args, **kwargs):
@@ -0,0 +1,241 @@
+"""A local fake of the capex portfolio page, its infogram pages and their live data tables, for trying out
+capex_scraper.read_capex_portfolio_html without logging in to capexinsider.com.
+
+The server can be told to be slow, to fail a fraction of requests, to always fail some tables, and to hang on some
+tables for longer than the read timeout. It answers conditional requests with 304 Not Modified when the ETag matches.
+Running this file starts one, scrapes it, and checks that every table that could be read was, in page order, that the
+ones that couldn't were left out, and that no more pages were read at once than there are workers. It then downloads
+twice into two snapshot dirs with a capex_scraper.CapexCache, changing some tables in between, and checks that only
+the changed tables were downloaded again, and the rest were hard linked from the first snapshot.
+"""
+import argparse
+import glob
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import capex_scraper
+
+PORTFOLIO_PATH = '/login/portfolio/'
+INFOGRAM_PATH = '/infogram/'
+LIVE_DATA_PATH = '/live/'
+
+def make_table_json(key, version = 0):
+    return json.dumps({ 'data' : [[['Company','Ticker','Weight'],
+                                   [{ 'type' : 'link', 'value' : f'Company {key}', 'href' : f'https://example.com/{key}' },key,f'{5+version}%']]],
+                        'refreshed' : f'2025-05-{9+version:02d}T10:00:00.000Z' }).encode('utf-8')
+
+class FakeCapexServer(ThreadingHTTPServer):
+    def __init__(self, num_infograms, tables_per_infogram, latency_secs = 0.0, failure_rate = 0.0, failing_keys = (),
+                 hanging_keys = (), hang_secs = 0.0, seed = 0):
+        super().__init__(('127.0.0.1',0), FakeCapexHandler)
+        self.infogram_ids = [f'ig-{i:02d}' for i in range(num_infograms)]
+        self.live_keys = { id : [f'{id}-t{j}' for j in range(tables_per_infogram)] for id in self.infogram_ids }
+        self.latency_secs = latency_secs
+        self.failure_rate = failure_rate
+        self.failing_keys = set(failing_keys)
+        self.hanging_keys = set(hanging_keys)
+        self.hang_secs = hang_secs
+        self.rng = random.Random(seed)
+        #live key -> version of the table, which changes its contents and ETag
+        self.table_versions = {}
+
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.num_not_modified = 0
+        self.num_active = 0
+        self.max_active = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def get_portfolio_html(self):
+        #attribute order and quoting vary, and other divs are mixed in, like on the real page
+        divs = [f'<div class="infogram-embed" data-id="{id}" data-type="interactive"></div>' if i % 2 == 0 else
+                f"<div data-id='{id}' data-title=\"t\" class='wp-block infogram-embed'></div>"
+                for i,id in enumerate(self.infogram_ids)]
+        return ('<html><body><div class="header" data-id="not-an-embed"></div>' + '<p>filler</p>' * 500 +
+                ''.join(divs) + '</body></html>').encode('utf-8')
+
+    def get_infogram_html(self, id):
+        entities = { f'e{j}' : { 'props' : { 'chartData' : { 'custom' : { 'live' : { 'key' : key, 'provider' : 'atlas_google_drive' } } } } }
+                     for j,key in enumerate(self.live_keys[id]) }
+        #a chart without live data, which is skipped
+        entities['static'] = { 'props' : { 'chartData' : { 'data' : [[1,2]] } } }
+        data = { 'elements' : { 'content' : { 'content' : { 'entities' : entities } } }, 'text' : 'has }; and "quotes"' }
+        return ('<html><head><script>var x = 1;</script>' + '<script>window.other={};</script>' * 200 +
+                f'<script>window.infographicData={json.dumps(data)};</script></head><body></body></html>').encode('utf-8')
+
+class FakeCapexHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server : FakeCapexServer = self.server
+        with server.lock:
+            server.num_requests += 1
+            server.num_active += 1
+            server.max_active = max(server.max_active,server.num_active)
+            fail = server.rng.random() < server.failure_rate
+        try:
+            time.sleep(server.latency_secs)
+
+            etag = None
+            if(self.path == PORTFOLIO_PATH):
+                body = server.get_portfolio_html()
+            elif(self.path.startswith(INFOGRAM_PATH) and self.path[len(INFOGRAM_PATH):] in server.live_keys):
+                body = server.get_infogram_html(self.path[len(INFOGRAM_PATH):])
+                etag = f'"{self.path[len(INFOGRAM_PATH):]}"'
+            elif(self.path.startswith(LIVE_DATA_PATH)):
+                key = self.path[len(LIVE_DATA_PATH):]
+                if(key in server.hanging_keys):
+                    time.sleep(server.hang_secs)
+                if(key in server.failing_keys):
+                    fail = True
+                version = server.table_versions.get(key,0)
+                body = make_table_json(key,version)
+                etag = f'"{key}-{version}"'
+            else:
+                self.send_error(404)
+                return
+
+            if(fail):
+                self.send_error(500)
+                return
+
+            if(etag is not None and self.headers.get('If-None-Match') == etag):
+                with server.lock:
+                    server.num_not_modified += 1
+                self.send_response(304)
+                self.send_header('ETag',etag)
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            if(etag is not None):
+                self.send_header('ETag',etag)
+            self.send_header('Content-Length',str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError,ConnectionResetError):
+            #the client gave up waiting
+            pass
+        finally:
+            with server.lock:
+                server.num_active -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="scrapes a local fake capex site and checks the results",
+        exit_on_error=True,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--infograms", type=int, default=5, help="number of infogram pages")
+    parser.add_argument("--tables", type=int, default=4, help="number of tables in each infogram page")
+    parser.add_argument("--failing-tables", type=int, default=1, help="number of tables whose requests always fail")
+    parser.add_argument("--hanging-tables", type=int, default=1, help="number of tables that take longer than the timeout")
+    parser.add_argument("--failure-rate", type=float, default=0.1, help="fraction of requests that fail at random")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds each request takes")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=1.0)
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--backoff", type=float, default=0.05, help="seconds before the first retry")
+    parser.add_argument("--changed-tables", type=int, default=2, help="number of tables changed between the cached downloads")
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+
+    all_keys = [f'ig-{i:02d}-t{j}' for i in range(args.infograms) for j in range(args.tables)]
+    rng = random.Random(args.seed)
+    bad_keys = rng.sample(all_keys,args.failing_tables + args.hanging_tables)
+    failing_keys = bad_keys[:args.failing_tables]
+    hanging_keys = bad_keys[args.failing_tables:]
+
+    server = FakeCapexServer(args.infograms,args.tables,args.latency,args.failure_rate,failing_keys,hanging_keys,
+                             args.timeout * 2,args.seed)
+    server.start()
+
+    start_time = time.monotonic()
+    (capex_html,infogram_htmls,table_data) = capex_scraper.read_capex_portfolio_html(
+        urllib.request.build_opener(),args.workers,args.timeout,args.retries,args.backoff,
+        portfolio_url=f"{server.url}{PORTFOLIO_PATH}",infogram_url=f"{server.url}{INFOGRAM_PATH}",
+        live_data_url=f"{server.url}{LIVE_DATA_PATH}")
+    elapsed = time.monotonic() - start_time
+
+    print(f"{server.num_requests} requests in {elapsed:.2f}s, at most {server.max_active} at once")
+
+    errors = []
+    expected_keys = [k for k in all_keys if k not in bad_keys]
+    if(len(infogram_htmls) != args.infograms):
+        errors.append(f"read {len(infogram_htmls)} infogram pages, expected {args.infograms}")
+    if([key for (_,key,_) in table_data] != expected_keys):
+        errors.append(f"read tables {[key for (_,key,_) in table_data]}, expected {expected_keys}")
+    errors += [f"table {key} is wrong" for (_,key,td) in table_data if td != make_table_json(key)]
+    #each infogram page also has an entity without a live key, which takes an index but isn't read
+    errors += [f"table {key} has index {index}, expected {expected_index}" for (index,key,_) in table_data
+               for expected_index in [all_keys.index(key) + all_keys.index(key) // args.tables]
+               if index != expected_index]
+    if(server.max_active > args.workers):
+        errors.append(f"{server.max_active} requests at once, but only {args.workers} workers")
+
+    #the cached downloads, without failures so every table is read
+    server.failure_rate = 0.0
+    server.failing_keys = set()
+    server.hanging_keys = set()
+    changed_keys = rng.sample(all_keys,args.changed_tables)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = capex_scraper.CapexCache(os.path.join(tmp_dir,'capex_cache.sqlite'))
+        def download(snap_dir):
+            os.makedirs(snap_dir)
+            (_,_,table_data) = capex_scraper.read_capex_portfolio_html(
+                urllib.request.build_opener(),args.workers,args.timeout,args.retries,args.backoff,
+                portfolio_url=f"{server.url}{PORTFOLIO_PATH}",infogram_url=f"{server.url}{INFOGRAM_PATH}",
+                live_data_url=f"{server.url}{LIVE_DATA_PATH}",cache=cache)
+            num_changed = capex_scraper.save_tables(table_data,snap_dir,cache)
+            return { os.path.basename(fp).split('_',3)[3][:-len('.json')] : fp
+                     for fp in glob.glob(os.path.join(snap_dir,'capex_data_*.json')) },num_changed
+
+        (files1,num_changed1) = download(os.path.join(tmp_dir,'2025-05-09'))
+        for key in changed_keys:
+            server.table_versions[key] = 1
+        num_not_modified = server.num_not_modified
+        (files2,num_changed2) = download(os.path.join(tmp_dir,'2025-05-10'))
+        num_not_modified = server.num_not_modified - num_not_modified
+        cache.close()
+
+        print(f"second cached download had {num_not_modified} unchanged pages and tables, {num_changed2} changed tables")
+
+        if(num_changed1 != len(all_keys)):
+            errors.append(f"first cached download changed {num_changed1} tables, expected {len(all_keys)}")
+        if(num_changed2 != len(changed_keys)):
+            errors.append(f"second cached download changed {num_changed2} tables, expected {len(changed_keys)}")
+        if(num_not_modified != args.infograms + len(all_keys) - len(changed_keys)):
+            errors.append(f"second cached download had {num_not_modified} unchanged pages and tables, expected "
+                          f"{args.infograms + len(all_keys) - len(changed_keys)}")
+        if(sorted(files2) != sorted(all_keys)):
+            errors.append(f"second cached download saved {sorted(files2)}, expected {sorted(all_keys)}")
+        for key,fp in files2.items():
+            with open(fp,'rb') as f:
+                if(f.read() != make_table_json(key,server.table_versions.get(key,0))):
+                    errors.append(f"table {key} in second cached download is wrong")
+            if((key in changed_keys) == os.path.samefile(fp,files1[key])):
+                errors.append(f"table {key} is {'' if key in changed_keys else 'not '}linked to the first download")
+
+    server.shutdown()
+
+    for e in errors:
+        print(e)
+    print("ok" if not errors else f"{len(errors)} errors")
+
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,173 @@
+"""A local fake quote server, for trying out history_stock_downloader's fetch scheduler without talking to yahoo.
+
+The server makes up weekly prices for any symbol, and can be told to be slow, to fail a fraction of requests, and to
+always fail requests containing certain symbols. Running this file starts one, downloads through it into a temporary
+price store, and checks that every symbol that could be fetched was, and that the ones that couldn't weren't recorded
+as fetched.
+"""
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+import requests
+
+import history_stock_downloader
+
+#symbols starting with this are unknown to the server, and get no data, like yahoo does for delisted symbols
+UNKNOWN_SYMBOL_PREFIX = 'UNK'
+
+class FakeQuoteServer(ThreadingHTTPServer):
+    def __init__(self, latency_secs = 0.0, failure_rate = 0.0, failing_symbols = (), seed = 0):
+        super().__init__(('127.0.0.1',0), FakeQuoteHandler)
+        self.latency_secs = latency_secs
+        self.failure_rate = failure_rate
+        self.failing_symbols = set(failing_symbols)
+        self.rng = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.request_times = []
+        self.num_active = 0
+        self.max_active = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+class FakeQuoteHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server : FakeQuoteServer = self.server
+        with server.lock:
+            server.request_times.append(time.monotonic())
+            server.num_active += 1
+            server.max_active = max(server.max_active,server.num_active)
+            fail = server.rng.random() < server.failure_rate
+        try:
+            time.sleep(server.latency_secs)
+
+            query = parse_qs(urlparse(self.path).query)
+            symbols = query['symbols'][0].split(',')
+            if(fail or server.failing_symbols.intersection(symbols)):
+                self.send_error(500)
+                return
+
+            dates = pd.date_range(query['start'][0],query['end'][0],freq='W-MON',inclusive='left')
+            res = { s : { 'date' : [d.strftime('%Y-%m-%d') for d in dates],
+                          'adjclose' : [float(sum(map(ord,s)) + d.toordinal() % 100) for d in dates] }
+                    for s in symbols if not s.startswith(UNKNOWN_SYMBOL_PREFIX) }
+
+            body = json.dumps(res).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type','application/json')
+            self.send_header('Content-Length',str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.num_active -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+def make_fetch_fn(base_url, timeout = 30):
+    """Returns a fetch_fn for history_stock_downloader.download_stock_history that reads from a FakeQuoteServer"""
+    def fetch(batch, start_date, end_date, interval):
+        r = requests.get(f"{base_url}/history", params={ 'symbols' : ','.join(batch), 'start' : start_date, 'end' : end_date,
+                                                         'interval' : interval }, timeout=timeout)
+        r.raise_for_status()
+        data = r.json()
+
+        results = {}
+        for symbol in batch:
+            if(symbol in data and data[symbol]['date']):
+                results[symbol] = pd.DataFrame({ 'adjclose' : data[symbol]['adjclose'] },
+                                               index=pd.to_datetime(data[symbol]['date']))
+            else:
+                results[symbol] = None
+        return results
+
+    return fetch
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="downloads stock history from a local fake quote server and checks the results",
+        exit_on_error=True,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--symbols", type=int, default=100, help="number of symbols to download")
+    parser.add_argument("--unknown-symbols", type=int, default=5, help="number of symbols the server has no data for")
+    parser.add_argument("--failing-symbols", type=int, default=2, help="number of symbols whose requests always fail")
+    parser.add_argument("--failure-rate", type=float, default=0.2, help="fraction of requests that fail at random")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds each request takes")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=history_stock_downloader.DEFAULT_FETCH_WORKERS)
+    parser.add_argument("--requests-per-sec", type=float, default=20.0)
+    parser.add_argument("--retries", type=int, default=history_stock_downloader.DEFAULT_FETCH_RETRIES)
+    parser.add_argument("--backoff", type=float, default=0.05, help="seconds before the first retry")
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+
+    symbols = [f"S{i:03d}" for i in range(args.symbols)]
+    unknown_symbols = [f"{UNKNOWN_SYMBOL_PREFIX}{i:03d}" for i in range(args.unknown_symbols)]
+    failing_symbols = [f"F{i:03d}" for i in range(args.failing_symbols)]
+    all_symbols = symbols + unknown_symbols + failing_symbols
+    random.Random(args.seed).shuffle(all_symbols)
+
+    server = FakeQuoteServer(args.latency,args.failure_rate,failing_symbols,args.seed)
+    server.start()
+
+    errors = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store_file = os.path.join(tmp_dir,'stock_prices.sqlite')
+        def download():
+            return history_stock_downloader.download_stock_history(all_symbols,'2024-01-01','2025-01-01','1wk',store_file,args.batch_size,
+                                                                   fetch_fn=make_fetch_fn(server.url),workers=args.workers,
+                                                                   requests_per_sec=args.requests_per_sec,retries=args.retries,
+                                                                   backoff_secs=args.backoff)
+
+        start_time = time.monotonic()
+        res = download()
+        elapsed = time.monotonic() - start_time
+
+        times = server.request_times
+        #the fastest rate seen over any window of a second
+        peak_rate = max(sum(1 for t2 in times if t <= t2 < t+1.0) for t in times) if times else 0
+        print(f"{len(times)} requests in {elapsed:.2f}s, at most {server.max_active} at once and {peak_rate} in one second")
+
+        errors += [f"no data for {s}" for s in symbols if res[s] is None]
+        errors += [f"got data for {s}" for s in unknown_symbols + failing_symbols if res[s] is not None]
+        if(server.max_active > args.workers):
+            errors.append(f"{server.max_active} requests at once, but only {args.workers} workers")
+        if(peak_rate > args.requests_per_sec + args.workers):
+            errors.append(f"{peak_rate} requests in one second, limit is {args.requests_per_sec}")
+
+        #everything but the failing symbols should now be in the store, and not fetched again
+        num_requests = len(times)
+        server.failure_rate = 0.0
+        download()
+        store = history_stock_downloader.PriceStore(store_file)
+        for s in all_symbols:
+            fetched = not store.get_missing_ranges(s,'1wk','2024-01-01','2025-01-01')
+            if(fetched == (s in failing_symbols)):
+                errors.append(f"{s} is {'' if fetched else 'not '}recorded as fetched")
+        store.close()
+        print(f"second download made {len(times) - num_requests} requests")
+
+    server.shutdown()
+
+    for e in errors:
+        print(e)
+    print("ok" if not errors else f"{len(errors)} errors")
+
+    sys.exit(1 if errors else 0)
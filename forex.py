@@ -0,0 +1,239 @@
+"""Converts amounts between currencies with the ECB euro reference rates, and keeps the rates downloaded for all
+snapshots in a store in the main dir.
+
+The rates are read once into a table with a row for every day and a column for every currency, so whole columns of
+amounts are converted with array lookups rather than one call per amount. The results are the same as
+CurrencyConverter(fallback_on_missing_rate=True, fallback_on_wrong_date=True) gives:
+- days without a rate (ex. weekends) are linearly interpolated between the closest days with one
+- days before or after the rates of a currency use its first or last rate
+- without a date, the last date the currency being converted from has a rate for is used
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass
+import datetime
+import io
+import sqlite3
+import sys
+import urllib.request
+
+import numpy as np
+import pandas as pd
+
+import ftypes
+import util
+
+#the ECB rates are the value of one euro in each currency
+REF_CURRENCY = 'EUR'
+
+#the ECB files have dates like 2025-05-09 (history file) or 09 May 2025 (single day file)
+DATE_FORMATS = ['%Y-%m-%d','%d %B %Y']
+
+DATE_FORMAT = '%Y-%m-%d'
+
+#the ECB publishes the rates of each weekday at around 16:00 CET
+PUBLISH_HOUR_UTC = 16
+
+#the days of rates in ftypes.FOREX_90_DAY_URL, less a few in case the file is a little behind
+RECENT_RATES_DAYS = 85
+
+@dataclass
+class RateTable:
+    first_date : np.datetime64 # date of the first row of rates
+    currencies : list[str]
+    rates : np.ndarray # days x currencies, the value of a euro in each currency on each day since first_date
+    last_days : np.ndarray # for each currency, the row of the last day the file has a rate for
+
+    def get_currency_indexes(self, currencies):
+        """Returns the column of each currency, or errors out if one isn't in the table"""
+        currency_to_index = { c : i for i,c in enumerate(self.currencies) }
+        unknown = [c for c in currencies if c not in currency_to_index]
+        if(unknown):
+            util.error(f"No exchange rates for {', '.join(map(str,unknown))}, must be one of {', '.join(self.currencies)}")
+        return np.array([currency_to_index[c] for c in currencies],dtype=int)
+
+def parse_dates(s : pd.Series):
+    res = pd.Series(pd.NaT,index=s.index,dtype='datetime64[ns]')
+    for fmt in DATE_FORMATS:
+        res = res.fillna(pd.to_datetime(s,format=fmt,errors='coerce'))
+    return res
+
+def read_rates_file(fp, compression = 'infer') -> pd.DataFrame:
+    """Reads an ECB rates file, either the zip or the csv inside it, into a frame of the rates of each currency,
+    indexed by date. Missing rates are NaN
+    """
+    #ex. "Date,USD,JPY,..." then "2025-05-09,1.1253,163.71,...", missing rates are 'N/A' or blank
+    df = pd.read_csv(fp,dtype=str,keep_default_na=False,skipinitialspace=True,compression=compression)
+    df.columns = [c.strip() for c in df.columns]
+    #each line ends with a comma, which makes an extra unnamed column
+    df = df[[c for c in df.columns if c != '' and not c.startswith('Unnamed:')]]
+
+    dates = parse_dates(df['Date'].str.strip())
+    if(dates.isna().any()):
+        util.error(f"Cannot parse date '{df['Date'][dates.isna()].iloc[0]}' in {fp}")
+
+    rates = df.drop(columns='Date').apply(lambda c : pd.to_numeric(c.str.strip().replace(['','N/A'],None),errors='coerce'))
+    rates.index = dates
+    return rates.groupby(level=0).last().dropna(axis=1,how='all')
+
+def make_rate_table(rates : pd.DataFrame) -> RateTable:
+    """Makes the table of the rates of every day from a frame like read_rates_file returns"""
+    if(rates.empty):
+        util.error("There are no exchange rates")
+
+    days = pd.date_range(rates.index[0],rates.index[-1],freq='D')
+    rates = rates.reindex(days)
+    last_days = np.array([days.get_loc(rates[c].last_valid_index()) for c in rates.columns],dtype=int)
+    rates = rates.interpolate(method='linear',limit_area='inside').ffill().bfill()
+
+    rates[REF_CURRENCY] = 1.0
+    last_days = np.append(last_days,len(days)-1)
+
+    return RateTable(days[0].to_datetime64().astype('datetime64[D]'),list(rates.columns),rates.to_numpy(dtype=float),last_days)
+
+def read_rate_table(fp : str) -> RateTable:
+    return make_rate_table(read_rates_file(fp))
+
+def convert(table : RateTable, amounts, currencies, new_currency : str, dates = None) -> np.ndarray:
+    """Converts each amount from its currency to new_currency.
+
+    Args:
+        amounts: array-like of numbers
+        currencies: array-like of currency codes, the same length as amounts
+        dates: optional array-like of the dates to use the rates of, the same length as amounts. Where not given, or
+            missing, the last date the currency has a rate for is used
+
+    Returns:
+        array of the converted amounts, NaN where the amount or currency is missing
+    """
+    amounts = pd.to_numeric(pd.Series(amounts),errors='coerce').to_numpy(dtype=float)
+
+    #each distinct currency is only looked up once
+    codes,uniques = pd.factorize(pd.Series(currencies,dtype=object))
+    present = codes >= 0
+    from_index = np.zeros(len(codes),dtype=int)
+    from_index[present] = table.get_currency_indexes(list(uniques))[codes[present]]
+    to_index = table.get_currency_indexes([new_currency])[0]
+
+    days = table.last_days[from_index]
+    if(dates is not None):
+        dates = pd.to_datetime(pd.Series(dates),errors='coerce').to_numpy(dtype='datetime64[D]')
+        has_date = ~np.isnat(dates)
+        days[has_date] = np.clip((dates[has_date] - table.first_date).astype(int),0,len(table.rates)-1)
+
+    res = amounts / table.rates[days,from_index] * table.rates[days,to_index]
+    res[~present] = np.nan
+
+    return res
+
+class RateStore:
+    """Stores the ECB rates in sqlite, by (date, currency), so they're only downloaded once for all snapshots"""
+
+    def __init__(self, db_file):
+        self.conn = sqlite3.connect(db_file)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS rates (date TEXT NOT NULL, currency TEXT NOT NULL, rate REAL NOT NULL,
+                                PRIMARY KEY (date, currency)) WITHOUT ROWID""")
+        #the latest date rates were downloaded for, which may be later than the last rates if the ECB didn't publish any
+        self.conn.execute("CREATE TABLE IF NOT EXISTS checked (id INTEGER PRIMARY KEY CHECK (id = 0), date TEXT NOT NULL)")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def commit(self):
+        self.conn.commit()
+
+    def get_last_date(self):
+        """Returns the last date there are rates for, as YYYY-MM-DD, or None if there are none"""
+        return self.conn.execute("SELECT MAX(date) FROM rates").fetchone()[0]
+
+    def get_checked_date(self):
+        row = self.conn.execute("SELECT date FROM checked").fetchone()
+        return None if row is None else row[0]
+
+    def set_checked_date(self, date : str):
+        self.conn.execute("INSERT OR REPLACE INTO checked VALUES (0,?)", (date,))
+
+    def add_rates(self, rates : pd.DataFrame):
+        """Adds the rates of a frame like read_rates_file returns. Rates already stored for a date are replaced"""
+        stacked = rates.stack().dropna()
+        self.conn.executemany("INSERT OR REPLACE INTO rates VALUES (?,?,?)",
+                              zip(stacked.index.get_level_values(0).strftime(DATE_FORMAT),stacked.index.get_level_values(1),
+                                  stacked.to_numpy(dtype=float)))
+
+    def load_rates(self, end_date : str = None) -> pd.DataFrame:
+        """Returns the rates up to and including end_date (all if None), as a frame like read_rates_file returns"""
+        df = pd.read_sql_query("SELECT date, currency, rate FROM rates WHERE date <= ? ORDER BY date", self.conn,
+                               params=[end_date or '9999-12-31'])
+        rates = df.pivot(index='date',columns='currency',values='rate')
+        rates.index = pd.DatetimeIndex(pd.to_datetime(rates.index,format=DATE_FORMAT))
+        rates.columns.name = None
+        return rates
+
+def get_latest_published_date(now : datetime.datetime = None) -> str:
+    """Returns the latest weekday the ECB should have published rates for by now (utc). Holidays aren't accounted for"""
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    day = now.date() if now.hour >= PUBLISH_HOUR_UTC else now.date() - datetime.timedelta(days=1)
+    while(day.weekday() >= 5):
+        day -= datetime.timedelta(days=1)
+    return day.strftime(DATE_FORMAT)
+
+def download_rates(url : str, timeout : float) -> pd.DataFrame:
+    with urllib.request.urlopen(url,timeout=timeout) as r:
+        content = r.read()
+    return read_rates_file(io.BytesIO(content),compression='zip')
+
+def update_rate_store(store_file : str, timeout : float = ftypes.FOREX_DOWNLOAD_TIMEOUT_SECS):
+    """Downloads the rates published since the last ones in the store, from the smallest ECB file that has them all.
+    Nothing is downloaded if the store is already up to date, and if the download fails, the rates already stored are
+    kept and a warning is given.
+
+    Returns:
+        the last date there are rates for, as YYYY-MM-DD, or None if there are none
+    """
+    store = RateStore(store_file)
+    try:
+        last_date = store.get_last_date()
+        latest_date = get_latest_published_date()
+        if(store.get_checked_date() == latest_date or (last_date is not None and last_date >= latest_date)):
+            return last_date
+
+        #only the missing days are downloaded: the latest day's file if only it is missing, the last 90 days' if the
+        #store is less behind than that, and the whole history only when the store is new or much further behind
+        previous_date = get_latest_published_date(datetime.datetime.strptime(latest_date,DATE_FORMAT) - datetime.timedelta(hours=1))
+        recent_date = (datetime.datetime.strptime(latest_date,DATE_FORMAT) - datetime.timedelta(days=RECENT_RATES_DAYS)).strftime(DATE_FORMAT)
+        if(last_date is not None and last_date >= previous_date):
+            url = ftypes.FOREX_URL
+        elif(last_date is not None and last_date >= recent_date):
+            url = ftypes.FOREX_90_DAY_URL
+        else:
+            url = ftypes.FOREX_HISTORY_URL
+
+        print(f"Downloading exchange rates from {url}")
+        try:
+            rates = download_rates(url,timeout)
+        except Exception as e:
+            util.warn(f"Could not download exchange rates from {url}: {e}. " +
+                      (f"Using the stored rates of {last_date}" if last_date is not None else "There are no stored rates"))
+            return last_date
+
+        store.add_rates(rates)
+        store.set_checked_date(latest_date)
+        store.commit()
+
+        return store.get_last_date()
+    finally:
+        store.close()
+
+def load_store_rate_table(store_file : str, end_date : str = None) -> RateTable:
+    """Returns the table of the rates in the store up to and including end_date (all if None)"""
+    store = RateStore(store_file)
+    try:
+        return make_rate_table(store.load_rates(end_date))
+    finally:
+        store.close()
+
+if __name__ == '__main__':
+    #ex. python forex.py forex.zip 100 USD CAD 2025-05-09
+    table = read_rate_table(sys.argv[1])
+    print(convert(table,[float(sys.argv[2])],[sys.argv[3]],sys.argv[4],None if len(sys.argv) < 6 else [sys.argv[5]])[0])
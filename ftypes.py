@@ -12,10 +12,41 @@ FINANCE_REPORTS_DIR = "reports"
 
 THEME_TRACK_CONFIG_FILE = 'theme_track_config.xlsx'
 
-YAHOO_FINANCE_CACHE_FILE = 'yahoo_finance_cache.json'
+#sheet of the report with the holdings, as read from the brokerage files
+HOLDINGS_WS_TITLE = 'Holdings Input Data'
 
+#the names of the ways rules can be run and reports written, see rules_parser.RULES_ENGINES and reports.REPORT_WRITERS.
+#Here so the command line can list them without importing those
+RULES_ENGINE_NAMES = ['compiled','rowwise','indexed']
+REPORT_WRITER_NAMES = ['write-only','openpyxl']
+
+#holds data derived from the files in a snapshot dir, so it doesn't need to be recomputed every run.
+#can be deleted at any time
+SNAPSHOT_CACHE_DIR = '.theme_track_cache'
+
+#stock prices downloaded for all snapshots, kept in the main dir
+STOCK_PRICE_STORE_FILE = 'stock_prices.sqlite'
+#the stock prices used by a snapshot, kept in the snapshot dir so its reports can be reproduced
+SNAPSHOT_STOCK_PRICES_FILE = 'stock_prices_used.sqlite'
+
+#latest day of ECB exchange rates, the last 90 days of them, and all of them since 1999
 FOREX_URL = 'https://www.ecb.europa.eu/stats/eurofxref/eurofxref.zip'
+FOREX_90_DAY_URL = 'https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist-90d.zip'
+FOREX_HISTORY_URL = 'https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist.zip'
+FOREX_DOWNLOAD_TIMEOUT_SECS = 30
+#the exchange rates of older snapshots, downloaded into the snapshot dir
 FOREX_FILENAME = 'forex.zip'
+#exchange rates downloaded for all snapshots, kept in the main dir
+FOREX_STORE_FILE = 'forex_rates.sqlite'
+#the date of the latest exchange rates a snapshot uses from the forex store, kept in the snapshot dir
+FOREX_DATE_FILENAME = 'forex_date.txt'
+
+#how download-capex reads the capex pages and tables
+CAPEX_FETCH_WORKERS = 8 # pages read at the same time
+CAPEX_FETCH_TIMEOUT_SECS = 30
+CAPEX_FETCH_RETRIES = 2 # times a failed read is retried
+#capex pages and tables downloaded before, kept in the main dir, so only changed ones are downloaded again
+CAPEX_CACHE_FILE = 'capex_cache.sqlite'
 
 WELCOME_BAT_FILE = r'dos_scripts\welcome.bat'
 WELCOME_BAT_ENV = 'IN_WELCOME_BAT'
@@ -30,6 +61,12 @@ GAIN_LOSS_PREFIX = 'R:GainLoss'
 
 GAIN_LOSS_NOT_ALL_DATA_PRESENT_PREFIX = 'R:GainLossNotAllPresent'
 
+#time weighted and money weighted returns, calculated from brokerage events, see returns.py
+TWR_PREFIX = 'R:TWR'
+MWR_PREFIX = 'R:MWR'
+
+RETURN_NOT_ALL_DATA_PRESENT_PREFIX = 'R:ReturnNotAllPresent'
+
 
 class PickType(Enum):
     CapexTotalPortfolio = auto(),
@@ -83,6 +120,13 @@ class BrokerageTypes(Enum):
     InteractiveBrokers = auto(),
     Schwab = auto(),
 
+#kinds of brokerage events used to calculate returns
+class EventTypes(Enum):
+    Buy = auto(),
+    Sell = auto(),
+    Dividend = auto(),
+    Fee = auto(),
+
 class DataTypes(Enum):
     Pick = auto(),
     Holding = auto(),
@@ -200,6 +244,11 @@ class ReportConfig:
 
 
 
+#which day's exchange rates values are converted to the report currency with
+class ForexDateTypes(Enum):
+    Latest = auto(), # the latest rates in the snapshot's forex file
+    RefreshedDate = auto(), # the rates of each row's D:RefreshedDate, or the latest if it has none
+
 @dataclass
 class Config:
     version : str
@@ -208,3 +257,4 @@ class Config:
     currency_formats : dict[str,str] # currency to excel format
     hist_perf_periods : list[str]
     hist_perf_slip_days : int
+    forex_date : ForexDateTypes = ForexDateTypes.Latest
@@ -1,90 +1,376 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
 from io import StringIO
 import json
 import os
+import random
+import sqlite3
+import threading
+import time
 import pandas as pd
-from yahooquery import Ticker
 
+import util
 
-#if a unknowned symbol is given to yahooquery, it just returns nothing. In this case, we need to store that nothing was returned in the cache.
+
+#if a unknowned symbol is given to yahooquery, it just returns nothing. In the old json cache, this was stored as the result
 NO_RESULTS = "No Results"
 
-def download_stock_history(symbols, start_date, end_date, interval, cache_file, batch_size):
+#the json cache file used by older versions, which is imported into a new price store
+OLD_JSON_CACHE_FILE = 'yahoo_finance_cache.json'
+
+#columns of the price history that are kept. Yahoo may not return all of them
+PRICE_COLUMNS = ['open','high','low','close','volume','adjclose','dividends','splits']
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def to_store_date(d):
+    """Converts a date, datetime or 'YYYY-MM-DD' string to the text format dates are stored in, which sorts in date order"""
+    ts = pd.Timestamp(d)
+    if(ts.tzinfo is not None):
+        ts = ts.tz_localize(None)
+    return ts.strftime(DATE_FORMAT)
+
+class PriceStore:
+    """Stores stock price history in sqlite, by (symbol, interval, date).
+
+    Also records which date ranges have already been fetched for each symbol and interval, including ranges
+    where yahoo returned nothing, so that only the missing ranges need to be fetched. Ranges are half open,
+    [start, end), like the start and end passed to yahoo.
+    """
+
+    def __init__(self, db_file):
+        self.conn = sqlite3.connect(db_file)
+        self.conn.execute(f"""CREATE TABLE IF NOT EXISTS prices (symbol TEXT NOT NULL, interval TEXT NOT NULL, date TEXT NOT NULL,
+                                {', '.join(f'{c} REAL' for c in PRICE_COLUMNS)},
+                                PRIMARY KEY (symbol, interval, date))""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS fetched_ranges (symbol TEXT NOT NULL, interval TEXT NOT NULL,
+                                start TEXT NOT NULL, end TEXT NOT NULL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS fetched_ranges_symbol ON fetched_ranges (symbol, interval)")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def get_fetched_ranges(self, symbol, interval):
+        return self.conn.execute("SELECT start, end FROM fetched_ranges WHERE symbol = ? AND interval = ? ORDER BY start",
+                                 (symbol,interval)).fetchall()
+
+    def get_missing_ranges(self, symbol, interval, start, end):
+        """Returns the parts of [start, end) that haven't been fetched yet, as a list of (start, end)"""
+        start,end = to_store_date(start),to_store_date(end)
+        missing = []
+        for (fetched_start,fetched_end) in self.get_fetched_ranges(symbol,interval):
+            if(fetched_end <= start):
+                continue
+            if(fetched_start >= end):
+                break
+            if(fetched_start > start):
+                missing.append((start,fetched_start))
+            start = max(start,fetched_end)
+
+        if(start < end):
+            missing.append((start,end))
+
+        return missing
+
+    def get_last_date_before(self, symbol, interval, date):
+        """Returns the date of the last bar stored before date, or None"""
+        return self.conn.execute("SELECT MAX(date) FROM prices WHERE symbol = ? AND interval = ? AND date < ?",
+                                 (symbol,interval,to_store_date(date))).fetchone()[0]
+
+    def add_fetched_range(self, symbol, interval, start, end):
+        """Records that [start, end) was fetched, merging it with the ranges already recorded"""
+        start,end = to_store_date(start),to_store_date(end)
+        for (fetched_start,fetched_end) in self.get_fetched_ranges(symbol,interval):
+            if(fetched_end >= start and fetched_start <= end):
+                start = min(start,fetched_start)
+                end = max(end,fetched_end)
+
+        self.conn.execute("DELETE FROM fetched_ranges WHERE symbol = ? AND interval = ? AND end >= ? AND start <= ?",
+                          (symbol,interval,start,end))
+        self.conn.execute("INSERT INTO fetched_ranges VALUES (?,?,?,?)", (symbol,interval,start,end))
+
+    def add_prices(self, symbol, interval, df):
+        """Adds the rows of a price history frame, indexed by date. Rows already stored for a date are replaced"""
+        if(df is None or df.empty):
+            return
+
+        rows = [(symbol,interval,to_store_date(d)) + tuple(None if pd.isna(v) else float(v) for v in vals)
+                for d,vals in zip(df.index,df.reindex(columns=PRICE_COLUMNS).itertuples(index=False))]
+        self.conn.executemany(f"INSERT OR REPLACE INTO prices VALUES ({','.join(['?']*(3+len(PRICE_COLUMNS)))})", rows)
+
+    def commit(self):
+        self.conn.commit()
+
+    def load_prices(self, symbols, interval, start, end):
+        """Returns a dict of symbol to its price history frame within [start, end), or None if there is no data.
+        Only columns with at least one value are included, and the index is a DatetimeIndex
+        """
+        placeholders = ','.join(['?']*len(symbols))
+        df = pd.read_sql_query(f"""SELECT * FROM prices WHERE symbol IN ({placeholders}) AND interval = ? AND date >= ? AND date < ?
+                                   ORDER BY symbol, date""",
+                               self.conn, params=list(symbols) + [interval,to_store_date(start),to_store_date(end)])
+
+        results = { symbol : None for symbol in symbols }
+        for symbol,symbol_df in df.groupby('symbol',sort=False):
+            symbol_df = symbol_df.set_index(pd.DatetimeIndex(pd.to_datetime(symbol_df['date'],format=DATE_FORMAT),name='date'))
+            results[symbol] = symbol_df[PRICE_COLUMNS].dropna(axis=1,how='all')
+
+        return results
+
+    def import_json_cache(self, cache_file):
+        """Imports the entries of the json cache file used by older versions"""
+        try:
+            with open(cache_file, 'r') as f:
+                cache = json.load(f)
+        except Exception as e:
+            util.warn(f"Could not import old stock history cache {cache_file}: {e}")
+            return
+
+        for key,value in cache.items():
+            symbol,start,end,interval = key.split('|')
+            if(value != NO_RESULTS):
+                self.add_prices(symbol,interval,pd.read_json(StringIO(value)))
+            self.add_fetched_range(symbol,interval,start,end)
+        self.commit()
+
+def open_price_store(store_file):
+    """Opens the price store, creating it if necessary. If it's new and the json cache file of older versions is
+    next to it, that is imported"""
+    is_new = not os.path.exists(store_file)
+    store = PriceStore(store_file)
+
+    old_cache_file = os.path.join(os.path.dirname(store_file),OLD_JSON_CACHE_FILE)
+    if(is_new and os.path.exists(old_cache_file)):
+        store.import_json_cache(old_cache_file)
+
+    return store
+
+def fetch_history_batch(batch, start_date, end_date, interval):
+    """Fetches price history from yahoo for a batch of symbols. Raises an exception if the request fails
+
+    Returns:
+        dict of symbol to its history frame, or None if yahoo returned nothing for it
+    """
+    #slow to import, and not needed when all the prices are already stored
+    from yahooquery import Ticker
+
+    print(f"Fetching stocks for {batch}")
+    stocks = Ticker(batch, timeout=120, asynchronous=True)
+    print(f"Fetching stock histoy for {batch} from {start_date} to {end_date}")
+    df = stocks.history(start=start_date, end=end_date, interval=interval)
+    print(f"Done fetching stock histoy for {batch}")
+
+    results = {}
+    for symbol in batch:
+        #when some symbols can't be found, yahooquery returns a dict of symbol to frame or error message instead
+        if(isinstance(df,dict)):
+            symbol_df = df.get(symbol)
+            results[symbol] = symbol_df if isinstance(symbol_df,pd.DataFrame) and not symbol_df.empty else None
+        #if all the symbols failed to load, the df returned has no columns
+        elif(df.empty):
+            results[symbol] = None
+        else:
+            try:
+                results[symbol] = df.xs(symbol,level='symbol')
+            except KeyError:
+                results[symbol] = None
+
+    return results
+
+DEFAULT_FETCH_WORKERS = 4
+DEFAULT_REQUESTS_PER_SEC = 2.0
+DEFAULT_FETCH_RETRIES = 3
+DEFAULT_BACKOFF_SECS = 2.0
+MAX_BACKOFF_SECS = 60.0
+
+class TokenBucket:
+    """Limits the rate of requests. Each request takes a token, and tokens are added back at a fixed rate, up to
+    capacity, so short bursts are allowed. Thread safe.
+    """
+
+    def __init__(self, rate, capacity, clock = time.monotonic, sleep = time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.last_time = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available and takes it"""
+        while(True):
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+                self.last_time = now
+                if(self.tokens >= 1):
+                    self.tokens -= 1
+                    return
+                wait_secs = (1 - self.tokens) / self.rate
+            self.sleep(wait_secs)
+
+class FetchScheduler:
+    """Runs batch fetches concurrently, rate limited, retrying failed requests with exponential backoff.
+
+    If a batch still fails after all its retries, it's split in half and each half is tried again, so that a
+    single bad symbol can't fail the others. A symbol that fails on its own is left out of the results, so it
+    isn't recorded as fetched and is tried again next time.
+    """
+
+    def __init__(self, fetch_fn, workers = DEFAULT_FETCH_WORKERS, requests_per_sec = DEFAULT_REQUESTS_PER_SEC,
+                 retries = DEFAULT_FETCH_RETRIES, backoff_secs = DEFAULT_BACKOFF_SECS, sleep = time.sleep):
+        """
+        Args:
+            fetch_fn: fn(batch, start, end) returning a dict of symbol to history frame or None. Raises on failure
+            workers: number of batches fetched at the same time
+            requests_per_sec: maximum rate of requests, or None for no limit
+            retries: number of times a failed request is retried before giving up
+            backoff_secs: time to wait before the first retry. Doubles with each retry
+        """
+        self.fetch_fn = fetch_fn
+        self.workers = workers
+        self.rate_limiter = TokenBucket(requests_per_sec, max(workers,1), sleep=sleep) if requests_per_sec else None
+        self.retries = retries
+        self.backoff_secs = backoff_secs
+        self.sleep = sleep
+
+    def fetch_with_retries(self, batch, start, end):
+        """Returns (dict of symbol to frame or None, list of symbols that failed)"""
+        for attempt in range(self.retries + 1):
+            if(self.rate_limiter is not None):
+                self.rate_limiter.acquire()
+            try:
+                return self.fetch_fn(batch, start, end),[]
+            except Exception as e:
+                if(attempt == self.retries):
+                    util.warn(f"Fetching {batch} from {start} to {end} failed: {e}")
+                    break
+                delay = min(self.backoff_secs * 2**attempt, MAX_BACKOFF_SECS)
+                #jitter, so workers that failed together don't all retry together
+                self.sleep(delay * random.uniform(1.0, 1.5))
+
+        if(len(batch) == 1):
+            return {},batch
+
+        mid = len(batch) // 2
+        results,failed = self.fetch_with_retries(batch[:mid], start, end)
+        results2,failed2 = self.fetch_with_retries(batch[mid:], start, end)
+        results.update(results2)
+        return results,failed + failed2
+
+    def run(self, jobs):
+        """Fetches each job, a tuple of (batch, start, end).
+
+        Returns:
+            iterator of (job, dict of symbol to frame or None), in the order jobs finish. Failed symbols are
+            left out of the dict
+        """
+        with ThreadPoolExecutor(max_workers=max(self.workers,1)) as executor:
+            futures = { executor.submit(self.fetch_with_retries, *job) : job for job in jobs }
+            for future in as_completed(futures):
+                results,failed = future.result()
+                if(failed):
+                    util.warn(f"Could not fetch stock history for {', '.join(failed)}, will try again next time")
+                yield futures[future],results
+
+def fill_missing_ranges(store, symbols, interval, start_date, end_date, run_jobs_fn, batch_size, refetch_last_bar):
+    """Fetches the date ranges of each symbol that aren't in the store yet, and adds them to it.
+
+    Args:
+        run_jobs_fn: fn(jobs) that fetches jobs of (batch, start, end), with 'YYYY-MM-DD' dates, and returns an
+            iterator of (job, dict of symbol to history frame or None). See FetchScheduler.run
+        refetch_last_bar: if true, a range that continues on from stored data is fetched starting at the last bar
+            already stored, since that bar may have been incomplete when it was fetched
+    """
+    # Group the symbols by the range they are missing, since a request is for a single range
+    symbols_for_range = {}
+    for symbol in symbols:
+        for (range_start,range_end) in store.get_missing_ranges(symbol,interval,start_date,end_date):
+            if(refetch_last_bar):
+                range_start = store.get_last_date_before(symbol,interval,range_start) or range_start
+            symbols_for_range.setdefault((range_start,range_end),[]).append(symbol)
+
+    jobs = []
+    for (range_start,range_end),range_symbols in symbols_for_range.items():
+        fetch_start = datetime.strptime(range_start,DATE_FORMAT).strftime('%Y-%m-%d')
+        fetch_end = datetime.strptime(range_end,DATE_FORMAT).strftime('%Y-%m-%d')
+
+        for i in range(0, len(range_symbols), batch_size):
+            jobs.append((range_symbols[i:i + batch_size],fetch_start,fetch_end))
+
+    #the store is only touched from this thread, as results come in
+    for (batch,fetch_start,fetch_end),results in run_jobs_fn(jobs):
+        for symbol,symbol_df in results.items():
+            store.add_prices(symbol,interval,symbol_df)
+            store.add_fetched_range(symbol,interval,fetch_start,fetch_end)
+        #commit each batch, so a failure later on doesn't lose what was already fetched
+        store.commit()
+
+def download_stock_history(symbols, start_date, end_date, interval, store_file, batch_size, shared_store_file = None,
+                           fetch_fn = None, workers = DEFAULT_FETCH_WORKERS, requests_per_sec = DEFAULT_REQUESTS_PER_SEC,
+                           retries = DEFAULT_FETCH_RETRIES, backoff_secs = DEFAULT_BACKOFF_SECS):
     """
     Download stock history for multiple stocks using yahooquery with caching and batch processing.
 
+    Prices are kept in a sqlite price store, and only the date ranges of each symbol that aren't in the store
+    yet are fetched. Symbols missing the same range are fetched together. Batches are fetched concurrently,
+    see FetchScheduler.
+
+    If shared_store_file is given, store_file only holds the bars that were used, and is never changed once it
+    covers a range. Missing ranges are copied into it from the shared store, which is the one that downloads
+    from yahoo. This lets each snapshot keep a frozen copy of its prices, while sharing downloads between
+    snapshots.
+
     Parameters:
     - symbols (list): List of stock ticker symbols (e.g., ['VCIG', 'MULN']).
     - start_date (str): Start date in 'YYYY-MM-DD' format. 
-    - end_date (str): End date in 'YYYY-MM-DD' format.
+    - end_date (str): End date in 'YYYY-MM-DD' format, not included, like all ranges in the price store.
     - interval (str): Time interval '1m', '2m', '5m', '15m', '30m', '60m', '90m', '1h', '1d', '5d', '1wk', '1mo', '3mo'
-    - cache_file (str): Path to the JSON cache file.
+    - store_file (str): Path to the sqlite price store.
     - batch_size (int): Number of stocks to fetch per batch.
+    - shared_store_file (str): Path to the sqlite price store shared between snapshots, or None
+    - fetch_fn: fn(batch, start, end, interval) used to fetch a batch. Defaults to fetch_history_batch
+    - workers, requests_per_sec, retries, backoff_secs: see FetchScheduler
 
     Returns:
-    - dict: Dictionary mapping stock symbols to their historical data DataFrames.
+    - dict: Dictionary mapping stock symbols to their historical data DataFrames, or None if there is no data.
+      Symbols that couldn't be fetched are None as well
     """
-    # Load existing cache or initialize an empty one
-    if os.path.exists(cache_file):
-        try:
-            with open(cache_file, 'r') as f:
-                cache = json.load(f)
-        except Exception:
-            cache = {}
-    else:
-        cache = {}
+    store = open_price_store(store_file)
+    try:
+        if(shared_store_file is None):
+            fetch_fn = fetch_fn or fetch_history_batch
+            scheduler = FetchScheduler(lambda batch,s,e : fetch_fn(batch,s,e,interval),workers,requests_per_sec,retries,backoff_secs)
+            fill_missing_ranges(store,symbols,interval,start_date,end_date,scheduler.run,batch_size,True)
+        else:
+            def copy_from_shared_store(jobs):
+                for (batch,s,e) in jobs:
+                    results = download_stock_history(batch,s,e,interval,shared_store_file,batch_size,None,
+                                                     fetch_fn,workers,requests_per_sec,retries,backoff_secs)
 
-    # Dictionary to store results
-    results = {}
-    # List of symbols that need to be fetched
-    symbols_to_fetch = []
+                    #symbols the shared store failed to fetch aren't copied, so they are tried again next time
+                    shared_store = PriceStore(shared_store_file)
+                    try:
+                        results = { symbol : df for symbol,df in results.items() if not shared_store.get_missing_ranges(symbol,interval,s,e) }
+                    finally:
+                        shared_store.close()
 
-    # Check cache for each symbol
-    for symbol in symbols:
-        # Create a unique key for this query
-        key = f"{symbol}|{start_date}|{end_date}|{interval}"
-        if key in cache:
-            if(cache[key] == NO_RESULTS):
-                results[symbol] = None
-            else:
-                # Use cached data if available
-                results[symbol] = pd.read_json(StringIO(cache[key]))
-        else:
-            # Mark symbol for fetching
-            symbols_to_fetch.append(symbol)
-
-    # Process symbols that need fetching in batches
-    for i in range(0, len(symbols_to_fetch), batch_size):
-        batch = symbols_to_fetch[i:i + batch_size]
-        # Fetch data asynchronously for the batch
-        print(f"Fetching stocks for {batch}")
-        stocks = Ticker(batch, timeout=120, asynchronous=True)
-        print(f"Fetching stock histoy for {batch}")
-        df = stocks.history(start=start_date, end=end_date, interval=interval)
-        print(f"Done fetching stock histoy for {batch}")
-
-        for symbol in batch:
-            #if all the symbols failed to load, the df returned has no columns
-            if(df.empty):
-                cache_result = NO_RESULTS
-                results[symbol] = None
-            else:
-                try:
-                    symbol_rows = df.xs(symbol,level='symbol')
-                    cache_result = symbol_rows.to_json()
-                    results[symbol] = symbol_rows
-                except KeyError:
-                    cache_result = NO_RESULTS
-                    results[symbol] = None
-
-            key = f"{symbol}|{start_date}|{end_date}|{interval}"
-            cache[key] = cache_result
-
-    if(len(symbols_to_fetch) != 0):
-        # Save updated cache
-        with open(cache_file, 'w') as f:
-            json.dump(cache, f)
+                    yield (batch,s,e),results
+            fill_missing_ranges(store,symbols,interval,start_date,end_date,copy_from_shared_store,max(len(symbols),1),False)
 
-    return results
+        return store.load_prices(symbols,interval,start_date,end_date)
+    finally:
+        store.close()
+
+def get_unfetched_symbols(store_file, symbols, interval, start_date, end_date):
+    """Returns the symbols that still have date ranges that haven't been fetched, ex. because their download failed"""
+    store = open_price_store(store_file)
+    try:
+        return [symbol for symbol in symbols if store.get_missing_ranges(symbol,interval,start_date,end_date)]
+    finally:
+        store.close()
 
 # Example usage in a script with command-line argument for batch_size
 if __name__ == "__main__":
@@ -100,7 +386,7 @@ if __name__ == "__main__":
     start_date = '2023-01-01'
     end_date = '2023-12-31'
     interval = '1wk'
-    cache_file = 'stock_cache.json'
+    store_file = 'stock_prices.sqlite'
 
     # Call the function
     stock_data = download_stock_history(
@@ -108,7 +394,7 @@ if __name__ == "__main__":
         start_date=start_date,
         end_date=end_date,
         interval=interval,
-        cache_file=cache_file,
+        store_file=store_file,
         batch_size=args.batch_size
     )
 
@@ -1,5 +1,6 @@
 import argparse
 import csv
+import io
 from enum import Enum, auto
 from util import error,warn,csv_assert,csv_error,csv_warning,ErrorType
 import pandas as pd
@@ -11,108 +12,162 @@ NUMERIC_COLUMNS = {
    'Open Positions': {'Quantity','Mult', 'Cost Price', 'Cost Basis', 'Close Price', 'Value', 'Unrealized P/L'}
   }
 
-class Table():
-    def __init__(self,name,fields) -> None:
-        self.name = name
-        self.fields = fields
-        self.rows = []
+class IBRowType(Enum):
+    Header = auto()
+    Data = auto()
+    SubTotal = auto()
+    Total = auto()
+    Notes = auto()
+    MetaInfo = auto()
 
-    def create_dataframe(self):
-        def extend_or_truncate_list_to_length(lst_orig, length_wanted, fill_value=None):
-            lst = lst_orig.copy()
+class IBTableName(Enum):
+    Disclosure = auto()
 
-            l = len(lst)
-            if(l >= length_wanted):
-                return lst[0:length_wanted]
-            
-            lst += [fill_value] * (length_wanted - l)
+#row types that aren't read
+SKIPPED_ROW_TYPES = {IBRowType.SubTotal.name,IBRowType.Total.name,IBRowType.Notes.name,IBRowType.MetaInfo.name,''}
 
-            return lst
+#the tables parse_holding_activity uses
+HOLDING_ACTIVITY_TABLES = {'Statement','Open Positions','Financial Instrument Information'}
 
-        #convert the rows to columns        
-        flen = len(self.fields)
-        columns = [[] for x in range(0,flen)]
-        for r in self.rows:
-            r = extend_or_truncate_list_to_length(r,flen)
-            for col,cell in zip(columns,r):
-                col.append(cell)
+class Table():
+    """A table of the statement. The data rows are kept as the csv text they were read from, and only parsed when
+    the dataframe is created"""
+    def __init__(self,name,fields,row_index) -> None:
+        self.name = name
+        self.fields = fields
+        self.row_index = row_index
+        self.data_lines = []
+
+    def read_data_rows(self):
+        """Parses the data rows one at a time, for when they don't fit the fields"""
+        rows = []
+        for row in csv.reader(self.data_lines):
+            data = row[2:]
+            if(len(self.fields) < len(data) and any(data[len(self.fields):])):
+                csv_warning(row,self.row_index,None,"Number of fields is less than number of data values, ignoring extras")
+            rows.append((data + [''] * len(self.fields))[0:len(self.fields)])
+
+        res = pd.DataFrame(rows,columns=range(len(self.fields)),dtype=object)
+        for i in self.get_numeric_field_indexes():
+            res[i] = pd.to_numeric(res[i])
+        return res
 
-        d = dict(zip(self.fields,columns))
+    def get_numeric_field_indexes(self):
+        numeric_cols = NUMERIC_COLUMNS.get(self.name,set())
+        return [i for i,f in enumerate(self.fields) if f in numeric_cols]
 
-        res = pd.DataFrame(d)
+    def create_dataframe(self):
+        numeric_field_indexes = self.get_numeric_field_indexes()
+        num_cols = len(self.fields) + 2
+
+        #the first two columns are the table name and row type
+        dtypes = { i+2 : str for i in range(len(self.fields)) }
+        dtypes.update({ i+2 : float for i in numeric_field_indexes })
+        try:
+            data = pd.read_csv(io.StringIO(''.join(self.data_lines)), header=None, names=range(num_cols), usecols=range(2,num_cols),
+                               dtype=dtypes, keep_default_na=False, na_values={ i+2 : [''] for i in numeric_field_indexes })
+            data.columns = range(len(self.fields))
+        except pd.errors.ParserError:
+            data = self.read_data_rows()
+
+        #short rows are padded with blanks
+        str_cols = [i for i in data.columns if i not in numeric_field_indexes]
+        data[str_cols] = data[str_cols].fillna('')
+
+        #if a field name is repeated, the last column is used
+        res = pd.DataFrame(dict(zip(self.fields,(data[i] for i in range(len(self.fields))))))
 
         res['D:TableType'] = self.name
 
         return res
 
 
-def generic_parse(file):
-    class IBRowType(Enum):
-        Header = auto()
-        Data = auto()
-        SubTotal = auto()
-        Total = auto()
-        Notes = auto()
-        MetaInfo = auto()
-
-    class IBTableName(Enum):
-        Disclosure = auto()
-
+def iter_records(f):
+    """Yields (row_index, record) for each csv record of the file, where record is the text of the record, which may
+    span more than one line if a quoted cell has a newline in it"""
+    record = []
+    num_quotes = 0
+    row_index = 0
+    for line in f:
+        line_quotes = line.count('"')
+        #most records are a single line
+        if(not record and line_quotes % 2 == 0):
+            yield row_index,line
+            row_index += 1
+            continue
+
+        record.append(line)
+        num_quotes += line_quotes
+        if(num_quotes % 2 == 0):
+            yield row_index,''.join(record)
+            row_index += 1
+            record = []
+            num_quotes = 0
+
+    if(record):
+        yield row_index,''.join(record)
+
+def split_record_start(record):
+    """Returns the table name and row type of a record"""
+    if(not record.startswith('"')):
+        parts = record.split(',',2)
+        if(len(parts) >= 2 and '"' not in parts[1]):
+            return parts[0],parts[1].rstrip('\r\n')
+
+    row = next(csv.reader([record]),[])
+    return (row + ['',''])[0],(row + ['',''])[1]
+
+def generic_parse(file, table_names = None):
+    """Splits the statement into its tables in one pass.
+
+    Args:
+        table_names: names of the tables to read, or None for all of them. The data rows of other tables are skipped
+            without being parsed
+
+    Returns:
+        dict of table name to list of Table, one for each time the table appears in the statement
+    """
     tables = {}
+    table = None
+    #start of the data rows of the last table seen, and whether they are read. Data rows usually follow their header,
+    #so most rows are handled by just checking this
+    data_prefix = None
+    read_data = False
 
     with open(file, newline='', encoding='utf-8-sig') as csvfile:
-        reader = csv.reader(csvfile)
-
-        def remove_blank_trailing_cells(row : list):
-            while(row[-1] == ''):
-                row.pop()
-
-        for (row_index,row) in enumerate(reader):
-            remove_blank_trailing_cells(row)
-            table_name = row[0]
-            row_type = row[1]
-            
-            if(table_name == IBTableName.Disclosure.name):
-                pass
+        for (row_index,record) in iter_records(csvfile):
+            if(data_prefix is not None and record.startswith(data_prefix)):
+                if(read_data):
+                    table.data_lines.append(record)
+                continue
+
+            if(not record.strip()):
+                continue
+
+            table_name,row_type = split_record_start(record)
+            data_prefix = None
+
+            if(table_name == IBTableName.Disclosure.name or (table_names is not None and table_name not in table_names)):
+                if('"' not in table_name):
+                    data_prefix,read_data = f"{table_name},",False
             elif(row_type == IBRowType.Header.name):
-                fields = row[2:]
-                t = Table(table_name,fields)
+                row = next(csv.reader([record]))
+                while(row[-1] == ''):
+                    row.pop()
+                table = Table(table_name,row[2:],row_index)
 
-                if(table_name in tables):
-                    #co: this is a common occurrence, no need to worry.
-                    #csv_warning(row,row_index,0,"Table specified twice, both will be parsed")
-                    pass
-                else:
-                    tables[table_name] = []
+                #co: a table specified twice is a common occurrence, no need to worry, both will be parsed
+                tables.setdefault(table_name,[]).append(table)
 
-                tables[table_name].append(t)
+                data_prefix,read_data = f"{table_name},{IBRowType.Data.name},",True
             elif(row_type == IBRowType.Data.name):
-                data = row[2:]
-                table = tables[table_name][-1]
-                if(len(fields) < len(data)):
-                    csv_warning(row,row_index,None,"Number of fields is less than number of data values, ignoring extras")
-
-                while(len(data) < len(fields)):
-                    data.append('')
-
-                if(table_name in NUMERIC_COLUMNS):
-                    numeric_cols = NUMERIC_COLUMNS[table_name]
-                    for i in range(0,len(fields)):
-                        if(fields[i] in numeric_cols):
-                            data[i] = float(data[i])
-                table.rows.append(data)
-            elif(row_type == IBRowType.SubTotal.name):
-                pass
-            elif(row_type == IBRowType.Total.name):
-                pass
-            elif(row_type == IBRowType.Notes.name):
-                pass
-            elif(row_type == IBRowType.MetaInfo.name):
-                pass
-            elif(row_type == ''):
+                if(table is None or table.name != table_name):
+                    table = tables[table_name][-1]
+                table.data_lines.append(record)
+            elif(row_type in SKIPPED_ROW_TYPES):
                 pass
             else:
-                csv_error(row,row_index,0,"Unrecognized row type")                
+                csv_error(next(csv.reader([record])),row_index,0,"Unrecognized row type")
 
     return tables
 
@@ -141,7 +196,7 @@ def parse_holding_activity(file):
     #     df['Symbol'] = df[column_name].str.extract(r'^([^\(]+)\(')
     #     df['ISIN'] = df[column_name].str.extract(r'\(([^\)]+)\)')
 
-    tables = generic_parse(file)
+    tables = generic_parse(file,HOLDING_ACTIVITY_TABLES)
 
     op = create_dataframe_from_tables(tables,'Open Positions')
     fii = create_dataframe_from_tables(tables,'Financial Instrument Information')
@@ -152,9 +207,9 @@ def parse_holding_activity(file):
     holdings_res = pd.merge(op, fii, on=['Asset Category','Symbol'], how='inner',validate='1:1')
     holdings_res[ftypes.SpecialColumns.DBrokerage.get_col_name()] = ftypes.BrokerageTypes.InteractiveBrokers.name
 
-    file_attrs = tables['Statement'][0].rows
+    file_attrs = tables['Statement'][0].create_dataframe()
 
-    for name,val in file_attrs:
+    for name,val in zip(file_attrs.iloc[:,0],file_attrs.iloc[:,1]):
         holdings_res[name] = val
 
     return holdings_res
@@ -1,20 +1,31 @@
+from copy import copy
 from dataclasses import dataclass
+import datetime
 from enum import Enum, auto
 from functools import partial
+import math
 import re
 from typing import Any, Callable
 import pandas as pd
 import ftypes
-from openpyxl.styles import Font
+import openpyxl as op
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
+from openpyxl.utils import get_column_letter
 import array_log as al
+import snapshot_store
 import util
 from typing import Sequence
 
-HOLDINGS_WS_TITLE = 'Holdings Input Data'
+HOLDINGS_WS_TITLE = ftypes.HOLDINGS_WS_TITLE
 PICK_WS_TITLE = 'Pick Input Data'
+EVENTS_WS_TITLE = 'Events Input Data'
 JOINED_DATA_WS_TITLE = 'Joined Data'
 NA_STR_NAME = '(none)'
 
+#stage of the snapshot store recording the last workbook written, see make_report_workbook
+REPORT_WORKBOOK_STAGE = 'report-workbook'
+
 header_font = Font(bold=True, italic=True)
 normal_line_font = Font()
 total_line_font = Font(bold=True)
@@ -30,7 +41,7 @@ def style_simple_report_ws(ws, num_lines):
             cell.font = normal_line_font
 
 
-def style_report_ws(ws, num_lines):
+def style_report_ws(ws, num_lines, is_total_row = True):
     #Make header stylish
     for cell in ws[1]:
         cell.font = header_font
@@ -42,7 +53,7 @@ def style_report_ws(ws, num_lines):
 
     #Make last line (the total) stylish
     for cell in ws[num_lines+1]:
-        cell.font = total_line_font
+        cell.font = total_line_font if is_total_row else normal_line_font
 
 
 
@@ -94,6 +105,163 @@ def update_number_formats(excel_formats,ws,num_rows,native_currency_code):
         ws.column_dimensions[col[0].column_letter].width = adjusted_width      
 
 
+#the style pandas gives to header cells, with our header font applied over it
+header_border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+header_alignment = Alignment(horizontal='center', vertical='top')
+
+#formats pandas uses for dates when writing to excel
+PANDAS_DATE_FORMAT = 'YYYY-MM-DD'
+PANDAS_DATETIME_FORMAT = 'YYYY-MM-DD HH:MM:SS'
+
+def calc_column_width(excel_format, header, values):
+    """Calculates the width of a column the same way update_number_formats does"""
+    max_len = len(header)
+    for v in values:
+        max_len = max(calc_max_len(excel_format, v),max_len)
+
+    return (max_len + 2) * 1.2
+
+def to_excel_value(val):
+    """Converts a value in a dataframe to what pandas would write to an excel cell.
+
+    Returns:
+        (value,number format or None)
+    """
+    if(val is None or (isinstance(val,float) and math.isnan(val))):
+        return '',None
+    if(isinstance(val,bool)):
+        return val,None
+    if(isinstance(val,int)):
+        return val,None
+    if(isinstance(val,float)):
+        if(math.isinf(val)):
+            return ('inf' if val > 0 else '-inf'),None
+        return val,None
+    if(isinstance(val,str)):
+        return val,None
+
+    #numpy and pandas types, which are rare in object columns
+    if(pd.api.types.is_scalar(val) and pd.isna(val)):
+        return '',None
+    if(pd.api.types.is_integer(val)):
+        return int(val),None
+    if(pd.api.types.is_float(val)):
+        return to_excel_value(float(val))
+    if(pd.api.types.is_bool(val)):
+        return bool(val),None
+    if(getattr(val, "tzinfo", None) is not None):
+        util.error("Excel does not support datetimes with timezones")
+    if(isinstance(val,datetime.datetime)):
+        return val,PANDAS_DATETIME_FORMAT
+    if(isinstance(val,datetime.date)):
+        return val,PANDAS_DATE_FORMAT
+    if(isinstance(val,datetime.timedelta)):
+        return val.total_seconds() / 86400,'0'
+
+    return str(val),None
+
+def get_excel_columns(df : pd.DataFrame):
+    """Returns the converted values and number formats of each column of df, as lists"""
+    res = []
+    for ci in range(df.shape[1]):
+        converted = [to_excel_value(v) for v in df.iloc[:,ci].tolist()]
+        res.append(([v for v,_ in converted],[f for _,f in converted]))
+
+    return res
+
+
+class OpenpyxlReportWriter:
+    """Writes the report workbook through pd.ExcelWriter, then styles it cell by cell"""
+
+    def __init__(self, output_file):
+        self.writer = pd.ExcelWriter(output_file, engine='openpyxl')
+
+    def write_report_sheet(self, title, res_df, excel_formats, native_currency_code, is_total_row = True):
+        res_df.to_excel(self.writer, index=False, sheet_name=title)
+        ws = self.writer.sheets[title]
+        style_report_ws(ws,res_df.shape[0],is_total_row)
+
+        update_number_formats(excel_formats,ws,res_df.shape[0],native_currency_code)
+
+    def write_simple_sheet(self, title, res_df):
+        res_df.to_excel(self.writer, index=False, sheet_name=title)
+        ws = self.writer.sheets[title]
+        style_simple_report_ws(ws,res_df.shape[0])
+
+    def close(self):
+        self.writer.close()
+
+
+class WriteOnlyReportWriter:
+    """Writes the report workbook with a write only openpyxl workbook, which streams rows to the file.
+    Styles are set up once per column and copied to each cell, rather than being applied to an in-memory
+    sheet afterwards. The result looks the same as OpenpyxlReportWriter's.
+    """
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.wb = op.Workbook(write_only=True)
+
+    def make_style_cell(self, ws, font, number_format = None):
+        cell = WriteOnlyCell(ws)
+        cell.font = font
+        if(number_format is not None):
+            cell.number_format = number_format
+        return cell
+
+    def write_sheet(self, title, res_df, excel_formats, is_total_row):
+        ws = self.wb.create_sheet(title)
+        num_rows = res_df.shape[0]
+        columns = get_excel_columns(res_df)
+
+        if(excel_formats is not None):
+            for ci,(excel_format,header,(values,_)) in enumerate(zip(excel_formats,res_df.columns,columns)):
+                ws.column_dimensions[get_column_letter(ci+1)].width = calc_column_width(excel_format,str(header),values)
+
+        header_row = []
+        for header in res_df.columns:
+            cell = WriteOnlyCell(ws, to_excel_value(header)[0])
+            cell.font = header_font
+            cell.border = header_border
+            cell.alignment = header_alignment
+            header_row.append(cell)
+        ws.append(header_row)
+
+        #style templates, keyed by (font, number format)
+        style_cells = {}
+        def get_style(font, number_format):
+            key = (id(font),number_format)
+            if(key not in style_cells):
+                style_cells[key] = self.make_style_cell(ws,font,number_format)
+            return style_cells[key]._style
+
+        for ri in range(num_rows):
+            font = total_line_font if (is_total_row and ri == num_rows - 1) else normal_line_font
+            row = []
+            for ci,(values,formats) in enumerate(columns):
+                number_format = excel_formats[ci] if excel_formats is not None else formats[ri]
+                cell = WriteOnlyCell(ws, values[ri])
+                cell._style = copy(get_style(font,number_format))
+                row.append(cell)
+            ws.append(row)
+
+    def write_report_sheet(self, title, res_df, excel_formats, native_currency_code, is_total_row = True):
+        self.write_sheet(title, res_df, excel_formats, is_total_row)
+
+    def write_simple_sheet(self, title, res_df):
+        self.write_sheet(title, res_df, None, False)
+
+    def close(self):
+        self.wb.save(self.output_file)
+
+
+REPORT_WRITERS = {
+    'write-only' : WriteOnlyReportWriter,
+    'openpyxl' : OpenpyxlReportWriter,
+}
+assert list(REPORT_WRITERS.keys()) == ftypes.REPORT_WRITER_NAMES
+
+
 def calc_performance_gains_for_cat(config, cat_column, res_df, joined_df):
     for period in config.hist_perf_periods:
         # ---- column names -----------------------------------------------------------
@@ -134,6 +302,23 @@ def calc_performance_gains_for_cat(config, cat_column, res_df, joined_df):
             lambda c: "*" if cat_any_missing.get(c, False) else ""
         )
 
+def add_returns(config, res_df, group_column, returns_df):
+    """Adds the R:TWR, R:MWR and R:ReturnNotAllPresent columns of each period to res_df, from the returns of the groups
+    of group_column in returns_df (see themetrack.calc_returns_df). They're empty for groups without returns, such as
+    when there are no brokerage events.
+    """
+    group_returns = pd.DataFrame()
+    if(returns_df is not None and not returns_df.empty):
+        group_returns = returns_df[returns_df['group_column'] == group_column].set_index('group')
+
+    for period in config.hist_perf_periods:
+        for col in [f"{ftypes.TWR_PREFIX}{period}",f"{ftypes.MWR_PREFIX}{period}"]:
+            res_df[col] = res_df[group_column].map(group_returns[col]).astype(float) if col in group_returns.columns else math.nan
+
+        flag_col = f"{ftypes.RETURN_NOT_ALL_DATA_PRESENT_PREFIX}{period}"
+        flagged = set(group_returns.index[group_returns[flag_col].astype(bool)]) if flag_col in group_returns.columns else set()
+        res_df[flag_col] = res_df[group_column].map(lambda g: "*" if g in flagged else "")
+
 def calc_performance_gains_for_stocks(config, res_df):
     for period in config.hist_perf_periods:
         # ---- column names -----------------------------------------------------------
@@ -148,7 +333,22 @@ def calc_performance_gains_for_stocks(config, res_df):
 def make_portfolio_report(config : ftypes.Config, report_config : ftypes.ReportConfig, joined_df : pd.DataFrame, holdings_df : pd.DataFrame, 
                            picks_df : pd.DataFrame, native_currency_code : str
                           ):
+    return make_report_sheet_fn(report_config,calc_portfolio_report(config,report_config,joined_df),native_currency_code)
+
+def make_report_sheet_fn(report_config : ftypes.ReportConfig, res_df : pd.DataFrame, native_currency_code : str):
+    def final_step_fn(writer):
+        excel_formats = [r[2] for r in report_config.columns]
+        writer.write_report_sheet(report_config.name, res_df, excel_formats, native_currency_code)
 
+    return final_step_fn
+
+def calc_portfolio_report(config : ftypes.Config, report_config : ftypes.ReportConfig, joined_df : pd.DataFrame,
+                          returns_df : pd.DataFrame = None):
+    """Returns the rows of a report sheet, with the display names as columns and a total row at the end.
+    Only depends on joined_df, returns_df, report_config and config.hist_perf_periods
+
+    The returns are those of each category for category reports, and of each symbol for securities reports.
+    """
     total_sum = joined_df[ftypes.SpecialColumns.RCurrValue.get_col_name()].sum()
 
     def get_total_perc(row):
@@ -165,6 +365,7 @@ def make_portfolio_report(config : ftypes.Config, report_config : ftypes.ReportC
         res_df.reset_index(names=[report_config.cat_column],inplace=True)
         res_df[ftypes.SpecialColumns.RTotalPerc.get_col_name()] = category_df.apply(get_total_perc,axis=1)
         calc_performance_gains_for_cat(config, report_config.cat_column, res_df, joined_df)
+        add_returns(config, res_df, report_config.cat_column, returns_df)
     else:
         category_df[ftypes.SpecialColumns.RCatTotalPerc.get_col_name()] = category_df.apply(get_total_perc,axis=1)
         res_df = joined_df.copy()
@@ -196,6 +397,7 @@ def make_portfolio_report(config : ftypes.Config, report_config : ftypes.ReportC
         res_df = res_df[res_df.apply(row_filter_fn(report_config.always_show_pick_bitmask),axis=1)]
 
         calc_performance_gains_for_stocks(config, res_df)
+        add_returns(config, res_df, ftypes.SpecialColumns.CYahooTicker.get_col_name(), returns_df)
 
         # TODO 2.5 reenable this, using a different column per report or something...
         # def get_cat_total_perc_for_df(row):
@@ -219,43 +421,132 @@ def make_portfolio_report(config : ftypes.Config, report_config : ftypes.ReportC
 
     res_df.rename(columns={ name : display_as for name,display_as,excel_format in report_config.columns}, inplace=True)
 
-    def final_step_fn(writer):
-        res_df.to_excel(writer, index=False, sheet_name=report_config.name)
-        ws = writer.sheets[report_config.name]
-        style_report_ws(ws,res_df.shape[0])
+    return res_df
 
-        excel_formats = [r[2] for r in report_config.columns]
-        update_number_formats(excel_formats,ws,res_df.shape[0],native_currency_code)
 
-    return final_step_fn
+def calc_allocation_history(snapshot_dfs, cat_column):
+    """Calculates how the value of a series of snapshots is allocated between the categories of cat_column.
+
+    Args:
+        snapshot_dfs: list of (snapshot date, joined df), oldest first
+
+    Returns:
+        (series of the total value, frame of the fraction of the total in each category), both indexed by snapshot date
+    """
+    value_col = ftypes.SpecialColumns.RCurrValue.get_col_name()
+
+    cat_values = {}
+    for date,joined_df in snapshot_dfs:
+        cats = joined_df[cat_column].fillna(NA_STR_NAME) if cat_column in joined_df.columns else pd.Series(NA_STR_NAME,index=joined_df.index)
+        cat_values[date] = joined_df[value_col].groupby(cats).sum()
 
+    value_df = pd.DataFrame(cat_values).T.fillna(0.0)
+    totals = value_df.sum(axis=1)
+    alloc_df = value_df.div(totals.replace(0,pd.NA),axis=0).astype(float).fillna(0.0)
+
+    #largest categories in the latest snapshot first
+    alloc_df = alloc_df[alloc_df.iloc[-1].sort_values(ascending=False,kind='stable').index]
+
+    return totals,alloc_df
+
+def make_history_workbook(snapshot_dfs, config : ftypes.Config, output_file : str, report_writer : str = 'write-only'):
+    """Writes the allocation of each snapshot between the categories of the category reports in config, and how much
+    it drifted from one snapshot to the next.
+
+    Args:
+        snapshot_dfs: list of (snapshot date, joined df), oldest first
+    """
+    if(report_writer not in REPORT_WRITERS):
+        util.error(f"Unknown report writer '{report_writer}', must be one of {', '.join(REPORT_WRITERS.keys())}")
+
+    #reports of the same category would only repeat each other
+    cat_report_configs = {}
+    for report_config in config.reports:
+        if(report_config.is_cat_type):
+            cat_report_configs.setdefault(report_config.cat_column,report_config)
+    if(not cat_report_configs):
+        util.error("There are no category reports in the config to create the history from")
+
+    currency_format = config.currency_formats.get(config.currency,'#,##0.00')
+
+    writer = REPORT_WRITERS[report_writer](output_file)
+    for report_config in cat_report_configs.values():
+        totals,alloc_df = calc_allocation_history(snapshot_dfs,report_config.cat_column)
+        cat_names = [str(c) for c in alloc_df.columns]
+
+        res_df = pd.DataFrame({ 'Date' : alloc_df.index, f'Total {config.currency}' : totals.values })
+        res_df[cat_names] = alloc_df.values
+        #one row per snapshot, there's no total line
+        writer.write_report_sheet(f"{report_config.name} Allocation"[:31], res_df, ['@',currency_format] + ['0.00%'] * len(cat_names),
+                                  config.currency, is_total_row=False)
+
+        #change since the previous snapshot, and over all of them
+        drift_df = alloc_df.diff().iloc[1:]
+        drift_df.loc['Overall'] = alloc_df.iloc[-1] - alloc_df.iloc[0]
+        res_df = pd.DataFrame({ 'Date' : drift_df.index })
+        res_df[cat_names] = drift_df.values
+        writer.write_report_sheet(f"{report_config.name} Drift"[:31], res_df, ['@'] + ['0.00%'] * len(cat_names), config.currency,
+                                  is_total_row=False)
+
+    writer.close()
 
 def make_report_workbook(orig_joined_df : pd.DataFrame, holdings_df : pd.DataFrame, picks_df : pd.DataFrame, native_currency_code : str, 
-                         rules_log : al.Log, config : ftypes.Config,output_file : str) -> pd.DataFrame:
-    
+                         rules_log : al.Log, config : ftypes.Config,output_file : str, report_writer : str = 'write-only',
+                         events_df : pd.DataFrame = None, store : snapshot_store.SnapshotStore = None,
+                         returns_df : pd.DataFrame = None) -> pd.DataFrame:
+    """Writes the report sheets, followed by the input data, to output_file. events_df is the brokerage events
+    keyed to their holdings and categories, see themetrack.get_return_events_df, and returns_df their returns, see
+    themetrack.calc_returns_df.
+
+    If a store is given, each report sheet's rows are kept in it, keyed on the contents of the joined data and the
+    report's config, so only the reports whose inputs changed are recalculated. If nothing changed at all and
+    output_file is still the one written last time, it isn't written again.
+    """
+    use_store = store is not None and store.enabled
+    if(use_store):
+        workbook_key = snapshot_store.make_key(output_file,report_writer,snapshot_store.object_key(config),native_currency_code,
+                                               *[snapshot_store.frame_key(df) for df in [orig_joined_df,holdings_df,picks_df,events_df,returns_df]])
+        found,written_df = store.load(REPORT_WORKBOOK_STAGE,workbook_key)
+        if(found and written_df is not None and written_df.at[0,'sha256'] == snapshot_store.file_key(output_file)):
+            return
+
     #PERF, this table is pretty large, but we don't want to go mucking with it here and then use it for something else later
     joined_df = orig_joined_df.copy()
 
     joined_df[ftypes.SpecialColumns.RTheme.get_col_name()] = joined_df[ftypes.SpecialColumns.RTheme.get_col_name()].fillna(NA_STR_NAME)
     joined_df[ftypes.SpecialColumns.RSector.get_col_name()] = joined_df[ftypes.SpecialColumns.RSector.get_col_name()].fillna(NA_STR_NAME)
 
-    #make_portfolio_report returns a function here because debugging while within a "with pd.ExcelWriter..." is a pain,
+    def get_report_df(ri, report_config):
+        if(not use_store):
+            return calc_portfolio_report(config,report_config,joined_df,returns_df)
+        key = snapshot_store.make_key(joined_key,snapshot_store.frame_key(returns_df),snapshot_store.object_key(report_config),
+                                      config.hist_perf_periods)
+        return store.get_or_build(f"report-{ri}",key,lambda : calc_portfolio_report(config,report_config,joined_df,returns_df))
+
+    joined_key = snapshot_store.frame_key(joined_df) if use_store else None
+
+    #the sheets are written by functions here because debugging while within a "with pd.ExcelWriter..." is a pain,
     #so we minimize the amount of code inside it
-    report_writer_fn_list = [make_portfolio_report(config, report_config, joined_df,holdings_df,picks_df,native_currency_code) for report_config in config.reports]
+    report_writer_fn_list = [make_report_sheet_fn(report_config,get_report_df(ri,report_config),native_currency_code)
+                             for ri,report_config in enumerate(config.reports)]
     
+    if(report_writer not in REPORT_WRITERS):
+        util.error(f"Unknown report writer '{report_writer}', must be one of {', '.join(REPORT_WRITERS.keys())}")
+
     # Export to Excel
-    with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
-        for rw_fn in report_writer_fn_list:
-            rw_fn(writer)
-
-        def add_df(res_df, title, writer):
-            res_df.to_excel(writer, index=False, sheet_name=title)
-            ws = writer.sheets[title]
-            style_simple_report_ws(ws,res_df.shape[0])
-
-        add_df(holdings_df, HOLDINGS_WS_TITLE, writer)
-        add_df(picks_df, PICK_WS_TITLE, writer)
-        add_df(orig_joined_df, JOINED_DATA_WS_TITLE, writer)
+    writer = REPORT_WRITERS[report_writer](output_file)
+    for rw_fn in report_writer_fn_list:
+        rw_fn(writer)
+
+    writer.write_simple_sheet(HOLDINGS_WS_TITLE, holdings_df)
+    writer.write_simple_sheet(PICK_WS_TITLE, picks_df)
+    if(events_df is not None and not events_df.empty):
+        writer.write_simple_sheet(EVENTS_WS_TITLE, events_df)
+    writer.write_simple_sheet(JOINED_DATA_WS_TITLE, orig_joined_df)
+    writer.close()
+
+    if(use_store):
+        store.save(REPORT_WORKBOOK_STAGE,workbook_key,pd.DataFrame({'sha256' : [snapshot_store.file_key(output_file)]}))
         
 
 
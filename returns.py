@@ -0,0 +1,285 @@
+"""Calculates time weighted (TWR) and money weighted (MWR) returns of positions, and of groups of positions such as
+themes, from brokerage events (buys, sells, dividends and fees) and stock price history.
+
+Positions are valued at every price bar, at the start of each period and at the end date. An event is counted at the
+first valuation date on or after it happened. Money taken out of a position (sale proceeds and dividends) is added to
+the value at that date, and money put in (purchases and fees) to the value at the date before, so the growth of each
+step is:
+
+    (value + money taken out) / (previous value + money put in)
+
+This is the "my way" calculation of twr_example_calc.ods. TWR is the product of the steps over the period. MWR is the
+rate that makes the value at the start of the period, the money put in and taken out, and the value at the end add up
+to zero. Both are for the whole period rather than annualized, like the R:GainLoss columns.
+"""
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+import ftypes
+import stock_perf_data
+
+#columns of an events frame
+EVENT_DATE_COL = 'date'
+EVENT_SYMBOL_COL = 'symbol'
+#name of a ftypes.EventTypes
+EVENT_TYPE_COL = 'type'
+#number of shares bought or sold, always positive
+EVENT_QUANTITY_COL = 'quantity'
+#cash paid into the account, negative for buys and fees, positive for sells and dividends
+EVENT_AMOUNT_COL = 'amount'
+
+EVENT_COLUMNS = [EVENT_DATE_COL,EVENT_SYMBOL_COL,EVENT_TYPE_COL,EVENT_QUANTITY_COL,EVENT_AMOUNT_COL]
+
+#part of the key of the stored return events and returns, bump this when they change
+RETURNS_VERSION = 1
+
+#share quantities smaller than this are treated as nothing held, to ignore rounding left over after selling everything
+MIN_QUANTITY = 1e-9
+
+#bounds of log(1+mwr) searched for the mwr
+MWR_MIN_LOG_GROWTH = -30.
+MWR_MAX_LOG_GROWTH = 30.
+MWR_ITERATIONS = 100
+
+@dataclass
+class PositionValues:
+    names : pd.Index # symbols, or groups of symbols
+    dates : pd.DatetimeIndex # valuation dates
+    value : np.ndarray # names x dates, value held at each date, nan if shares are held without a price
+    flow_in : np.ndarray # names x dates, money put in since the previous date
+    flow_out : np.ndarray # names x dates, money taken out since the previous date
+
+def get_period_start_dates(end_date, periods):
+    return { period : pd.Timestamp(stock_perf_data.calculate_start_date(period,end_date)) for period in periods }
+
+def get_close_prices(ts, dates):
+    """Returns the close price of a history frame as of each of dates, nan before the first bar"""
+    #the dividends are counted as events, so the close isn't adjusted for them
+    col = 'close' if 'close' in ts.columns else 'adjclose'
+    ts = ts[ts[col].notna()]
+
+    bar_dates = np.asarray(stock_perf_data.to_datetime_index(ts.index),dtype='datetime64[ns]')
+    idx = np.searchsorted(bar_dates,np.asarray(dates,dtype='datetime64[ns]'),side='right') - 1
+
+    return np.where(idx >= 0, ts[col].to_numpy(dtype=float)[np.maximum(idx,0)], np.nan)
+
+def get_split_adjusted_quantities(events_df, stock_hist):
+    """Yahoo's close prices are adjusted for later splits, so shares traded before a split are scaled by it here"""
+    qty = events_df[EVENT_QUANTITY_COL].to_numpy(dtype=float).copy()
+
+    for symbol,ts in stock_hist.items():
+        if(ts is None or 'splits' not in ts.columns):
+            continue
+        splits = ts['splits'][ts['splits'].fillna(0) > 0]
+        if(splits.empty):
+            continue
+
+        symbol_mask = (events_df[EVENT_SYMBOL_COL] == symbol).to_numpy()
+        for split_date,ratio in splits.items():
+            qty[symbol_mask & (events_df[EVENT_DATE_COL] < split_date).to_numpy()] *= ratio
+
+    return qty
+
+def get_position_values(events_df, stock_hist, end_date, periods, end_quantities = None):
+    """
+    Values each position at every valuation date up to end_date.
+
+    Parameters:
+    - events_df: frame with EVENT_COLUMNS
+    - stock_hist: dict of symbol to price history frame, as returned by history_stock_downloader.download_stock_history
+    - periods: performance periods, ex. ['3m','1y'], whose start dates are included in the valuation dates
+    - end_quantities: optional series of symbol to the number of shares held at end_date, such as the holdings of
+      the snapshot. Shares held before the first event are then added so each position ends up with this quantity,
+      which covers holdings bought before the events export starts.
+
+    Returns:
+    - PositionValues, by symbol
+    """
+    end_date = pd.Timestamp(end_date)
+    start_dates = get_period_start_dates(end_date,periods).values()
+
+    events_df = events_df[events_df[EVENT_DATE_COL] <= end_date]
+    event_symbols = events_df[EVENT_SYMBOL_COL]
+    names = pd.Index(pd.concat([event_symbols,pd.Series(end_quantities.index if end_quantities is not None else [],dtype=object)])
+                     .dropna().unique())
+
+    min_start_date = min(start_dates,default=end_date)
+    bar_dates = [ts.index for s,ts in stock_hist.items() if s in names and ts is not None]
+    dates = pd.DatetimeIndex(np.concatenate([np.asarray(stock_perf_data.to_datetime_index(d),dtype='datetime64[ns]') for d in bar_dates] +
+                                            [np.array(list(start_dates) + [end_date],dtype='datetime64[ns]')]))
+    dates = dates[(dates >= min_start_date) & (dates <= end_date)].unique().sort_values()
+
+    close = np.full((len(names),len(dates)),np.nan)
+    for i,symbol in enumerate(names):
+        ts = stock_hist.get(symbol)
+        if(ts is not None and not ts.empty):
+            close[i] = get_close_prices(ts,dates)
+
+    #events are counted at the first valuation date on or after them, earlier ones at the first date
+    rows = names.get_indexer(event_symbols)
+    cols = dates.searchsorted(events_df[EVENT_DATE_COL].to_numpy(dtype='datetime64[ns]'),side='left')
+    valid = rows >= 0
+    rows,cols = rows[valid],cols[valid]
+
+    event_types = events_df[EVENT_TYPE_COL].to_numpy()[valid]
+    qty = get_split_adjusted_quantities(events_df,stock_hist)[valid]
+    qty = np.select([event_types == ftypes.EventTypes.Buy.name, event_types == ftypes.EventTypes.Sell.name],[qty,-qty],0.)
+    amount = events_df[EVENT_AMOUNT_COL].to_numpy(dtype=float)[valid]
+    amount = np.nan_to_num(amount)
+
+    qty_change = np.zeros(close.shape)
+    flow_in = np.zeros(close.shape)
+    flow_out = np.zeros(close.shape)
+    np.add.at(qty_change,(rows,cols),np.nan_to_num(qty))
+    np.add.at(flow_in,(rows,cols),np.maximum(-amount,0.))
+    np.add.at(flow_out,(rows,cols),np.maximum(amount,0.))
+
+    if(end_quantities is not None and len(dates)):
+        end_qty = end_quantities.groupby(level=0).sum().reindex(names)
+        has_end_qty = end_qty.notna().to_numpy()
+        qty_change[has_end_qty,0] += end_qty.to_numpy(dtype=float)[has_end_qty] - qty_change[has_end_qty].sum(axis=1)
+
+    held = qty_change.cumsum(axis=1)
+    held[np.abs(held) < MIN_QUANTITY] = 0.
+
+    #nothing held is worth nothing, even without a price
+    value = np.where(held == 0., 0., held * close)
+
+    return PositionValues(names,dates,value,flow_in,flow_out)
+
+def group_position_values(pv : PositionValues, symbol_groups):
+    """Combines positions into groups, ex. themes. symbol_groups is a series of symbol to group. Positions without a
+    group are left out"""
+    codes,groups = pd.factorize(symbol_groups.reindex(pv.names))
+    valid = codes >= 0
+
+    def sum_by_group(a):
+        res = np.zeros((len(groups),a.shape[1]))
+        np.add.at(res,codes[valid],a[valid])
+        return res
+
+    return PositionValues(pd.Index(groups),pv.dates,sum_by_group(pv.value),sum_by_group(pv.flow_in),sum_by_group(pv.flow_out))
+
+def calc_mwr(cash_flows, times):
+    """
+    Solves sum(cash_flows * (1+mwr)^-times) = 0 for each row of cash_flows, by bisection over all rows at once.
+
+    Parameters:
+    - cash_flows: rows x times, money received by the investor, negative when paid
+    - times: fraction of the period at which each cash flow happens, from 0 to 1
+
+    Returns:
+    - mwr of each row, nan if there isn't one
+    """
+    def npv(log_growth):
+        return (cash_flows * np.exp(-log_growth[:,None] * times[None,:])).sum(axis=1)
+
+    lo = np.full(len(cash_flows),MWR_MIN_LOG_GROWTH)
+    hi = np.full(len(cash_flows),MWR_MAX_LOG_GROWTH)
+    npv_lo = npv(lo)
+    has_root = (np.sign(npv_lo) != np.sign(npv(hi))) & (np.abs(cash_flows).sum(axis=1) > 0)
+
+    for _ in range(MWR_ITERATIONS):
+        mid = (lo + hi) / 2
+        npv_mid = npv(mid)
+        same_sign = np.sign(npv_mid) == np.sign(npv_lo)
+        lo = np.where(same_sign,mid,lo)
+        npv_lo = np.where(same_sign,npv_mid,npv_lo)
+        hi = np.where(same_sign,hi,mid)
+
+    return np.where(has_root,np.expm1((lo + hi) / 2),np.nan)
+
+def calc_period_returns(pv : PositionValues, end_date, periods):
+    """
+    Returns a frame indexed by pv.names, with the following columns for each period:
+      - R:TWR<Period> time weighted return, nan if nothing was held during the period
+      - R:MWR<Period> money weighted return, nan if nothing was held, a value is missing or there is no solution
+      - R:ReturnNotAllPresent<Period> true if shares were held without a price at some point during the period,
+          in which case the steps without a value are left out of the returns
+    """
+    end_date = pd.Timestamp(end_date)
+
+    #growth of each step, from the previous valuation date
+    before = pv.value[:,:-1] + pv.flow_in[:,1:]
+    after = pv.value[:,1:] + pv.flow_out[:,1:]
+    missing = np.isnan(before) | np.isnan(after)
+    held = ~missing & (before > 0)
+    log_growth = np.where(held, np.log(np.maximum(after,0.) / np.where(held,before,1.) + np.finfo(float).tiny), 0.)
+
+    #cumulative sums, so each period is a difference of two columns
+    def cumsum_steps(a):
+        return np.concatenate([np.zeros((len(a),1)),np.cumsum(a,axis=1)],axis=1)
+    cum_log_growth = cumsum_steps(log_growth)
+    cum_held = cumsum_steps(held)
+    cum_missing = cumsum_steps(missing)
+
+    res = pd.DataFrame(index=pv.names)
+    for period,start_date in get_period_start_dates(end_date,periods).items():
+        s = pv.dates.get_loc(start_date)
+        e = pv.dates.get_loc(end_date)
+
+        was_held = cum_held[:,e] - cum_held[:,s] > 0
+
+        times = ((pv.dates[s:e+1] - pv.dates[s]) / (pv.dates[e] - pv.dates[s])).to_numpy(dtype=float)
+        cash_flows = pv.flow_out[:,s:e+1] - pv.flow_in[:,s:e+1]
+        cash_flows[:,0] = -pv.value[:,s]
+        cash_flows[:,-1] += pv.value[:,e]
+
+        res[f'{ftypes.TWR_PREFIX}{period}'] = np.where(was_held,np.expm1(cum_log_growth[:,e] - cum_log_growth[:,s]),np.nan)
+        #the mwr depends on every cash flow, so is only calculated when all the values are known
+        has_all_values = ~np.isnan(cash_flows).any(axis=1)
+        res[f'{ftypes.MWR_PREFIX}{period}'] = np.where(was_held & has_all_values,calc_mwr(np.nan_to_num(cash_flows),times),np.nan)
+        res[f'{ftypes.RETURN_NOT_ALL_DATA_PRESENT_PREFIX}{period}'] = (cum_missing[:,e] - cum_missing[:,s] > 0) | np.isnan(pv.value[:,s])
+
+    return res
+
+def calc_returns(events_df, stock_hist, end_date, periods, end_quantities = None, symbol_groups = None):
+    """
+    Calculates the returns of each position, and of each group of positions if symbol_groups is given. See
+    get_position_values and calc_period_returns
+
+    Returns:
+    - (returns by symbol, returns by group or None)
+    """
+    pv = get_position_values(events_df,stock_hist,end_date,periods,end_quantities)
+
+    position_returns = calc_period_returns(pv,end_date,periods)
+    group_returns = None
+    if(symbol_groups is not None):
+        group_returns = calc_period_returns(group_position_values(pv,symbol_groups),end_date,periods)
+
+    return position_returns,group_returns
+
+if __name__ == '__main__':
+    import argparse
+
+    import history_stock_downloader
+    import schwab_events_parser
+
+    parser = argparse.ArgumentParser(
+        description="prints the returns of the positions in schwab events files, using the prices in a price store",
+        exit_on_error=True,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("price_store", help="sqlite price store, ex. stock_prices_used.sqlite of a snapshot")
+    parser.add_argument("end_date", help="YYYY-MM-DD")
+    parser.add_argument("events_files", nargs='+', help="schwab transaction csv files")
+    parser.add_argument("--periods", nargs='+', default=['1y'])
+    parser.add_argument("--interval", default='1wk')
+
+    args = parser.parse_args()
+
+    events_df = pd.concat([schwab_events_parser.get_return_events(schwab_events_parser.parse_file(fp)) for fp in args.events_files],
+                          ignore_index=True)
+    start_date = min(get_period_start_dates(args.end_date,args.periods).values())
+
+    store = history_stock_downloader.PriceStore(args.price_store)
+    try:
+        stock_hist = store.load_prices(events_df[EVENT_SYMBOL_COL].unique(),args.interval,start_date,args.end_date)
+    finally:
+        store.close()
+
+    position_returns,_ = calc_returns(events_df,stock_hist,args.end_date,args.periods)
+    print(position_returns.to_string())
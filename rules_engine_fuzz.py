@@ -0,0 +1,129 @@
+"""Differential test of the rules engines. Runs every engine in rules_parser.RULES_ENGINES over randomized rule
+sheets and data, and complains if their results, their dtypes, or their rules logs differ. Some of the data frames are
+all numbers, which the row by row engines see as floats.
+"""
+import argparse
+import random
+import sys
+
+import pandas as pd
+
+import array_log as al
+import rules_parser
+
+COLUMNS = ['Symbol','Exchange','Currency','Value']
+NEW_COLUMNS = ['R:Ticker','R:Region']
+VALUES = ['AAA','AB','x1','USA','NYSE','',5,2.5,None]
+
+NUMERIC_VALUES = [1,2,5,2.5,None]
+
+def random_match_value(rng, var_name):
+    match rng.randint(0,6):
+        case 0:
+            return str(rng.choice(VALUES[:6]))
+        case 1:
+            return rng.choice(['r:A.*','r:x|U','r:(A)B','r:NY(SE)?'])
+        case 2:
+            return f"${{{var_name}}}"
+        case 3:
+            return f"${{{var_name}:[A-Za-z]+}}"
+        case 4:
+            #named and nested groups, which the variables are given by position
+            return rng.choice([f"${{{var_name}:(?P<g>[A-Z])[A-Z]*}}",f"r:(A)?${{{var_name}:(x|(U))}}.*",f"${{{var_name}:(\\d)(\\.\\d)?}}"])
+        case 5:
+            return str(rng.choice(NUMERIC_VALUES))
+        case _:
+            return f"x${{{var_name}}}"
+
+def random_replacement_value(rng, var_names):
+    choices = ['lit','','${unknown}','m:a,b']
+    if(var_names):
+        choices += [f"${{{rng.choice(var_names)}}}"] * 3 + [f"pre-${{{rng.choice(var_names)}}}-post"]
+    return rng.choice(choices)
+
+def random_rules_sheet(rng, num_rules):
+    """Returns the rows of a rules sheet, as read by util.read_standardized_csv"""
+    rows = [['Match','','Replacement','']]
+
+    for rule_index in range(num_rules):
+        rows.append([])
+
+        match_names = rng.sample(COLUMNS + NEW_COLUMNS,rng.randint(0,3))
+        match_values = [random_match_value(rng,f"v{rule_index}_{i}") for i in range(len(match_names))]
+        var_names = [m[0] for mv in match_values for m in rules_parser.ALL_VARS_PATTERN.findall(mv)]
+
+        repl_names = rng.sample(COLUMNS + NEW_COLUMNS,rng.randint(1,2))
+        repl_values = [random_replacement_value(rng,var_names) for _ in repl_names]
+
+        for i in range(max(len(match_names),len(repl_names),1)):
+            row = [match_names[i],match_values[i]] if i < len(match_names) else ['*' if i == 0 else '','']
+            row += [repl_names[i],repl_values[i]] if i < len(repl_names) else ['','']
+            rows.append(row)
+
+    return rows
+
+def random_df(rng, num_rows):
+    values = NUMERIC_VALUES if rng.random() < 0.3 else VALUES
+    return pd.DataFrame({ c : [rng.choice(values) for _ in range(num_rows)] for c in COLUMNS})
+
+def normalize_df(df):
+    df = df[sorted(df.columns)]
+    return (df.astype(object).where(df.notna(),None),list(df.dtypes))
+
+def run_engine(engine, system_rules, user_rules, df, log_on):
+    log = al.Log({}, turn_off=not log_on)
+    try:
+        res = rules_parser.RULES_ENGINES[engine](system_rules,user_rules,df.copy(),log)
+    except Exception as e:
+        return (f"raised {e!r}",None)
+    return (normalize_df(res),log.get_logs())
+
+def compare_engines(seed, num_rows):
+    """Runs all the engines over one random case. Returns a list of differences found"""
+    rng = random.Random(seed)
+
+    system_rules = rules_parser.parse_override_file(random_rules_sheet(rng,rng.randint(0,15)),False)
+    user_rules = rules_parser.parse_override_file(random_rules_sheet(rng,rng.randint(0,6)),True)
+    df = random_df(rng,num_rows)
+
+    #the rules log is only written for one holding at a time, and the engines may run differently with it on
+    log_on = rng.random() < 0.3
+    results = { e : run_engine(e,system_rules,user_rules,df,log_on) for e in rules_parser.RULES_ENGINES}
+
+    diffs = []
+    base_engine = 'rowwise'
+    base_res,base_logs = results[base_engine]
+    for engine,(res,logs) in results.items():
+        if(isinstance(base_res,str) or isinstance(res,str)):
+            if(not (isinstance(base_res,str) and isinstance(res,str))):
+                diffs.append(f"{engine}: {res if isinstance(res,str) else 'ok'}, {base_engine}: {base_res if isinstance(base_res,str) else 'ok'}")
+        elif(not res[0].equals(base_res[0])):
+            diffs.append(f"{engine}: result differs from {base_engine}")
+        elif(res[1] != base_res[1]):
+            diffs.append(f"{engine}: dtypes {res[1]} differ from {base_engine} {base_res[1]}")
+        elif(logs != base_logs):
+            diffs.append(f"{engine}: rules log differs from {base_engine}")
+
+    return diffs
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="runs all rules engines over random rules and data and checks they produce the same results",
+        exit_on_error=True,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--seed", type=int, default=0, help="first random seed")
+    parser.add_argument("--iterations", type=int, default=200, help="number of random cases to run")
+    parser.add_argument("--rows", type=int, default=30, help="number of data rows in each case")
+
+    args = parser.parse_args()
+
+    num_failed = 0
+    for seed in range(args.seed,args.seed+args.iterations):
+        for diff in compare_engines(seed,args.rows):
+            num_failed += 1
+            print(f"seed {seed}: {diff}")
+
+    print(f"{args.iterations} cases, {num_failed} differences")
+
+    sys.exit(1 if num_failed else 0)
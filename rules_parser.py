@@ -3,6 +3,7 @@
 from calendar import c
 import math
 from numpy import nan
+import numpy as np
 import openpyxl as op
 import sys
 
@@ -141,7 +142,9 @@ class OverrideRule:
         """
         def replace_var_sub(match):
             var_name = match.group(1)  # Extract the variable name from the match
-            return var_subs.get(var_name, match.group(0))  # Return the value or the original string
+            if(var_name not in var_subs):
+                return match.group(0) # Return the original string
+            return str(var_subs[var_name]) # the value may be numeric, if it was copied as is from the data
 
         altered_columns = set()
 
@@ -225,12 +228,31 @@ def parse_override_file(fi,is_user_rules) -> list[OverrideRule]:
                                "'[holding_column1],[holding_column2],...=[pick_column1],[pick_column2]...', Ex. 'Region,Ticker=Region,Ticker'")
 
         if(match_name != ''):
+            #a rule matching the same name twice or the same variable twice is in all likelyhood a mistake, and
+            #the indexed rule engine can't run it the same way as the others
+            if(match_name in [mc.name for mc in current_rule.match_conditions]):
+                util.csv_error(row,ri,0,f"The rule already has a match condition for {match_name}")
+
             current_rule.add_match_condition(ri,match_name, match_value)
+
+            var_names = get_match_condition_var_names(current_rule.match_conditions[-1])
+            earlier_var_names = [vn for mc in current_rule.match_conditions[:-1] for vn in get_match_condition_var_names(mc)]
+            dup_var_names = [vn for vn in var_names if vn in earlier_var_names]
+            if(dup_var_names or len(set(var_names)) != len(var_names)):
+                util.csv_error(row,ri,1,f"Each variable may only be matched once in a rule, got {','.join(dup_var_names or var_names)} more than once")
         if(repl_name != ''):
+            if(repl_name in [r_name for _,r_name,_ in current_rule.replacements]):
+                util.csv_error(row,ri,2,f"The rule already has a replacement for {repl_name}")
+
             current_rule.add_replacement(ri,repl_name, repl_value)
 
     return rules
 
+def get_match_condition_var_names(mc):
+    if(isinstance(mc,ReMatchCondition)):
+        return mc.var_names
+    return []
+
 def get_match_name_list_sorted_by_usage(override_rules):
         match_name_to_count = {}
         for r in override_rules:
@@ -257,10 +279,8 @@ def merge_dicts(d1 : dict, d2 : dict, fn):
     return d2_copy
 
 
-#TODO 2: When parsing rules, don't allow any rule to specify the same name twice in match or replacement.
-# First, we haven't made FastOverrideRulesList to handle this. (We could do it, but it would be overly complicated
-# and the user probably never needs to do this). Second, if this is happening, it is in all likelyhood a mistake
-#TODO 2: also don't allow a rule to match the same var twice in different match conditions
+#Note, parse_override_file() doesn't allow any rule to specify the same name twice in match or replacement or to match
+#the same var twice in different match conditions. FastOverrideRulesList relies on this.
 class MatchGroup:
     def __init__(self,name) -> None:
         self.name = name
@@ -295,13 +315,13 @@ class MatchGroup:
         returning all rule indexes that matches along with their var values
         """
 
-        val = row.get(self.name,'') #TODO 2 should we really use '' here? Probably need to chase down what
-        #we do elsewhere for non existant columns and then make sure we all use the same thing in all cases
+        #missing and empty values never match a simple match condition, same as MatchCondition.matches()
+        val = util.get_df_row_val(row,self.name)
 
         #handle simple match conditions (no regex, and no match vars), by simply adding the rule indexes
         #that belong to the match for the 'or' and are part of the rules that can match
-        res = { ri : {} for ri in self.val_to_ri_set.get(val,set()) if (ri > last_run_ri and
-                                                                         rules[ri].is_user_rule == is_user_rules)}
+        ri_set = self.val_to_ri_set.get(val,set()) if val is not None else set()
+        res = { ri : {} for ri in ri_set if (ri > last_run_ri and rules[ri].is_user_rule == is_user_rules)}
 
         #handle regex matches, with their own var values for the 'or'
         for re_mc,ri_set in self.re_mc_and_ri_set:
@@ -312,12 +332,6 @@ class MatchGroup:
             if(ri_set == set()):
                 continue
 
-            #H*CK
-            # for ri in ri_set:
-            #     if(rules[ri].row_index == 45):
-            #         print("bbbb")
-            #         break
-
             #match the regex against the value
             is_match,curr_match_vars = re_mc.matches(row)
             if(not is_match):
@@ -336,10 +350,8 @@ class FastOverrideRulesList:
         Speeds up override rules, by combining the match conditions so they only have to be run once,
         no matter how many rules use them.
 
-        WARNING: No rule may specify the same name twice in the match conditions or this will produce
-        inconsistent results.
-        WARNING 2: No rule may specify the same match variable in more than one
-        match condition, or inconsistent results may occur.
+        Rules must come from parse_override_file(), which makes sure no rule specifies the same name twice
+        in the match conditions or the same match variable in more than one match condition.
         """
 
         self.rules = rules
@@ -442,23 +454,38 @@ class FastOverrideRulesList:
 def create_forl(rules : list[OverrideRule]):
     return FastOverrideRulesList(rules)
 
-def run_rules_alt_method(rules : list[OverrideRule], forl : FastOverrideRulesList, df : pd.DataFrame, log : al.Log):
-    """Runs override rules against the data frame a different way
+def run_rules_indexed(system_rules : list[OverrideRule], user_rules : list[OverrideRule], df : pd.DataFrame, log : al.Log):
+    """Same as run_rules, but uses a FastOverrideRulesList so that each row jumps straight to the next rule that
+    matches it, rather than trying every rule in turn. If we have 1000's of rules this may be faster.
 
-    Args:
-        rules: rules to run
-        forl : call create_forl()
-        df (pd.DataFrame): Dataframe to update
+    The rules log is the same as run_rules. To do this, the rules that were skipped over are tried against
+    the row for the log only, when the log is on.
     """
+    rules = system_rules + user_rules
+    forl = create_forl(rules)
 
-    def update_row(row):
+    def update_row(row_orig):
+        row = row_orig.to_dict()
         #fixed columns are columns that are changed by user rules. If this happens 
         #then the system rules cannot override
         fixed_columns = {}
+
+        def log_non_matching_rules(is_user_rules, after_ri, before_ri):
+            """writes the log for rules that were skipped because they didn't match"""
+            if(not log_is_on(log)):
+                return
+            for ri in range(after_ri+1,before_ri):
+                r = rules[ri]
+                if(r.is_user_rule != is_user_rules):
+                    continue
+                with al.add_log_context(log, {"rule_row_index": r.row_index}):
+                    r.matches(row,log=log)
+                    al.write_log(log, "did not match.")
         
         def run_rules(is_user_rules):
             #we have to run each rule one by one since rules change the input data of any rule that
             #happens after it
+            any_rule_matched = False
 
             last_ri = -1
             match_data = forl.create_empty_match_data()
@@ -469,24 +496,35 @@ def run_rules_alt_method(rules : list[OverrideRule], forl : FastOverrideRulesLis
                 if(ri is None):
                     break
 
+                log_non_matching_rules(is_user_rules,last_ri,ri)
                 last_ri = ri
-                
-                altered_columns = rules[ri].apply(var_values,row, fixed_columns=fixed_columns,log=log)         
+                any_rule_matched = True
+
+                with al.add_log_context(log, {"rule_row_index": rules[ri].row_index}):
+                    if(log_is_on(log)):
+                        rules[ri].matches(row,log=log)
+                    al.write_log(log, "matched.")
+                    altered_columns = rules[ri].apply(var_values,row, fixed_columns=fixed_columns,log=log)         
                 forl.reset_match_data(match_data,altered_columns)
 
-        #run the system rules    
-        run_rules(False)
-        #run the user rules
-        run_rules(True)
-        #run the system rules again, so any change by the user rule will be propagated to the system rule
-        #(note this will not overwrite values set by user rules, which become fixed columns)
-        run_rules(False)
+            log_non_matching_rules(is_user_rules,last_ri,len(rules))
 
-        return row
+            return any_rule_matched
 
-    df = df.apply(update_row,axis=1)
+        with al.add_log_context(log, {"df_index" : row_orig.name}):
+            with al.add_log_context(log, {"rule_set": "system_rules pass 1"}):
+                run_rules(False)
+            with al.add_log_context(log, {"rule_set": "user_rules"}):
+                any_user_rules_matched = run_rules(True)
+            #run the system rules again, so any change by the user rule will be propagated to the system rule
+            #(note this will not overwrite values set by user rules, which become fixed columns)
+            if(any_user_rules_matched):
+                with al.add_log_context(log, {"rule_set": "system_rules pass 2"}):
+                    run_rules(False)
 
-    return df
+        return row
+
+    return pd.DataFrame(df.apply(update_row, axis=1).tolist())
         
 
 def run_rules(system_rules : list[OverrideRule], user_rules : list[OverrideRule], df : pd.DataFrame, log : al.Log):
@@ -526,7 +564,7 @@ def run_rules(system_rules : list[OverrideRule], user_rules : list[OverrideRule]
         #override any rule added to system rules, but also any system rule that depends on a
         #value changed by a user rule will use the user rule's value, and not any clashing
         #system rule's value.
-        with al.add_log_context(log, {"df_index" : row_orig.index}):
+        with al.add_log_context(log, {"df_index" : row_orig.name}):
             with al.add_log_context(log, {"rule_set": "system_rules pass 1"}):
                 run_rules(system_rules,log, False)
             with al.add_log_context(log, {"rule_set": "user_rules"}):
@@ -539,5 +577,242 @@ def run_rules(system_rules : list[OverrideRule], user_rules : list[OverrideRule]
     
     return pd.DataFrame(df.apply(lambda row: update_row(row), axis=1).tolist())
 
+VAR_SUB_PATTERN = re.compile(r'\$\{(\w+)\}')
+SINGLE_VAR_SUB_PATTERN = re.compile(r'^\$\{(\w+)\}$')
+
+class CompiledFrame:
+    """Columns of a dataframe as object arrays, which rules read and write in bulk.
+
+    Equality match conditions are answered from a factorization of the column, which is computed once
+    and reused by every rule until the column is written to.
+    """
+    def __init__(self, df : pd.DataFrame):
+        self.num_rows = len(df)
+        self.columns = { c : df[c].to_numpy(dtype=object,copy=True) for c in df.columns}
+        self.codes_cache = {}
+
+    def get_series(self, name):
+        col = self.columns.get(name)
+        if(col is None):
+            return None
+        return pd.Series(col,copy=False)
+
+    def equals_mask(self, name, value):
+        col = self.columns.get(name)
+        if(col is None):
+            return np.zeros(self.num_rows,dtype=bool)
+
+        if(name not in self.codes_cache):
+            try:
+                codes,uniques = pd.factorize(col)
+                self.codes_cache[name] = (codes,{ u : code for code,u in enumerate(uniques)})
+            except TypeError: #unhashable values, can't factorize
+                self.codes_cache[name] = None
+
+        cached = self.codes_cache[name]
+        if(cached is None):
+            return pd.Series(col,copy=False).eq(value).to_numpy(dtype=bool)
+
+        codes,value_to_code = cached
+        code = value_to_code.get(value)
+        if(code is None):
+            return np.zeros(self.num_rows,dtype=bool)
+        return codes == code
+
+    def set_values(self, name, mask, values):
+        col = self.columns.get(name)
+        if(col is None):
+            col = np.full(self.num_rows,nan,dtype=object)
+            self.columns[name] = col
+        col[mask] = values
+        self.codes_cache.pop(name,None)
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.columns).infer_objects()
+
+
+class CompiledRule:
+    """An OverrideRule that matches and replaces a whole column at a time
+    """
+    def __init__(self, rule : OverrideRule):
+        self.rule = rule
+        self.var_names = set()
+
+        for mc in rule.match_conditions:
+            if(isinstance(mc,ReMatchCondition)):
+                self.var_names.update(mc.var_names)
+
+        #each replacement is split into pieces, which are either literal strings or variable names
+        self.replacements = []
+        for row_index,r_name,r_value in rule.replacements:
+            m = SINGLE_VAR_SUB_PATTERN.match(r_value)
+            if(m and m.group(1) in self.var_names):
+                #used alone, so the value is copied as is (it may be numeric)
+                pieces = None
+                single_var = m.group(1)
+            else:
+                single_var = None
+                pieces = []
+                for i,piece in enumerate(VAR_SUB_PATTERN.split(r_value)):
+                    is_var = (i % 2 == 1 and piece in self.var_names)
+                    if(i % 2 == 1 and not is_var):
+                        piece = f"${{{piece}}}"
+                    pieces.append((is_var,piece))
+            self.replacements.append((row_index,r_name,r_value,single_var,pieces))
+
+    def match_condition_mask(self, mc, cf : CompiledFrame, rows, var_values):
+        """Returns a boolean mask of which of the given row indexes match the condition, and adds any variable values
+        of the matching rows to var_values
+        """
+        if(isinstance(mc,MatchCondition)):
+            return cf.equals_mask(mc.name,mc.val_str)[rows]
+
+        s = cf.get_series(mc.name)
+        if(s is None):
+            return np.zeros(len(rows),dtype=bool)
+        s = s.iloc[rows]
+        mask = s.notna().to_numpy(dtype=bool)
+
+        if(len(mc.var_names) == 1 and mc.val_re == NO_REGEX):
+            var_values[mc.var_names[0]] = s
+            return mask
+
+        strs = s[mask].astype(str)
+        str_mask = strs.str.match(mc.val_re).to_numpy(dtype=bool)
+        mask[mask] = str_mask
+
+        if(mc.var_names):
+            groups = s.astype(str)[mask].str.extract(f"^(?:{mc.val_re})",expand=True)
+            #variables are given groups by position, like zip(var_names,m.groups()) does. Named groups get
+            #their name as the column name, so the columns are taken by position too
+            for i,var_name in enumerate(mc.var_names):
+                #groups that didn't participate in the match are None, same as re.match()
+                group = groups.iloc[:,i].reindex(s.index)
+                var_values[var_name] = group.astype(object).where(group.notna(),None)
+
+        return mask
+
+    def matches(self, cf : CompiledFrame, rows):
+        """Returns the row indexes, out of the given ones, that the rule matches and the values of the rule's variables for them
+        """
+        var_values = {}
+        for mc in self.rule.match_conditions:
+            mask = self.match_condition_mask(mc,cf,rows,var_values)
+            rows = rows[mask]
+            var_values = { k : v[mask] for k,v in var_values.items()}
+            if(len(rows) == 0):
+                break
+
+        return rows,var_values
+
+    def replacement_values(self, single_var, pieces, var_values, num_rows):
+        if(single_var is not None):
+            return var_values[single_var].to_numpy(dtype=object)
+
+        if(all(not is_var for is_var,_ in pieces)):
+            return "".join([piece for _,piece in pieces])
+
+        res = pd.Series([''] * num_rows,dtype=object)
+        for is_var,piece in pieces:
+            if(is_var):
+                res = res + var_values[piece].astype(str).to_numpy(dtype=object)
+            else:
+                res = res + piece
+        return res.to_numpy(dtype=object)
+
+    def apply(self, cf : CompiledFrame, rows, var_values, fixed_columns):
+        for row_index,r_name,r_value,single_var,pieces in self.replacements:
+            target_rows = rows
+            if(not self.rule.is_user_rule and r_name in fixed_columns):
+                target_rows = rows[~fixed_columns[r_name][rows]]
+
+            if(len(target_rows) == 0):
+                continue
+
+            target_var_values = var_values
+            if(len(target_rows) != len(rows)):
+                keep = np.isin(rows,target_rows)
+                target_var_values = { k : v[keep] for k,v in var_values.items()}
+
+            values = self.replacement_values(single_var,pieces,target_var_values,len(target_rows))
+
+            #run_rules only writes values that differ from the old ones, so copying a group that didn't match (None)
+            #into a column no row has yet doesn't add the column
+            if(r_name in cf.columns or isinstance(values,str) or any(v is not None for v in values)):
+                cf.set_values(r_name,target_rows,values)
+
+            if(self.rule.is_user_rule):
+                fixed = fixed_columns.setdefault(r_name,np.zeros(cf.num_rows,dtype=bool))
+                fixed[target_rows] = True
+
+
+def log_is_on(log : al.Log):
+    return not log.turn_off
+
+def run_rules_compiled(system_rules : list[OverrideRule], user_rules : list[OverrideRule], df : pd.DataFrame, log : al.Log):
+    """Same as run_rules, but runs each rule against all rows at once rather than each row against all the rules.
+
+    Rules still run one after another in order, since a rule may change the input of any rule after it. Each rule
+    narrows down the rows it applies to using its match conditions, and then writes its replacements into
+    those rows in bulk.
+
+    The rules log is written per row and per match condition, in row order, so when it's on this falls back to run_rules.
+    """
+    if(log_is_on(log)):
+        return run_rules(system_rules,user_rules,df,log)
+
+    #run_rules sees each row as a series of the columns' common dtype, so in a frame of only ints and floats, the ints
+    #are floats. Convert the same way, so both engines match and copy the same values, and give the same dtypes
+    if(len(df.columns) > 0 and all(pd.api.types.is_numeric_dtype(t) for t in df.dtypes)):
+        df = df.astype(df.to_numpy().dtype)
+
+    compiled_system_rules = [CompiledRule(r) for r in system_rules]
+    compiled_user_rules = [CompiledRule(r) for r in user_rules]
+
+    cf = CompiledFrame(df.reset_index(drop=True))
+
+    #fixed columns are a mask per column of the rows that were set by a user rule, which system rules may not change
+    fixed_columns = {}
+
+    def run_rule_set(rules : list[CompiledRule], rows):
+        matched = np.zeros(cf.num_rows,dtype=bool)
+
+        for r in rules:
+            matched_rows,var_values = r.matches(cf,rows)
+
+            if(len(matched_rows) == 0):
+                continue
+
+            r.apply(cf,matched_rows,var_values,fixed_columns)
+            matched[matched_rows] = True
+
+        return matched
+
+    all_rows = np.arange(cf.num_rows)
+
+    run_rule_set(compiled_system_rules,all_rows)
+    any_user_rules_matched = run_rule_set(compiled_user_rules,all_rows)
+    #rows changed by a user rule get the system rules run again, which won't overwrite the fixed columns
+    run_rule_set(compiled_system_rules,all_rows[any_user_rules_matched])
+
+    return cf.to_dataframe()
+
+#part of the key of the stored frames the rules are run over, bump this when running the rules gives different results
+RULES_VERSION = 2
+
+RULES_ENGINES = {
+    'compiled' : run_rules_compiled,
+    'rowwise' : run_rules,
+    'indexed' : run_rules_indexed,
+}
+assert list(RULES_ENGINES.keys()) == ftypes.RULES_ENGINE_NAMES
+
+def run_rules_with_engine(engine : str, system_rules : list[OverrideRule], user_rules : list[OverrideRule], df : pd.DataFrame, log : al.Log):
+    """Runs the rules using one of RULES_ENGINES. All engines produce the same result"""
+    if(engine not in RULES_ENGINES):
+        util.error(f"No rules engine named {engine}, must be one of {','.join(RULES_ENGINES.keys())}")
+
+    return RULES_ENGINES[engine](system_rules,user_rules,df,log)
+
 if __name__ == '__main__':
     parse_override_file(sys.argv[1])
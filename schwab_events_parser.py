@@ -1,19 +1,48 @@
 """Parses an override excel or csv file
 """
-import datetime
+import os
 import sys
 
 import util
-from util import skip_blank_lines,verify_header,read_data
+from util import verify_header
 
 import ftypes
 import re
+import returns
+import schwab_parser
 import pandas as pd
 
 SCHWAB_HEADERS = ['Date','Action','Symbol','Description','Quantity','Price','Fees & Comm','Amount']
 
 SCHWAB_NUMERIC_HEADERS = ['Quantity','Price','Fees & Comm','Amount']
 
+#last row of the export, with the sum of the amounts
+SCHWAB_TOTAL_ROW_NAME = 'Transactions Total'
+
+NUMERIC_JUNK_RE = re.compile(r'[^0-9.-]')
+
+#schwab actions that are used to calculate returns. Others, such as transfers, interest and stock splits (yahoo
+#prices are already adjusted for them), are ignored
+SCHWAB_ACTION_TO_EVENT_TYPE = {
+    'Buy' : ftypes.EventTypes.Buy,
+    'Reinvest Shares' : ftypes.EventTypes.Buy,
+    'Sell' : ftypes.EventTypes.Sell,
+    'Cash Dividend' : ftypes.EventTypes.Dividend,
+    'Qualified Dividend' : ftypes.EventTypes.Dividend,
+    'Non-Qualified Div' : ftypes.EventTypes.Dividend,
+    'Special Dividend' : ftypes.EventTypes.Dividend,
+    'Special Qual Div' : ftypes.EventTypes.Dividend,
+    'Pr Yr Cash Div' : ftypes.EventTypes.Dividend,
+    'Pr Yr Div Reinvest' : ftypes.EventTypes.Dividend,
+    'Reinvest Dividend' : ftypes.EventTypes.Dividend,
+    'Long Term Cap Gain' : ftypes.EventTypes.Dividend,
+    'Short Term Cap Gain' : ftypes.EventTypes.Dividend,
+    'Cash In Lieu' : ftypes.EventTypes.Dividend,
+    'ADR Mgmt Fee' : ftypes.EventTypes.Fee,
+    'Foreign Tax Paid' : ftypes.EventTypes.Fee,
+    'Service Fee' : ftypes.EventTypes.Fee,
+}
+
 def extract_last_3_account_chars(filename):
     # Match the pattern between 'Individual_' and '_Transactions'
     match = re.search(r'Individual_XXX(.*?)_Transactions', filename)
@@ -25,41 +54,66 @@ def extract_last_3_account_chars(filename):
 
 
 
-def parse_file(fp : str):
-    acct_last3 = extract_last_3_account_chars(fp)
-
-    fi = enumerate(util.extend_all_row_length(util.read_standardized_csv(fp),min_len=9))
-    (ri,row) = next(fi)
-    verify_header(ri,row,SCHWAB_HEADERS)
-
-    all_rows = []
-    while(True):
-        (ri,row) = skip_blank_lines(fi)
+def parse_file(fp : str, snapshot_datestr : str = None):
+    """Parses a schwab transactions export, one row per event, newest first as schwab writes them.
 
-        #at EOF
-        if(row is None):
-            break
+    Args:
+        snapshot_datestr: unused, the format hasn't changed between snapshots yet
+    """
+    acct_last3 = extract_last_3_account_chars(os.path.basename(fp))
 
-        acct_name = row[0]
-        (ri,row) = next(fi)
+    cells = schwab_parser.read_cells(fp)
+    #short files still get all the columns
+    for ci in range(cells.shape[1],len(SCHWAB_HEADERS)):
+        cells[ci] = ''
 
-        (curr_table_rows,at_eof,ri) = read_data(fi)
+    verify_header(0,schwab_parser.get_row(cells,0),SCHWAB_HEADERS)
 
-        all_rows += curr_table_rows[0:-2]
+    #cells after the last header are extra data that doesn't fit
+    extra = (cells.iloc[1:,len(SCHWAB_HEADERS):] != '').any(axis=1)
+    if(extra.any()):
+        ri = extra.index[extra.to_numpy()][0]
+        util.csv_error(schwab_parser.get_row(cells,ri),ri,len(SCHWAB_HEADERS),f"Row has more cells than the header, {','.join(SCHWAB_HEADERS)}")
 
-        if(at_eof):
-            break
+    res = cells.iloc[1:,0:len(SCHWAB_HEADERS)].set_axis(SCHWAB_HEADERS,axis=1)
 
-    headers = SCHWAB_HEADERS+[ftypes.SpecialColumns.DAcctName.get_col_name()]
+    #blank rows and the total row at the end aren't events
+    res = res[(res != '').any(axis=1) & (res['Date'] != SCHWAB_TOTAL_ROW_NAME)].reset_index(drop=True)
 
-    res =  pd.DataFrame(all_rows,columns=headers)
-
-    #schwab uses 'N/A' for some securities sometimes, so we replace it with None
-    res[SCHWAB_NUMERIC_HEADERS] = res[SCHWAB_NUMERIC_HEADERS].replace('N/A', None)
+    for c in SCHWAB_NUMERIC_HEADERS:
+        res[c] = to_number(res[c])
+    res[ftypes.SpecialColumns.DAcctName.get_col_name()] = acct_last3
     res[ftypes.SpecialColumns.DBrokerage.get_col_name()] = ftypes.BrokerageTypes.Schwab.name
 
     return res
 
+def to_number(s : pd.Series):
+    #ex. "-$1,234.56". Blank cells, and 'N/A' which schwab uses for some securities sometimes, become NaN
+    return pd.to_numeric(s.str.replace(NUMERIC_JUNK_RE, '',regex=True).replace('',None), errors='coerce')
+
+def get_return_events(df, symbol_col = 'Symbol', keep_columns = ()):
+    """Converts the frame returned by parse_file into an events frame for returns.calc_returns
+
+    Args:
+        symbol_col: column to take the symbol from, ex. the yahoo ticker column once the rules have been run
+        keep_columns: columns of df copied into the events frame as is, ex. the holding each event is for
+    """
+    event_types = df['Action'].map({ k : v.name for k,v in SCHWAB_ACTION_TO_EVENT_TYPE.items() })
+    df = df[event_types.notna()]
+
+    res = pd.DataFrame({
+        #ex. "05/09/2025 as of 05/08/2025"
+        returns.EVENT_DATE_COL : pd.to_datetime(df['Date'].str[:10],format='%m/%d/%Y'),
+        returns.EVENT_SYMBOL_COL : df[symbol_col],
+        returns.EVENT_TYPE_COL : event_types[df.index],
+        returns.EVENT_QUANTITY_COL : df['Quantity'].abs(),
+        returns.EVENT_AMOUNT_COL : df['Amount'],
+    })
+    for c in keep_columns:
+        res[c] = df[c]
+
+    return res.reset_index(drop=True)
+
 if __name__ == '__main__':
     df = parse_file(sys.argv[1])
 
@@ -1,13 +1,15 @@
 """Parses an override excel or csv file
 """
 import datetime
+import io
 import sys
 
 import util
-from util import skip_blank_lines,verify_header,read_data
+from util import verify_header
 
 import ftypes
 import re
+import numpy as np
 import pandas as pd
 from date_registry import DateRegistry
 
@@ -30,50 +32,110 @@ dr.register("numeric_headers","2025-05-07",['Qty (Quantity)', 'Price', 'Price Ch
                 'Mkt Val (Market Value)', 'Day Chng $ (Day Change $)', 'Day Chng % (Day Change %)', 'Cost Basis', 'Gain $ (Gain/Loss $)', 
                 'Gain % (Gain/Loss %)', '% of Acct (% of Account)'])
 
+#removes everything but the number from a cell, ex. "$1,234.56" -> "1234.56"
+NUMERIC_JUNK_RE = re.compile(r'[^0-9.()-]')
+INTEGER_RE = re.compile(r'-?[0-9]+')
+#a cell starting or ending with whitespace always has it next to a delimiter, quote or line end
+UNTRIMMED_CELL_MARKERS = [f"{a}{q}{w}" for a in [',','\n'] for q in ['','"'] for w in [' ','\t']] + \
+                         [f"{w}{q}{a}" for a in [',','\n','\r'] for q in ['','"'] for w in [' ','\t']]
+
+def read_cells(fp : str):
+    """Reads all the rows of the file into one frame of strings, trimmed like util.read_standardized_csv, with
+    '' for missing cells. Blank rows are kept, so the row index of the frame is the row index in the file.
+    """
+    if(fp.endswith(".csv")):
+        with open(fp, newline='') as fh:
+            text = fh.read()
+
+        #no row has more cells than commas, so this is enough columns
+        max_cells = max((line.count(',') + 1 for line in text.splitlines()),default=1)
+        cells = pd.read_csv(io.StringIO(text), header=None, names=range(max_cells), dtype=str, keep_default_na=False,
+                            skip_blank_lines=False).fillna('')
+        #the first row is the title, which has commas and spaces inside quotes, so only it is checked separately
+        rest = text[text.find('\n')+1:] if '\n' in text else ''
+        if(not any(m in rest for m in UNTRIMMED_CELL_MARKERS) and not rest.endswith((' ','\t'))):
+            cells.iloc[0] = cells.iloc[0].str.strip()
+            return cells
+    elif(fp.endswith(".xlsx")):
+        cells = pd.DataFrame(list(util.iter_xlsx_rows(fp))).fillna('').astype(str)
+    else:
+        util.error(f"don't know how to read {fp}")
+
+    return cells.apply(lambda c : c.str.strip())
+
+def get_row(cells : pd.DataFrame, ri : int):
+    """Returns a row of cells as a list, without trailing blanks, for error messages and header checks"""
+    row = cells.iloc[ri].tolist()
+    while(row and row[-1] == ''):
+        row.pop()
+    return row
+
+def convert_numeric_columns(df : pd.DataFrame, columns : list[str]):
+    """Converts the columns to numbers. Columns of whole numbers become ints, others floats, like pd.to_numeric
+    does for each column.
+
+    Each distinct value is only cleaned and converted once, for all the columns together, since the same values
+    (ex. 'N/A', '$0.00') come up over and over.
+    """
+    if(df.empty or not columns):
+        return
+
+    codes,uniques = pd.factorize(pd.Series(df[columns].to_numpy().ravel(order='F'),dtype=object))
+
+    #schwab uses 'N/A' for some securities sometimes, so we replace it with None
+    cleaned = pd.Series(uniques,dtype=object).replace('N/A', None).str.replace(NUMERIC_JUNK_RE, '',regex=True)
+    nums = pd.to_numeric(cleaned, errors='raise').to_numpy(dtype=float)[codes].reshape((len(columns),len(df)))
+    is_int = cleaned.str.fullmatch(INTEGER_RE,na=False).to_numpy(dtype=bool)[codes].reshape((len(columns),len(df))).all(axis=1)
+
+    for c,col_nums,col_is_int in zip(columns,nums,is_int):
+        df[c] = col_nums.astype('int64') if col_is_int else col_nums
+
 def parse_file_v1(fp : str, subdir_datestr : str):
     schwab_headers = dr.get("headers",subdir_datestr)
     schwab_numeric_headers = dr.get("numeric_headers",subdir_datestr)
 
-    fi = enumerate(util.extend_all_row_length(util.read_standardized_csv(fp),min_len=17))
-    (ri,row) = next(fi)
+    cells = read_cells(fp)
+    #short files still get all the columns
+    for ci in range(cells.shape[1],len(schwab_headers)):
+        cells[ci] = ''
 
     #first parse the date
     #Positions for CUSTACCS as of 02:07 AM ET, 04/03/2024
-    (mm,dd,yyyy) = util.csv_assert_match(r'Positions for .*? as of .*, (\d\d)/(\d\d)/(\d\d\d\d)$', ri,0,row,"Can't parse date on first row")
+    (mm,dd,yyyy) = util.csv_assert_match(r'Positions for .*? as of .*, (\d\d)/(\d\d)/(\d\d\d\d)$', 0,0,get_row(cells,0),"Can't parse date on first row")
 
+    #each account is a run of non blank rows, the account name, the header, the holdings, and the cash and total rows
+    is_blank = (cells == '').all(axis=1).to_numpy()
+    non_blank = np.flatnonzero(~is_blank[1:]) + 1
+    run_starts = non_blank[np.r_[True, np.diff(non_blank) > 1]] if len(non_blank) else non_blank
+    run_ends = non_blank[np.r_[np.diff(non_blank) > 1, True]] if len(non_blank) else non_blank
 
-    all_rows = []
-    while(True):
-        (ri,row) = skip_blank_lines(fi)
+    data_rows = []
+    acct_names = []
+    for (start,end) in zip(run_starts,run_ends):
+        acct_name = cells.iat[start,0]
+        if(end < start + 3):
+            util.csv_error(get_row(cells,end),end,0,"Account table must have a header, and end with 'Cash & Cash Investments' and 'Account Total'")
 
-        #at EOF
-        if(row is None):
-            break
+        verify_header(start+1,get_row(cells,start+1),schwab_headers)
 
-        acct_name = row[0]
-        (ri,row) = next(fi)
+        util.csv_assert(cells.iat[end-1,0] == 'Cash & Cash Investments',get_row(cells,end-1),end-1,0,util.ErrorType.Error,"Table second to last row must be 'Cash & Cash Investments'")
+        util.csv_assert(cells.iat[end,0] == 'Account Total',get_row(cells,end),end,0,util.ErrorType.Error,"Table must end with 'Account Total'")
 
-        verify_header(ri,row,schwab_headers)
+        data_rows.append(np.arange(start+2,end-1))
+        acct_names.append(acct_name)
 
-        (curr_table_rows,at_eof,ri) = read_data(fi,acct_name)
+    data_rows_index = np.concatenate(data_rows + [np.array([],dtype=int)])
 
-        util.csv_assert(curr_table_rows[-2][0] == 'Cash & Cash Investments',row,ri-2,0,util.ErrorType.Error,"Table second to last row must be 'Cash & Cash Investments'")
-        util.csv_assert(curr_table_rows[-1][0] == 'Account Total',row,ri-1,0,util.ErrorType.Error,"Table must end with 'Account Total'")
+    #cells after the last header are extra data that doesn't fit
+    extra = (cells.iloc[data_rows_index,len(schwab_headers):] != '').any(axis=1)
+    if(extra.any()):
+        ri = extra.index[extra.to_numpy()][0]
+        util.csv_error(get_row(cells,ri),ri,len(schwab_headers),f"Row has more cells than the header, {','.join(schwab_headers)}")
 
-        all_rows += curr_table_rows[0:-2]
+    res = cells.iloc[data_rows_index,0:len(schwab_headers)].set_axis(schwab_headers,axis=1).reset_index(drop=True)
+    res[ftypes.SpecialColumns.DAcctName.get_col_name()] = np.repeat(np.array(acct_names,dtype=object),[len(r) for r in data_rows])
 
-        if(at_eof):
-            break
-
-    headers = schwab_headers+[ftypes.SpecialColumns.DAcctName.get_col_name()]
-
-    res =  pd.DataFrame(all_rows,columns=headers)
-
-    #schwab uses 'N/A' for some securities sometimes, so we replace it with None
-    res[schwab_numeric_headers] = res[schwab_numeric_headers].replace('N/A', None)
-    for c in schwab_numeric_headers:
-        res[c] = res[c].str.replace('[^0-9.()-]', '',regex=True)
-        res[c] = pd.to_numeric(res[c], errors='raise')
+    convert_numeric_columns(res,schwab_numeric_headers)
     res[ftypes.SpecialColumns.DBrokerage.get_col_name()] = ftypes.BrokerageTypes.Schwab.name
     res[ftypes.SpecialColumns.DRefreshedDate.get_col_name()] = datetime.date(int(yyyy),int(mm),int(dd))
 
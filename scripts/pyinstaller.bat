@@ -3,7 +3,20 @@ cd ..
 pyinstaller.exe --name themetrack --icon=images\themetrack.ico themetrack.py ^
 --add-data system_rules.xlsx:. ^
 --add-data theme_track_config.xlsx:. ^
---add-data dos_scripts/welcome.bat:dos_scripts
+--add-data dos_scripts/welcome.bat:dos_scripts ^
+--hidden-import pandas ^
+--hidden-import openpyxl ^
+--hidden-import capex_scraper ^
+--hidden-import ib_parser ^
+--hidden-import rules_parser ^
+--hidden-import schwab_parser ^
+--hidden-import schwab_events_parser ^
+--hidden-import reports ^
+--hidden-import scraper_util ^
+--hidden-import config_parser ^
+--hidden-import forex ^
+--hidden-import stock_perf_data ^
+--hidden-import snapshot_store
 
 mkdir dist\themetrack\dos_scripts
 copy dos_scripts\dos_greeting.txt dist\themetrack\dos_scripts\
@@ -0,0 +1,160 @@
+"""Stores the data frames built from a snapshot dir, so that they only need to be rebuilt when the inputs they were
+built from change.
+
+Each frame is stored under a stage name (ex. "parsed-U1234567_20250510.csv", "holdings-rules") together with a key,
+which is a hash of everything the frame was built from. Frames are written as parquet when they survive the round trip
+unchanged, so other tools can read them, and otherwise (ex. object columns mixing strings and numbers) as pickles.
+"""
+import glob
+import hashlib
+import json
+import os
+import pickle
+
+import pandas as pd
+
+import util
+
+#bump this whenever the way all stored frames are built changes, so old frames are ignored. Changes to a single stage
+#bump that stage's own version instead (ex. themetrack.InputFileType.parse_version, rules_parser.RULES_VERSION), so the
+#other stages are kept. 2: the parsers changed after the stages were first stored
+STORE_VERSION = 2
+
+FRAMES_SUBDIR = 'frames'
+PARQUET_EXT = '.parquet'
+PICKLE_EXT = '.pickle'
+#written instead of a frame when a stage produced None
+NONE_EXT = '.none'
+
+#(frames dir,stage) -> (key,frame) of the last frame of each stage, once keep_frames_in_memory() is called
+memory_frames = None
+
+def keep_frames_in_memory():
+    """Makes all stores also keep the last frame of each stage in memory, so a long running process
+    (ex. create-reports --watch) doesn't read unchanged stages back from disk each time
+    """
+    global memory_frames
+    if(memory_frames is None):
+        memory_frames = {}
+
+def copy_frame(df):
+    #callers are free to change the frames they get, so the ones in memory are never handed out directly
+    return None if df is None else df.copy()
+
+def make_key(*parts):
+    """Hashes the given parts into a key. Parts should be strings, numbers, or lists of them"""
+    return hashlib.sha256(json.dumps([STORE_VERSION,*parts],default=str).encode('utf-8')).hexdigest()
+
+def file_key(fp):
+    """Returns a key part for the contents of a file, or None if it doesn't exist"""
+    if(not os.path.exists(fp)):
+        return None
+    return util.get_file_sha256(fp)
+
+def object_key(o):
+    """Returns a key part for a picklable object, such as parsed rules"""
+    return hashlib.sha256(pickle.dumps(o)).hexdigest()
+
+def frame_key(df):
+    """Returns a key part for the contents of a frame, for stages built from other frames rather than from files.
+    None for a missing frame
+    """
+    if(df is None):
+        return None
+    h = hashlib.sha256(json.dumps([[str(c) for c in df.columns],[str(t) for t in df.dtypes]]).encode('utf-8'))
+    h.update(pd.util.hash_pandas_object(df,index=True).to_numpy().tobytes())
+    return h.hexdigest()
+
+def frame_survives_parquet(df, fp):
+    try:
+        df.to_parquet(fp)
+        return pd.read_parquet(fp).equals(df)
+    except Exception:
+        return False
+
+class SnapshotStore:
+    def __init__(self, cache_dir, enabled = True):
+        """
+        Args:
+            cache_dir: directory to store frames in, usually <snapshot dir>/ftypes.SNAPSHOT_CACHE_DIR
+            enabled: if false, nothing is read or written and every frame is rebuilt
+        """
+        self.frames_dir = os.path.join(cache_dir,FRAMES_SUBDIR)
+        self.enabled = enabled
+
+    def get_path(self, stage, key, ext):
+        return os.path.join(self.frames_dir,f"{stage}.{key[:32]}{ext}")
+
+    def load(self, stage, key):
+        """Returns (True,frame) if the frame for stage and key is stored, otherwise (False,None)"""
+        if(memory_frames is not None):
+            (mem_key,mem_df) = memory_frames.get((self.frames_dir,stage),(None,None))
+            if(mem_key == key):
+                return True,copy_frame(mem_df)
+
+        for ext in [PARQUET_EXT,PICKLE_EXT,NONE_EXT]:
+            fp = self.get_path(stage,key,ext)
+            if(not os.path.exists(fp)):
+                continue
+            try:
+                if(ext == PARQUET_EXT):
+                    df = pd.read_parquet(fp)
+                elif(ext == PICKLE_EXT):
+                    with open(fp,'rb') as f:
+                        df = pickle.load(f)
+                else:
+                    df = None
+                self.remember(stage,key,df)
+                return True,df
+            except Exception as e:
+                util.warn(f"Ignoring unreadable stored frame {fp}: {e}")
+
+        return False,None
+
+    def remember(self, stage, key, df):
+        if(memory_frames is not None):
+            memory_frames[(self.frames_dir,stage)] = (key,copy_frame(df))
+
+    def save(self, stage, key, df):
+        self.remember(stage,key,df)
+        try:
+            os.makedirs(self.frames_dir,exist_ok=True)
+
+            #only one version of each stage is kept
+            for old_fp in glob.glob(os.path.join(glob.escape(self.frames_dir),f"{glob.escape(stage)}.*")):
+                os.remove(old_fp)
+
+            if(df is None):
+                open(self.get_path(stage,key,NONE_EXT),'wb').close()
+                return
+
+            tmp_fp = self.get_path(stage,key,f".{os.getpid()}.tmp")
+            if(frame_survives_parquet(df,tmp_fp)):
+                os.replace(tmp_fp,self.get_path(stage,key,PARQUET_EXT))
+            else:
+                with open(tmp_fp,'wb') as f:
+                    pickle.dump(df,f,protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_fp,self.get_path(stage,key,PICKLE_EXT))
+        except OSError as e:
+            util.warn(f"Could not store frame {stage}: {e}")
+
+    def get_or_build(self, stage, key, build_fn, save_fn = None):
+        """Returns the stored frame for stage and key, or calls build_fn() to build it and stores the result.
+        The result may be None.
+
+        Args:
+            save_fn: optional fn() returning whether a frame that was just built should be stored, ex. not if it was
+                built from downloads that failed, so it is built again next time
+        """
+        if(not self.enabled):
+            return build_fn()
+
+        found,df = self.load(stage,key)
+        if(found):
+            return df
+
+        df = build_fn()
+        if(save_fn is None or save_fn()):
+            self.save(stage,key,df)
+
+        return df
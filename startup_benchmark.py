@@ -0,0 +1,83 @@
+"""Times how long the themetrack command line takes to start, and checks that its commands don't import slow modules
+they don't need before they run.
+
+By default themetrack.py is run with this python. With --exe, a frozen build is run instead, ex.
+dist\\themetrack\\themetrack.exe from scripts\\pyinstaller.bat. Which modules are imported can only be seen when not
+frozen, so only the times are checked then.
+
+Exits with 1 if a command takes longer than --max-secs to start, or imports one of SLOW_MODULES.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+#slow to import, and only needed once a command is running
+SLOW_MODULES = ['pandas','numpy','openpyxl','pyarrow','yfinance','yahooquery','bs4','browser_cookie3','fake_useragent','requests']
+
+#each one parses its arguments and exits, so only measures starting up
+STARTUP_COMMANDS = [
+    ['--help'],
+    ['create-snapshot','--help'],
+    ['download-capex','--help'],
+    ['create-reports','--help'],
+    ['create-history','--help'],
+]
+
+def get_imported_modules(cmd):
+    """Returns the top level names of the modules imported by running cmd, which must be a python command"""
+    res = subprocess.run(cmd[:1] + ['-X','importtime'] + cmd[1:],capture_output=True,text=True)
+    modules = set()
+    for line in res.stderr.splitlines():
+        #ex. "import time:       150 |      58895 |     openpyxl"
+        if(line.startswith('import time:') and '|' in line):
+            name = line.rsplit('|',1)[1].strip()
+            modules.add(name.split('.')[0])
+    return modules
+
+def time_command(cmd, runs):
+    """Returns the median number of seconds cmd takes to run"""
+    times = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        subprocess.run(cmd,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL,check=True)
+        times.append(time.perf_counter() - start_time)
+    return statistics.median(times)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="times how long the themetrack commands take to start, and checks they don't import slow modules",
+        exit_on_error=True,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--exe", type=str, help="frozen themetrack build to run, instead of themetrack.py")
+    parser.add_argument("--runs", type=int, default=5, help="times to run each command, the median time is used")
+    parser.add_argument("--max-secs", type=float, default=1.0, help="longest a command may take to start")
+
+    args = parser.parse_args()
+
+    if(args.exe is None):
+        base_cmd = [sys.executable,os.path.join(os.path.dirname(os.path.abspath(__file__)),'themetrack.py')]
+    else:
+        base_cmd = [args.exe]
+
+    errors = []
+    for command in STARTUP_COMMANDS:
+        cmd = base_cmd + command
+        secs = time_command(cmd,args.runs)
+        print(f"{' '.join(command):30} {secs:.3f}s")
+        if(secs > args.max_secs):
+            errors.append(f"'{' '.join(command)}' took {secs:.3f}s to start, limit is {args.max_secs}s")
+
+        if(args.exe is None):
+            slow = sorted(get_imported_modules(cmd).intersection(SLOW_MODULES))
+            if(slow):
+                errors.append(f"'{' '.join(command)}' imports {', '.join(slow)}")
+
+    for e in errors:
+        print(e)
+    print("ok" if not errors else f"{len(errors)} errors")
+
+    sys.exit(1 if errors else 0)
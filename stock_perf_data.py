@@ -9,6 +9,9 @@ import util
 
 import history_stock_downloader
 
+#part of the key of the stored holdings history, bump this when calc_stock_history gives different results
+STOCK_HISTORY_VERSION = 1
+
 def calculate_start_date(duration_str, end_date):
     # Parse the duration string
     number = int(duration_str[:-1])
@@ -30,31 +33,43 @@ def calculate_start_date(duration_str, end_date):
     
     return start_date
 
-def to_datetime(d):
-    return datetime.combine(d, time.min)
+def to_datetime_index(index):
+    #to_datetime is slow even when there's nothing to convert
+    return index if isinstance(index,pd.DatetimeIndex) else pd.to_datetime(index)
+
+def get_bars_df(stock_hist_df):
+    """Puts the adjusted close of every symbol's history into a single frame, with 'symbol', 'date' and 'adjclose' columns"""
+    hists = [(symbol,ts) for symbol,ts in stock_hist_df.items() if ts is not None and not ts.empty]
 
+    bars_df = pd.DataFrame({
+        'symbol' : np.repeat(np.array([symbol for symbol,_ in hists],dtype=object),[len(ts) for _,ts in hists]),
+        'date' : np.concatenate([np.asarray(to_datetime_index(ts.index),dtype='datetime64[ns]') for _,ts in hists] + [np.array([],dtype='datetime64[ns]')]),
+        'adjclose' : np.concatenate([ts['adjclose'].to_numpy(dtype=float) for _,ts in hists] + [np.array([],dtype=float)]),
+    })
 
-def find_closest_date(index, target_date, max_days):
+    return bars_df.dropna(subset=['date'])
+
+def find_closest_bars(bars_df, symbols, target_date, max_days):
     """
-    Find the date in the index closest to target_date within max_days.
-    
+    Finds the bar of each symbol closest to target_date, within max_days. If two bars are equally close, the earlier
+    one is used.
+
     Parameters:
-    - index: DatetimeIndex of dates to search.
-    - target_date: Target date to find the closest match for.
-    - max_days: Maximum allowed difference in days (default is 5).
-    
+    - bars_df: frame of 'symbol', 'date', 'adjclose', see get_bars_df
+    - symbols: symbols to look up
+    - target_date: date to find the closest bar to
+    - max_days: maximum allowed difference in days
+
     Returns:
-    - Closest date if within max_days, otherwise None.
+    - frame indexed by symbol, with the 'date' and 'adjclose' of the closest bar, or NaT/NaN if there isn't one
     """
-    target_date = to_datetime(target_date)
-    start = to_datetime(target_date - pd.Timedelta(days=max_days))
-    end = to_datetime(target_date + pd.Timedelta(days=max_days))
-    candidates = index[(index >= start) & (index <= end)]
-    if candidates.empty:
-        return None
-    else:
-        diff = abs(candidates - target_date)
-        return candidates[diff.argmin()]
+    targets_df = pd.DataFrame({'symbol' : pd.Series(symbols,dtype=object), 'target_date' : pd.Timestamp(target_date)})
+    targets_df['target_date'] = targets_df['target_date'].astype('datetime64[ns]')
+
+    res = pd.merge_asof(targets_df, bars_df.sort_values('date',kind='stable'), left_on='target_date', right_on='date', by='symbol',
+                        direction='nearest', tolerance=pd.Timedelta(days=max_days))
+
+    return res.set_index('symbol')[['date','adjclose']]
 
 def add_stock_perf_data_to_holdings_df(holdings_df, stock_hist_df, end_date, periods, max_slippage_days):
     """
@@ -64,6 +79,9 @@ def add_stock_perf_data_to_holdings_df(holdings_df, stock_hist_df, end_date, per
             the date falls on the weekend or yahoo has no data for that date)
       - R:AdjCloseEndPrice<Period> the yahoo adjusted close start price, which is repriced for dividend gains  
       - R:PriceEndDate<Period> the date used for the end price (same restrictions apply as PriceStartDate)
+
+    The columns are always added, and are empty for holdings without price data for the period. Each symbol is
+    only looked up once, even if it's held in several accounts.
     
     Parameters:
     - end_date: End date for performance calculation (string or datetime).
@@ -74,56 +92,36 @@ def add_stock_perf_data_to_holdings_df(holdings_df, stock_hist_df, end_date, per
     Returns:
       updated df
     """
-
-    res_df = pd.DataFrame()
-
     # Convert end_date to datetime
     end_date = pd.to_datetime(end_date).date()
 
-    # Iterate over unique symbols in holdings_df
-    def update_holdings_row(row):
-        yahoo_symbol = row[ftypes.SpecialColumns.CYahooTicker.get_col_name()]
-        for period in periods:
-            
-            # Calculate start date by subtracting periodMonths
-            start_date = calculate_start_date(period, end_date)
-            
-            if yahoo_symbol in stock_hist_df:
-                # Get time series data for the symbol
-                ts = stock_hist_df[yahoo_symbol]
-                
-                # Find closest dates within slippage days
-                closest_start_date = find_closest_date(ts.index, start_date, max_slippage_days)
-                closest_end_date = find_closest_date(ts.index, end_date, max_slippage_days)
-                
-                if (closest_start_date is None or 
-                    closest_end_date is None or 
-                    closest_start_date >= closest_end_date):
-                    continue
-
-                # Retrieve adjusted close prices
-                adjclose_start_price = ts.loc[closest_start_date, 'adjclose']
-                adjclose_end_price = ts.loc[closest_end_date, 'adjclose']
-
-                row[f'{ftypes.ADJ_CLOSE_START_PRICE_PREFIX}{period}'] = adjclose_start_price
-                row[f'{ftypes.ADJ_CLOSE_END_PRICE_PREFIX}{period}'] = adjclose_end_price
-
-                row[f'{ftypes.PRICE_START_DATE_PREFIX}{period}'] = closest_start_date
-                row[f'{ftypes.PRICE_END_DATE_PREFIX}{period}'] = closest_end_date
-        
-        return row
-
-    holdings_df = holdings_df.apply(update_holdings_row,axis=1)
-
-    return holdings_df
-
-
-def calc_stock_history(cache_file,config,sub_dir_date,holdings_df):
-    """Updates holdings_df and returns the result"""
-    if(not config.hist_perf_periods):
-        print("Historical performance periods not defined, not calculating performance")
-        return
+    holding_symbols = holdings_df[ftypes.SpecialColumns.CYahooTicker.get_col_name()]
+    symbols = [s for s in holding_symbols.dropna().unique() if s in stock_hist_df]
+
+    bars_df = get_bars_df({ s : stock_hist_df[s] for s in symbols })
+    end_bars = find_closest_bars(bars_df, symbols, end_date, max_slippage_days)
 
+    new_cols = {}
+    for period in periods:
+        start_date = calculate_start_date(period, end_date)
+        start_bars = find_closest_bars(bars_df, symbols, start_date, max_slippage_days)
+
+        #both ends need a price, and the start has to come before the end
+        valid = start_bars['date'].notna() & end_bars['date'].notna() & (start_bars['date'] < end_bars['date'])
+
+        def to_holdings_col(symbol_vals, dtype):
+            return holding_symbols.map(symbol_vals[valid]).astype(dtype)
+
+        new_cols[f'{ftypes.ADJ_CLOSE_START_PRICE_PREFIX}{period}'] = to_holdings_col(start_bars['adjclose'],float)
+        new_cols[f'{ftypes.ADJ_CLOSE_END_PRICE_PREFIX}{period}'] = to_holdings_col(end_bars['adjclose'],float)
+        new_cols[f'{ftypes.PRICE_START_DATE_PREFIX}{period}'] = to_holdings_col(start_bars['date'],'datetime64[ns]')
+        new_cols[f'{ftypes.PRICE_END_DATE_PREFIX}{period}'] = to_holdings_col(end_bars['date'],'datetime64[ns]')
+
+    return holdings_df.assign(**new_cols)
+
+
+def get_min_start_date(config, sub_dir_date):
+    """Returns the earliest start date of config.hist_perf_periods, as 'YYYY-MM-DD'"""
     min_start_date = sub_dir_date
     for perf_period in config.hist_perf_periods:
         num_periods = int(perf_period[:-1])
@@ -133,12 +131,38 @@ def calc_stock_history(cache_file,config,sub_dir_date,holdings_df):
         if(start_date < min_start_date):
             min_start_date = start_date
 
+    return min_start_date
+
+def load_stock_history(price_store_file, config, sub_dir_date, symbols):
+    """Returns the prices calc_stock_history downloaded into price_store_file, as a dict of symbol to its price
+    history frame, or None if there is no data"""
+    store = history_stock_downloader.PriceStore(price_store_file)
+    try:
+        return store.load_prices(symbols,'1wk',get_min_start_date(config,sub_dir_date),sub_dir_date)
+    finally:
+        store.close()
+
+def calc_stock_history(price_store_file,config,sub_dir_date,holdings_df,shared_price_store_file=None):
+    """Updates holdings_df and returns the result, along with the symbols whose prices couldn't all be downloaded.
+    Those are downloaded again the next time this is called.
+
+    The prices used are kept in price_store_file. If shared_price_store_file is given, prices missing from
+    price_store_file are taken from there rather than downloaded directly, see download_stock_history
+    """
+    if(not config.hist_perf_periods):
+        print("Historical performance periods not defined, not calculating performance")
+        return holdings_df,[]
+
+    min_start_date = get_min_start_date(config,sub_dir_date)
+
     # get a unique set of tickers. Since there may be multiple brokerages, there could also be multiple holdings,
     # so we have to remove duplicates
     symbols = list(set(holdings_df[holdings_df[ftypes.SpecialColumns.CYahooTicker.get_col_name()].notna()]
                          [ftypes.SpecialColumns.CYahooTicker.get_col_name()].tolist()))
 
     stock_hist_df = history_stock_downloader.download_stock_history(symbols,min_start_date,sub_dir_date,'1wk',
-                                                                    cache_file,8)
+                                                                    price_store_file,8,shared_price_store_file)
     
-    return add_stock_perf_data_to_holdings_df(holdings_df, stock_hist_df, sub_dir_date, config.hist_perf_periods, config.hist_perf_slip_days)
+    unfetched_symbols = history_stock_downloader.get_unfetched_symbols(price_store_file,symbols,'1wk',min_start_date,sub_dir_date)
+
+    return add_stock_perf_data_to_holdings_df(holdings_df, stock_hist_df, sub_dir_date, config.hist_perf_periods, config.hist_perf_slip_days),unfetched_symbols
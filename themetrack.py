@@ -1,5 +1,10 @@
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 import datetime
-from functools import partial
+import logging
+import multiprocessing
 import os
 import argparse
 import pathlib
@@ -7,32 +12,39 @@ import re
 import shutil
 import subprocess
 import sys
+import time
 
-import urllib
-
-import numpy
-import yahoo_stock_lookup
 import util
-import capex_scraper
-import ib_parser
-import rules_parser
-import schwab_parser
-import pandas as pd
 import ftypes
-import reports
 import external
-import scraper_util
-import config_parser
 import array_log as al
-from currency_converter import CurrencyConverter
 import platform
 
-import history_stock_downloader
-import stock_perf_data
+#these are slow to import, and only some commands need them, so they're only imported when first used
+pd = util.lazy_import('pandas')
+capex_scraper = util.lazy_import('capex_scraper')
+ib_parser = util.lazy_import('ib_parser')
+rules_parser = util.lazy_import('rules_parser')
+schwab_parser = util.lazy_import('schwab_parser')
+schwab_events_parser = util.lazy_import('schwab_events_parser')
+reports = util.lazy_import('reports')
+scraper_util = util.lazy_import('scraper_util')
+config_parser = util.lazy_import('config_parser')
+forex = util.lazy_import('forex')
+stock_perf_data = util.lazy_import('stock_perf_data')
+returns = util.lazy_import('returns')
+snapshot_store = util.lazy_import('snapshot_store')
 
 CREATE_SNAPSHOT_COMMAND = 'create-snapshot'
 CREATE_REPORTS_COMMAND = 'create-reports'
 DOWNLOAD_CAPEX_COMMAND = 'download-capex'
+CREATE_HISTORY_COMMAND = 'create-history'
+
+HISTORY_REPORT_FILE = 'history_report.xlsx'
+
+#browsers download-capex can read the login cookies of
+CAPEX_BROWSERS = ["chrome","firefox","brave"]
+REPORT_OUT_FILE = 'report_out.xlsx'
 
 def get_files_with_ext(directory, ext):
     """Returns all files ending in given extension"""
@@ -72,14 +84,14 @@ def is_schwab_holdings_csv(filename : str):
                       
 def is_schwab_events_csv(filename : str):
     return re_matches(filename, 
-                      r"^Individual_XXX\d+_Tranasctions.*\.(?:csv|xlsx)$",
+                      r"^Individual_XXX\d+_Transactions.*\.(?:csv|xlsx)$",
                       r"^events_schwab.*\.(?:csv|xlsx)$")
                       
 
 def is_system_overrides_file(filename : str):
     return re.match(r"^system_overrides.*\.(?:csv|xlsx)$",filename.lower()) is not None
 
-def get_port_desc(rows,pick_types, pt_to_order_score):
+def get_port_desc(pick_types, pt_to_order_score):
     sorted_pick_types = sorted(pick_types,key=lambda pt: pt_to_order_score[pt])
 
     short_types = [ftypes.PICK_TYPE_TO_SHORT_NAME[pt] for pt in sorted_pick_types]
@@ -93,97 +105,281 @@ def pick_types_to_sort_order_key(pt_list, pt_to_order_score):
 
     return score
 
+def get_join_summary_for_bitmask(bitmask : int):
+    """Returns the derived columns of a joined row that only depend on the set of pick types
+    the holding matched (encoded as a D:JoinAllBitMask value)
+    """
+    pick_types = [pt for pt in ftypes.PickType if ftypes.bit_mask_has_pick_type(bitmask,pt)]
+
+    return {
+        ftypes.SpecialColumns.DCapexGainsPickTypeShortDesc.get_col_name() : get_port_desc(pick_types,ftypes.PICK_TYPE_TO_ORDER_CAP_GAINS),
+        ftypes.SpecialColumns.DDiviPickTypeShortDesc.get_col_name() : get_port_desc(pick_types,ftypes.PICK_TYPE_TO_ORDER_DIVI),
+        ftypes.SpecialColumns.DJoinAllBitMask.get_col_name() : bitmask,
+        ftypes.SpecialColumns.DCapexGainsPickTypeOrder.get_col_name() : pick_types_to_sort_order_key(pick_types,ftypes.PICK_TYPE_TO_ORDER_CAP_GAINS),
+        ftypes.SpecialColumns.DDiviPickTypeOrder.get_col_name() : pick_types_to_sort_order_key(pick_types,ftypes.PICK_TYPE_TO_ORDER_DIVI),
+    }
+
+def match_rows_by_match_columns(df : pd.DataFrame, other_df : pd.DataFrame, index_col, other_index_col, name, other_name):
+    """Finds every pair of rows of df and other_df that match according to the "C:MatchColumns" of the df row.
+
+    Rows are grouped by their C:MatchColumns value, so there is one keyed merge per distinct
+    value rather than one scan of other_df per row.
+
+    Args:
+        index_col, other_index_col: columns of df and other_df identifying their rows
+        name, other_name: what the rows of each are, for errors, ex. 'Holdings' and 'pick'
+
+    Returns:
+        pd.DataFrame: index_col and other_index_col columns, sorted by the row of df and then of other_df
+    """
+    pairs_list = [pd.DataFrame({index_col : pd.Series(dtype='int64'), other_index_col : pd.Series(dtype='int64')})]
+
+    #dropna=False so rows without a C:MatchColumns value aren't silently left out of the report
+    for mc_value,h_group in df.groupby(ftypes.SpecialColumns.CMatchColumns.get_col_name(),sort=False,dropna=False):
+        #this should never be None because it was checked when the file was parsed
+        mc = None if pd.isna(mc_value) else rules_parser.parse_match_columns(mc_value)
+        if(mc is None):
+            util.error(f"{name} at rows {','.join(str(i) for i in h_group[index_col])} have a "
+                       f"{ftypes.SpecialColumns.CMatchColumns.get_col_name()} of '{mc_value}', which isn't valid")
+        h_mc,p_mc = mc
+
+        missing_other_columns = [c for c in p_mc if c not in other_df.columns]
+        if(missing_other_columns):
+            util.error(f"{ftypes.SpecialColumns.CMatchColumns.get_col_name()} '{mc_value}' uses {','.join(missing_other_columns)}, "
+                       f"which isn't a column of any {other_name}")
+
+        #a row without one of its match columns can't match anything
+        if(any(c not in h_group.columns for c in h_mc)):
+            continue
+
+        #keys are compared as python objects, same as '==' would do. Empty values never match
+        key_names = [f'key{i}' for i in range(len(h_mc))]
+        h_keys = pd.DataFrame({ k : h_group[c].astype(object) for k,c in zip(key_names,h_mc)})
+        h_keys[index_col] = h_group[index_col]
+        p_keys = pd.DataFrame({ k : other_df[c].astype(object) for k,c in zip(key_names,p_mc)})
+        p_keys[other_index_col] = other_df[other_index_col]
+
+        pairs_list.append(pd.merge(h_keys.dropna(subset=key_names),p_keys.dropna(subset=key_names),
+                                   on=key_names,how='inner')[[index_col,other_index_col]])
+
+    pairs = pd.concat(pairs_list,ignore_index=True)
+    pairs.sort_values(by=[index_col,other_index_col],inplace=True,kind='stable')
+
+    return pairs.reset_index(drop=True)
+
+def match_holdings_to_picks(holdings_df : pd.DataFrame, picks_df : pd.DataFrame):
+    """Finds every (holding, pick) pair that match according to the "C:MatchColumns" of the holding.
+
+    Returns:
+        pd.DataFrame: 'holdings_index' and 'picks_index' columns, sorted by holding and then pick
+    """
+    return match_rows_by_match_columns(holdings_df,picks_df,'holdings_index','picks_index','Holdings','pick')
+
+def get_top_priority_join_rows(joined_df : pd.DataFrame, priority : dict):
+    """Returns the highest priority joined row for each holding according to the pick type priority dict
+    (ex. ftypes.PICK_TYPE_TO_CAPGAINS_PRIORITY), indexed by the holding index. Ties go to the first pick.
+    """
+    pick_type_priority = joined_df[ftypes.SpecialColumns.RPickType.get_col_name()].map({ k.name : v for k,v in priority.items()})
+
+    order = pd.DataFrame({'holdings_index' : joined_df['holdings_index'], 'priority' : pick_type_priority,
+                          'picks_index' : joined_df['picks_index']})
+    order.sort_values(by=['holdings_index','priority','picks_index'],kind='stable',na_position='last',inplace=True)
+
+    top_rows = joined_df.loc[order.drop_duplicates('holdings_index').index]
+
+    return top_rows.set_index('holdings_index',drop=False)
+
+def get_columns_in_first_seen_order(columns_lists):
+    res = {}
+    for columns in columns_lists:
+        res.update(dict.fromkeys(columns))
+    return list(res)
+
+def add_join_index_columns(holdings_df : pd.DataFrame, picks_df : pd.DataFrame):
+    """Adds the original row numbers of holdings and picks as columns. These are carried through the join, and
+    also show up in the input data sheets of the report"""
+    holdings_df['holdings_index'] = holdings_df.index
+    picks_df['picks_index'] = picks_df.index
+
 def join_holdings_and_picks(holdings_df : pd.DataFrame, picks_df : pd.DataFrame):
     """Returns the cartesian product of holdings and picks using "RMatchColumns" in each
     holding row to join them.
 
+    Each holding produces exactly one row. D:JoinResult is '1:1' if it matched a single pick, 'Many' if it matched
+    several, in which case the data of the highest priority divi pick is overlaid with the data of the highest
+    priority capex pick, or 'None' if it matched nothing. Picks that no holding matched are added afterwards,
+    with a D:JoinResult of 'None'.
+
     Returns:
         pd.DataFrame: cartesian product
     """
+    join_result_col = ftypes.SpecialColumns.DJoinResult.get_col_name()
 
-    # Set indices to preserve original row numbers
-    holdings_df['holdings_index'] = holdings_df.index
-    picks_df['picks_index'] = picks_df.index
+    add_join_index_columns(holdings_df,picks_df)
 
-    res = []
+    pairs = match_holdings_to_picks(holdings_df,picks_df)
 
-    joined_pick_row_indexes = {}
+    num_matches = pairs.groupby('holdings_index').size().reindex(holdings_df.index,fill_value=0)
 
-    #PERF this is very slow, but we can speed it up later, by matching multiple holdings at a time 
-    # that have the same MatchColumns value
-    for hi,h in holdings_df.iterrows():
-        #this should never be None because it was checked when the file was parsed
-        h_mc,p_mc = rules_parser.parse_match_columns(h[ftypes.SpecialColumns.CMatchColumns.get_col_name()])
+    #build a row for every matching pair, which is the pick with the holding's data written over it
+    pick_rows = picks_df.loc[pairs['picks_index'],[c for c in picks_df.columns if c not in holdings_df.columns]]
+    holding_rows = holdings_df.loc[pairs['holdings_index']]
+    joined_df = pd.concat([pick_rows.reset_index(drop=True),holding_rows.reset_index(drop=True)],axis=1)
+    joined_df = joined_df[get_columns_in_first_seen_order([picks_df.columns,holdings_df.columns])]
+    joined_df['picks_index'] = pairs['picks_index'].values
 
-        #match against the picks
-                
-        # Construct the boolean mask dynamically
-        mask = pd.Series(True, index=picks_df.index)  # Start with all True
-        for h_column,p_column in zip(h_mc,p_mc):
-            value = util.get_df_row_val(h,h_column) 
-            mask &= (picks_df[p_column] == value)  # Update mask to narrow down the rows
+    one_df = joined_df[joined_df['holdings_index'].map(num_matches) == 1].set_index('holdings_index',drop=False)
+    one_df[join_result_col] = '1:1'
 
-        filtered_picks_df = picks_df[mask]
-        
-        for pick_row in filtered_picks_df:
-            joined_pick_row_indexes[pick_row.index] = True
+    many_joined_df = joined_df[joined_df['holdings_index'].map(num_matches) > 1]
+    capex_top_df = get_top_priority_join_rows(many_joined_df,ftypes.PICK_TYPE_TO_CAPGAINS_PRIORITY)
+    divi_top_df = get_top_priority_join_rows(many_joined_df,ftypes.PICK_TYPE_TO_DIVI_PRIORITY).loc[capex_top_df.index]
 
-        joined_rows = filtered_picks_df.assign(**h)
+    #TODO 3.5 this is sort of a hack. We are taking the data from the highest priority capex row and adding the data from
+    #the highest priority divi row. This is because we want the sector from the divi pick and the theme from the 
+    #capex pick. So if a row matches both capex and divi, we need both capex and divi data to display the report properly
+    many_df = capex_top_df.where(capex_top_df.notna(),divi_top_df)
+    many_df[join_result_col] = 'Many'
 
-        num_joined_rows = len(joined_rows)
-        if(num_joined_rows == 0):
-            res.append(holdings_df.loc[hi].to_dict())
-            res[-1][ftypes.SpecialColumns.DJoinResult.get_col_name()] = 'None'
-        elif(num_joined_rows >= 1):
+    #the pick type columns only depend on the set of pick types each holding matched, so we compute them per bitmask
+    pick_type_flags = joined_df[ftypes.SpecialColumns.RPickType.get_col_name()].map(
+        { pt.name : flag for pt,flag in ftypes.PICK_TYPE_TO_BIT_FLAG.items()}).fillna(0).astype(int)
+    bitmasks = (pd.DataFrame({'holdings_index' : joined_df['holdings_index'], 'flag' : pick_type_flags})
+                .drop_duplicates().groupby('holdings_index')['flag'].sum())
+    summary_df = pd.DataFrame([get_join_summary_for_bitmask(bm) for bm in bitmasks.unique()],
+                              columns=list(get_join_summary_for_bitmask(0).keys()))
+    summary_df = summary_df.set_index(ftypes.SpecialColumns.DJoinAllBitMask.get_col_name(),drop=False)
 
-            if(num_joined_rows == 1):
-                res.append(joined_rows.iloc[0].to_dict())
-                res[-1][ftypes.SpecialColumns.DJoinResult.get_col_name()] = '1:1'
+    matched_df = pd.concat([one_df,many_df])
+    matched_summary_df = summary_df.loc[bitmasks.loc[matched_df.index]]
+    matched_summary_df.index = matched_df.index
+    matched_df = pd.concat([matched_df,matched_summary_df],axis=1)
 
-            elif(num_joined_rows > 1):
-                def sort_by_priority(priority,series):
-                    pn_dict = { k.name : v for k,v in priority.items()}
-                    return series.map(pn_dict)            
-                
-                sorted_capex_join_rows = joined_rows.sort_values(by=ftypes.SpecialColumns.RPickType.get_col_name(),
-                                                                key=partial(sort_by_priority,ftypes.PICK_TYPE_TO_CAPGAINS_PRIORITY))
-                sorted_divi_join_rows = joined_rows.sort_values(by=ftypes.SpecialColumns.RPickType.get_col_name(),
-                                                                key=partial(sort_by_priority,ftypes.PICK_TYPE_TO_DIVI_PRIORITY))
+    none_df = holdings_df[num_matches == 0].copy()
+    none_df[join_result_col] = 'None'
 
-                #TODO 3.5 this is sort of a hack. We are taking the data from the highest priority capex row and adding the data from
-                #the highest priority divi row. This is because we want the sector from the divi pick and the theme from the 
-                #capex pick. So if a row matches both capex and divi, we need both capex and divi data to display the report properly
-                join_data = util.filter_nan_from_dict(sorted_divi_join_rows.iloc[0].to_dict()) | util.filter_nan_from_dict(sorted_capex_join_rows.iloc[0].to_dict()) 
+    holdings_res_df = pd.concat([none_df,matched_df]).loc[holdings_df.index]
 
-                res.append(join_data)
-                res[-1][ftypes.SpecialColumns.DJoinResult.get_col_name()] = 'Many'
+    #add any empty picks with no investments
+    empty_picks_df = picks_df[~picks_df.index.isin(pairs['picks_index'])].copy()
+    empty_picks_df[join_result_col] = 'None'
 
-            pick_types = list(set([ftypes.PickType[r[ftypes.SpecialColumns.RPickType.get_col_name()]] 
-                                            for _,r in joined_rows.iterrows()]))
+    res_pd = pd.concat([holdings_res_df,empty_picks_df],ignore_index=True)
 
-            res[-1][ftypes.SpecialColumns.DCapexGainsPickTypeShortDesc.get_col_name()] = get_port_desc(sorted_capex_join_rows,pick_types,ftypes.PICK_TYPE_TO_ORDER_CAP_GAINS)
-            res[-1][ftypes.SpecialColumns.DDiviPickTypeShortDesc.get_col_name()] = get_port_desc(sorted_divi_join_rows,pick_types,ftypes.PICK_TYPE_TO_ORDER_DIVI)
+    #keep the columns in the order they first show up, going down the rows
+    matched_columns = list(joined_df.columns) + [join_result_col] + list(summary_df.columns)
+    row_columns = { 0 : list(holdings_df.columns) + [join_result_col], 1 : matched_columns, 2 : matched_columns}
+    columns_lists = [row_columns[min(n,2)] for n in num_matches.drop_duplicates()]
+    columns_lists.append(list(picks_df.columns) + [join_result_col])
 
-            res[-1][ftypes.SpecialColumns.DJoinAllBitMask.get_col_name()] = ftypes.pick_types_to_bitmask(pick_types)
-            res[-1][ftypes.SpecialColumns.DCapexGainsPickTypeOrder.get_col_name()] = pick_types_to_sort_order_key(pick_types,ftypes.PICK_TYPE_TO_ORDER_CAP_GAINS)
-            res[-1][ftypes.SpecialColumns.DDiviPickTypeOrder.get_col_name()] = pick_types_to_sort_order_key(pick_types,ftypes.PICK_TYPE_TO_ORDER_DIVI)
+    return res_pd[get_columns_in_first_seen_order(columns_lists)]
 
-            res[-1][ftypes.SpecialColumns.DJoinAllBitMask.get_col_name()] = (
-                ftypes.pick_types_to_bitmask(pick_types)
-            )
 
-    #add any empty picks with no investments
-    for pi in picks_df.index:
-        if(pi in joined_pick_row_indexes):
-            continue
+def get_schwab_return_events(events_df, symbol_col, keep_columns):
+    return schwab_events_parser.get_return_events(events_df,symbol_col,keep_columns)
+
+#converts the rule processed events of a brokerage into an events frame for returns.calc_returns,
+#fn(events_df, symbol_col, keep_columns) -> df
+BROKERAGE_TO_RETURN_EVENTS_FN = {
+    ftypes.BrokerageTypes.Schwab.name : get_schwab_return_events,
+}
+
+def get_report_cat_columns(config : ftypes.Config):
+    return list(dict.fromkeys(report_config.cat_column for report_config in config.reports))
+
+def get_return_events_df(events_df : pd.DataFrame, res_pd : pd.DataFrame, cat_columns):
+    """Keys the rule processed events to the holdings they're for, using the "C:MatchColumns" of each event, and
+    converts them to an events frame for returns.calc_returns.
+
+    Each event gets the C:YahooTicker of the first holding it matches as its symbol, along with that holding's
+    'holdings_index' and category in each of cat_columns (ex. R:Theme). Events that match no holding, such as
+    those of positions sold before the snapshot, and events of brokerages without a BROKERAGE_TO_RETURN_EVENTS_FN
+    are left out.
+
+    Returns:
+        pd.DataFrame: returns.EVENT_COLUMNS, followed by D:Brokerage, D:AcctName, 'holdings_index' and cat_columns
+    """
+    mc_col = ftypes.SpecialColumns.CMatchColumns.get_col_name()
+    ticker_col = ftypes.SpecialColumns.CYahooTicker.get_col_name()
+    brokerage_col = ftypes.SpecialColumns.DBrokerage.get_col_name()
+    cat_columns = [c for c in cat_columns if c in res_pd.columns]
+    keep_columns = [brokerage_col,ftypes.SpecialColumns.DAcctName.get_col_name(),'holdings_index'] + cat_columns
+
+    res = pd.DataFrame({ c : pd.Series(dtype=object) for c in returns.EVENT_COLUMNS + keep_columns})
 
-        res.append(picks_df.loc[pi].to_dict())
-        res[-1][ftypes.SpecialColumns.DJoinResult.get_col_name()] = 'None'
+    if(mc_col not in events_df.columns):
+        util.warn(f"No events have a {mc_col}, so they can't be matched to holdings to calculate returns")
+        return res
 
-    res_pd = pd.DataFrame(res)
+    events_df = events_df[events_df[brokerage_col].isin(BROKERAGE_TO_RETURN_EVENTS_FN.keys())].copy()
+    events_df['events_index'] = events_df.index
 
-    return res_pd
+    no_mc = events_df[mc_col].isna()
+    if(no_mc.any()):
+        util.warn(f"Events at rows {','.join(str(i) for i in events_df.index[no_mc])} have no {mc_col}, so they "
+                  "can't be matched to holdings to calculate returns")
+        events_df = events_df[~no_mc]
 
+    holdings_df = res_pd[res_pd['holdings_index'].notna()]
+    pairs = match_rows_by_match_columns(events_df,holdings_df,'events_index','holdings_index','Events','holding')
+    pairs = pairs.drop_duplicates('events_index')
+
+    #the holding's data is written over the event's
+    holding_rows = holdings_df.set_index('holdings_index',drop=False).loc[pairs['holdings_index'],[ticker_col,'holdings_index'] + cat_columns]
+    matched_df = events_df.loc[pairs['events_index']].assign(**{ c : holding_rows[c].to_numpy() for c in holding_rows.columns })
+
+    matched_df['holdings_index'] = matched_df['holdings_index'].astype('int64')
+
+    return pd.concat([fn(matched_df[matched_df[brokerage_col] == brokerage],ticker_col,keep_columns)
+                      for brokerage,fn in BROKERAGE_TO_RETURN_EVENTS_FN.items()],ignore_index=True)
+
+#columns of the frame returned by calc_returns_df, before the return columns
+RETURNS_GROUP_COLUMN = 'group_column'
+RETURNS_GROUP = 'group'
+
+def calc_returns_df(return_events_df : pd.DataFrame, res_pd : pd.DataFrame, config : ftypes.Config, price_store_file,
+                    snapshot_datestr, cat_columns):
+    """Calculates the TWR and MWR over config.hist_perf_periods of each held symbol, and of each category in
+    cat_columns, from the events returned by get_return_events_df. See returns.calc_returns.
+
+    Only holdings of brokerages that have events are included, since the returns of the others would be missing
+    their trades and dividends. Shares held since before the first event are worked out from their quantities.
+
+    Returns:
+        pd.DataFrame: RETURNS_GROUP_COLUMN and RETURNS_GROUP, followed by the columns of returns.calc_period_returns.
+        RETURNS_GROUP_COLUMN is C:YahooTicker for the returns of a symbol, or the category column for those of a category
+    """
+    ticker_col = ftypes.SpecialColumns.CYahooTicker.get_col_name()
+    brokerage_col = ftypes.SpecialColumns.DBrokerage.get_col_name()
+
+    holdings_df = res_pd[res_pd['holdings_index'].notna() & res_pd[ticker_col].notna() &
+                         res_pd[brokerage_col].isin(return_events_df[brokerage_col].unique())]
+    end_quantities = pd.Series(pd.to_numeric(holdings_df[ftypes.SpecialColumns.RQuantity.get_col_name()],errors='coerce').to_numpy(),
+                               index=holdings_df[ticker_col].to_numpy()).groupby(level=0).sum()
+    symbols = list(dict.fromkeys(list(end_quantities.index) + list(return_events_df[returns.EVENT_SYMBOL_COL].dropna())))
+
+    stock_hist = stock_perf_data.load_stock_history(price_store_file,config,snapshot_datestr,symbols)
+
+    def to_group_rows(group_returns, group_column):
+        group_returns = group_returns.rename_axis(RETURNS_GROUP).reset_index()
+        group_returns.insert(0,RETURNS_GROUP_COLUMN,group_column)
+        return group_returns
+
+    #the symbols of each category are the same for every category column, so the position returns are too
+    symbol_holdings = holdings_df.drop_duplicates(ticker_col).set_index(ticker_col)
+    res_list = []
+    for cat_column in [c for c in cat_columns if c in res_pd.columns]:
+        symbol_groups = symbol_holdings[cat_column].fillna(reports.NA_STR_NAME)
+        position_returns,group_returns = returns.calc_returns(return_events_df,stock_hist,snapshot_datestr,config.hist_perf_periods,
+                                                              end_quantities,symbol_groups)
+        if(not res_list):
+            res_list.append(to_group_rows(position_returns,ticker_col))
+        res_list.append(to_group_rows(group_returns,cat_column))
+
+    if(not res_list):
+        return pd.DataFrame(columns=[RETURNS_GROUP_COLUMN,RETURNS_GROUP])
+
+    return pd.concat(res_list,ignore_index=True)
 
 def get_main_dir():
     if os.name == 'nt':  # Windows
@@ -218,18 +414,17 @@ def get_dirs_latest_first(dirname):
 
     return sorted_subdirs
 
-def get_latest_valid_snapshot_dir(main_dir):
-    valid_dir = None
+def get_valid_snapshot_dirs(main_dir):
+    """Returns the snapshot dirs in main_dir, which are the ones with a config file, latest first"""
+    if(not os.path.exists(main_dir)):
+        return []
 
-    #search latest previous snapshots first
-    if(os.path.exists(main_dir)):
-        for d in get_dirs_latest_first(main_dir):
-            d2 = os.path.join(d,ftypes.THEME_TRACK_CONFIG_FILE)
-            if(os.path.exists(d2)):
-                valid_dir = d
-                break
+    return [d for d in get_dirs_latest_first(main_dir) if os.path.exists(os.path.join(d,ftypes.THEME_TRACK_CONFIG_FILE))]
+
+def get_latest_valid_snapshot_dir(main_dir):
+    valid_dirs = get_valid_snapshot_dirs(main_dir)
 
-    return valid_dir        
+    return valid_dirs[0] if valid_dirs else None
     
 def get_sub_dir_from_config(args):
     if(args.sub_dir is None):
@@ -276,7 +471,17 @@ def create_snapshot(args):
             print("Opening a gui window to output directory")
             external.open_dir(dest_dir)
 
-    urllib.request.urlretrieve(ftypes.FOREX_URL, os.path.join(dest_dir,ftypes.FOREX_FILENAME))
+    #the rates are kept for all snapshots in the main dir, and the snapshot records the date of the ones it uses.
+    #A snapshot keeps the rates it was created with, so running this again on it doesn't move it onto today's
+    forex_date_fp = os.path.join(dest_dir,ftypes.FOREX_DATE_FILENAME)
+    if(os.path.exists(forex_date_fp) or os.path.exists(os.path.join(dest_dir,ftypes.FOREX_FILENAME))):
+        print(f"Keeping the exchange rates {dest_dir} already uses")
+    else:
+        rate_date = forex.update_rate_store(os.path.join(args.main_dir,ftypes.FOREX_STORE_FILE),args.forex_timeout)
+        if(rate_date is not None):
+            with open(forex_date_fp,'w') as f:
+                f.write(rate_date)
+            print(f"Using exchange rates of {rate_date}")
 
     print("Done!")
 
@@ -284,14 +489,15 @@ def create_snapshot(args):
 1. Copy brokerage reports to {dest_dir}
 2. Login in capexinsider.com
 3. Run "(cmd) {DOWNLOAD_CAPEX_COMMAND} (browser)" to download capex files into the directory. Browser is the browser you logged in with and is
-   one of: {", ".join([x.name for x in scraper_util.Browser])}
+   one of: {", ".join(CAPEX_BROWSERS)}
 4. Edit {theme_track_config_dest} as necessary.
 5. Run "(cmd) {CREATE_REPORTS_COMMAND}" to create the final report. If you need to make changes, re-edit {ftypes.THEME_TRACK_CONFIG_FILE} and re-run this step
 """)
 
 def download_capex(args):
     sub_dir = get_sub_dir_from_config(args)
-    capex_scraper.read_capex_to_dir(scraper_util.name_to_browser[args.browser], sub_dir)
+    cache_file = None if args.no_cache else os.path.join(args.main_dir,ftypes.CAPEX_CACHE_FILE)
+    capex_scraper.read_capex_to_dir(scraper_util.name_to_browser[args.browser], sub_dir, args.workers, args.timeout, cache_file)
 
     print(f"""Done!
 If your brokerage files are already in {sub_dir}, run "(cmd) {CREATE_REPORTS_COMMAND}", otherwise download them,
@@ -315,30 +521,184 @@ def move_columns_to_front(df, columns_to_front):
     # Return the reordered DataFrame
     return df[new_order]
 
-def fill_in_forex(df, data_dir,config : ftypes.Config):
-    
-    converter = CurrencyConverter(currency_file=os.path.join(data_dir,ftypes.FOREX_FILENAME),fallback_on_missing_rate=True,fallback_on_wrong_date=True)
+def get_snapshot_forex_key(sub_dir):
+    """Returns a key part for the exchange rates a snapshot uses, see load_snapshot_rate_table"""
+    return [snapshot_store.file_key(os.path.join(sub_dir,f)) for f in [ftypes.FOREX_FILENAME,ftypes.FOREX_DATE_FILENAME]]
 
-    def update_native_currency(row):
-        curr_from = row[ftypes.SpecialColumns.RCurrValueCurrency.get_col_name()]
-        amt_from = row[ftypes.SpecialColumns.RCurrValueForeign.get_col_name()]
+def load_snapshot_rate_table(sub_dir, main_dir):
+    """Returns the exchange rates a snapshot uses. Older snapshots have their own copy of the rates, and newer ones
+    the date of the latest rates from the main dir's forex store they use
+    """
+    forex_file = os.path.join(sub_dir,ftypes.FOREX_FILENAME)
+    if(os.path.exists(forex_file)):
+        return forex.read_rate_table(forex_file)
 
-        if(pd.isna(curr_from) or pd.isna(amt_from)):
-            return None
-        
-        amt_to = converter.convert(amt_from,curr_from,config.currency)
+    forex_date_file = os.path.join(sub_dir,ftypes.FOREX_DATE_FILENAME)
+    store_file = os.path.join(main_dir,ftypes.FOREX_STORE_FILE)
+    if(not os.path.exists(forex_date_file) or not os.path.exists(store_file)):
+        util.error(f"There are no exchange rates for {sub_dir}. Please run (cmd) {CREATE_SNAPSHOT_COMMAND} --sub-dir {os.path.basename(sub_dir)} "
+                   "while online")
 
-        return amt_to
+    with open(forex_date_file) as f:
+        rate_date = f.read().strip()
 
-    df[ftypes.SpecialColumns.RCurrValue.get_col_name()] = df.apply(update_native_currency,axis=1)
+    return forex.load_store_rate_table(store_file,rate_date)
+
+def fill_in_forex(df, rate_table : forex.RateTable, config : ftypes.Config):
+    dates = None
+    if(config.forex_date == ftypes.ForexDateTypes.RefreshedDate and ftypes.SpecialColumns.DRefreshedDate.get_col_name() in df.columns):
+        dates = df[ftypes.SpecialColumns.DRefreshedDate.get_col_name()]
+
+    df[ftypes.SpecialColumns.RCurrValue.get_col_name()] = forex.convert(rate_table,df[ftypes.SpecialColumns.RCurrValueForeign.get_col_name()],
+                                                                       df[ftypes.SpecialColumns.RCurrValueCurrency.get_col_name()],
+                                                                       config.currency,dates)
     
 
 
-def build_result_df(sub_dir, snapshot_datestr, rules_log):
-    """"""
+def parse_capex_file(item_path, snapshot_datestr):
+    table_json_data = open(item_path,"rb").read()
+    return capex_scraper.convert_capex_portfolio_data_to_pandas(item_path, table_json_data)
+
+def parse_ib_activity_report_file(item_path, snapshot_datestr):
+    return ib_parser.parse_holding_activity(item_path)
+
+def parse_schwab_holdings_file(item_path, snapshot_datestr):
+    return schwab_parser.parse_file(item_path, snapshot_datestr)
+
+def parse_schwab_events_file(item_path, snapshot_datestr):
+    return schwab_events_parser.parse_file(item_path, snapshot_datestr)
+
+@dataclass
+class InputFileType:
+    is_type_fn : callable # fn(filename) -> bool
+    data_type : ftypes.DataTypes
+    parse_fn : callable # fn(item_path, snapshot_datestr) -> df or None. Must be picklable, since it's run in worker processes
+    uses_snapshot_date : bool # whether the parse depends on the snapshot date, which is then part of its cache key
+    parse_version : int = 1 # part of its cache key, bump this when parse_fn's output changes so stored frames are rebuilt
+
+INPUT_FILE_TYPES = [
+    InputFileType(is_capex_json, ftypes.DataTypes.Pick, parse_capex_file, False),
+    InputFileType(is_ib_activity_report_csv, ftypes.DataTypes.Holding, parse_ib_activity_report_file, False),
+    InputFileType(is_schwab_holdings_csv, ftypes.DataTypes.Holding, parse_schwab_holdings_file, True),
+    InputFileType(is_schwab_events_csv, ftypes.DataTypes.Event, parse_schwab_events_file, False),
+]
+
+def get_input_file_type(item):
+    for ft in INPUT_FILE_TYPES:
+        if(ft.is_type_fn(item)):
+            return ft
+    return None
+
+class ListLogHandler(logging.Handler):
+    """Keeps the log records it's given, so they can be sent to another process"""
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        #the args may not be picklable, so the message is formatted here
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+def run_in_worker_keeping_logs(fn, *args):
+    """Runs fn in a worker process, keeping what it logs rather than printing it, so the parent can print
+    the logs of each job in the order the jobs were given.
+
+    Returns:
+        (result of fn, log records). If fn fails, the records are attached to the exception as log_records
+    """
+    root = logging.getLogger()
+    handler = ListLogHandler()
+    old_handlers = root.handlers
+    root.handlers = [handler]
+    try:
+        return fn(*args),handler.records
+    except Exception as e:
+        e.log_records = handler.records
+        raise
+    finally:
+        root.handlers = old_handlers
+
+def replay_log_records(records):
+    for record in records:
+        logging.getLogger(record.name).handle(record)
+
+def parse_input_files(store, inputs, snapshot_datestr, workers):
+    """Parses the input files of a snapshot, in a process pool if more than one isn't already stored.
+
+    Args:
+        inputs: list of (item, item_path, InputFileType, key)
+        workers: maximum number of worker processes, None for the number of cpus
+
+    Returns:
+        list of the parsed frames, in the same order as inputs. If any parse fails, the error of the first
+        failing input is raised. Warnings are printed in input order, and only up to that input
+    """
+    results = [None] * len(inputs)
+    to_parse = []
+    for i,(item,item_path,ft,key) in enumerate(inputs):
+        found,df = store.load(f"parsed-{item}",key) if store.enabled else (False,None)
+        if(found):
+            results[i] = df
+        else:
+            to_parse.append(i)
+
+    workers = min(workers or os.cpu_count() or 1,len(to_parse))
+    if(workers <= 1):
+        for i in to_parse:
+            (_,item_path,ft,_) = inputs[i]
+            results[i] = ft.parse_fn(item_path,snapshot_datestr)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_in_worker_keeping_logs,inputs[i][2].parse_fn,inputs[i][1],snapshot_datestr) for i in to_parse]
+            try:
+                for i,f in zip(to_parse,futures):
+                    (results[i],records) = f.result()
+                    replay_log_records(records)
+            except BaseException as e:
+                replay_log_records(getattr(e,'log_records',[]))
+                executor.shutdown(cancel_futures=True)
+                raise
+
+    if(store.enabled):
+        for i in to_parse:
+            (item,_,_,key) = inputs[i]
+            store.save(f"parsed-{item}",key,results[i])
+
+    return results
 
-    picks_df = pd.DataFrame()
-    holdings_df = pd.DataFrame()
+def build_result_df(sub_dir, snapshot_datestr, rules_log, rules_engine = 'compiled', use_cache = True, calc_perf = True,
+                    parse_workers = None):
+    """Parses the inputs in the snapshot dir, runs the rules over them, and joins holdings with picks.
+
+    Each stage's result is kept in the snapshot cache dir, keyed on what it was built from, so only the stages
+    affected by a changed input are rebuilt.
+
+    If calc_perf is false, the stock history isn't downloaded, the performance columns aren't added and returns_df
+    is empty.
+
+    The input files are parsed in up to parse_workers processes (None for the number of cpus), see parse_input_files.
+
+    Brokerage events files are optional. The rules are run over their events too, which are then keyed to the
+    holdings they're for, see get_return_events_df. events_df is empty if there are none. The returns of the
+    holdings and their categories are calculated from them, see calc_returns_df.
+
+    Returns:
+        config,picks_df,holdings_df,events_df,res_pd,returns_df
+    """
+    #snapshots are always directly inside the main dir
+    main_dir = os.path.dirname(os.path.abspath(sub_dir))
+    cache_dir = os.path.join(sub_dir,ftypes.SNAPSHOT_CACHE_DIR)
+    store = snapshot_store.SnapshotStore(cache_dir,enabled=use_cache)
+
+    picks_dfs = []
+    holdings_dfs = []
+    events_dfs = []
+    picks_keys = []
+    holdings_keys = []
+    events_keys = []
 
     user_rules = []
     config_file = None
@@ -346,32 +706,44 @@ def build_result_df(sub_dir, snapshot_datestr, rules_log):
     data_dir_files = os.listdir(sub_dir)
     data_dir_files.sort()
 
+    inputs = []
     for item in data_dir_files:
         item_path = os.path.join(sub_dir, item)
         if os.path.isfile(item_path):
-            if is_capex_json(item):
-                table_json_data = open(item_path,"rb").read()
-                df = capex_scraper.convert_capex_portfolio_data_to_pandas(item_path, table_json_data)
-                if(df is not None):
-                    picks_df = pd.concat([picks_df,df],ignore_index=True)
-            elif is_ib_activity_report_csv(item):
-                ib_df = ib_parser.parse_holding_activity(item_path)
-
-                holdings_df = pd.concat([holdings_df,ib_df],ignore_index=True)
-            elif is_schwab_holdings_csv(item):
-                schwab_df = schwab_parser.parse_file(item_path, snapshot_datestr)
-
-                holdings_df = pd.concat([holdings_df,schwab_df],ignore_index=True)
+            ft = get_input_file_type(item)
+            if ft is not None:
+                key_parts = [snapshot_datestr] if ft.uses_snapshot_date else []
+                inputs.append((item,item_path,ft,snapshot_store.make_key(item,ft.parse_version,snapshot_store.file_key(item_path),*key_parts)))
             elif item == ftypes.THEME_TRACK_CONFIG_FILE:
                 if(config_file is not None):
                     util.error(f"There can only be one config file, got {item_path} and {config_file}")
-                config,user_rules,system_rules = config_parser.parse_config_file(item_path)
+                if(use_cache):
+                    config,user_rules,system_rules = config_parser.parse_config_file_cached(item_path,cache_dir)
+                else:
+                    config,user_rules,system_rules = config_parser.parse_config_file(item_path)
                 config_file = item_path
             else:
                 util.warn(f"skipping file {item_path}, don't know how to handle")
-        else:
+        elif item != ftypes.SNAPSHOT_CACHE_DIR:
             util.warn(f"skipping dir {item_path}")
 
+    #concatenated once at the end, in file order
+    for (item,item_path,ft,key),df in zip(inputs,parse_input_files(store,inputs,snapshot_datestr,parse_workers)):
+        if(ft.data_type == ftypes.DataTypes.Pick):
+            if(df is not None):
+                picks_dfs.append(df)
+                picks_keys.append(key)
+        elif(ft.data_type == ftypes.DataTypes.Holding):
+            holdings_dfs.append(df)
+            holdings_keys.append(key)
+        else:
+            events_dfs.append(df)
+            events_keys.append(key)
+
+    picks_df = pd.concat([pd.DataFrame()] + picks_dfs,ignore_index=True)
+    holdings_df = pd.concat([pd.DataFrame()] + holdings_dfs,ignore_index=True)
+    events_df = pd.concat([pd.DataFrame()] + events_dfs,ignore_index=True)
+
     if(picks_df.empty):
         util.error(f"Capex files have not been downloaded, please run (cmd) {DOWNLOAD_CAPEX_COMMAND}")
     if(holdings_df.empty):
@@ -379,33 +751,81 @@ def build_result_df(sub_dir, snapshot_datestr, rules_log):
 
     holdings_df[ftypes.SpecialColumns.DDataType.get_col_name()] = ftypes.DataTypes.Holding.name
     picks_df[ftypes.SpecialColumns.DDataType.get_col_name()] = ftypes.DataTypes.Pick.name
+    if(not events_df.empty):
+        events_df[ftypes.SpecialColumns.DDataType.get_col_name()] = ftypes.DataTypes.Event.name
 
     if(config_file is None):
         util.error(f'There is no {ftypes.THEME_TRACK_CONFIG_FILE} in {sub_dir}. Please run (cmd) {CREATE_SNAPSHOT_COMMAND}')
 
-    with al.add_log_context(rules_log,{"df": "holdings"}):
-        holdings_df = rules_parser.run_rules(system_rules,user_rules,holdings_df,rules_log)
-    with al.add_log_context(rules_log,{"df": "picks"}):
-        picks_df = rules_parser.run_rules(system_rules,user_rules,picks_df,rules_log)
+    #when logging, the rules always have to be run, so the log gets written
+    rules_store = snapshot_store.SnapshotStore(cache_dir,enabled=(use_cache and not rules_parser.log_is_on(rules_log)))
+    rules_key = snapshot_store.make_key(rules_parser.RULES_VERSION,snapshot_store.object_key((system_rules,user_rules)))
+
+    def run_rules(df, df_name):
+        with al.add_log_context(rules_log,{"df": df_name}):
+            return rules_parser.run_rules_with_engine(rules_engine,system_rules,user_rules,df,rules_log)
+
+    holdings_rules_key = snapshot_store.make_key(holdings_keys,rules_key)
+    holdings_df = rules_store.get_or_build("holdings-rules",holdings_rules_key,lambda : run_rules(holdings_df,"holdings"))
+    picks_rules_key = snapshot_store.make_key(picks_keys,rules_key)
+    picks_df = rules_store.get_or_build("picks-rules",picks_rules_key,lambda : run_rules(picks_df,"picks"))
+    if(not events_df.empty):
+        events_rules_key = snapshot_store.make_key(events_keys,rules_key)
+        events_df = rules_store.get_or_build("events-rules",events_rules_key,lambda : run_rules(events_df,"events"))
+
+    if(calc_perf):
+        holdings_history_key = snapshot_store.make_key(holdings_rules_key,stock_perf_data.STOCK_HISTORY_VERSION,snapshot_datestr,
+                                                       config.hist_perf_periods,config.hist_perf_slip_days,
+                                                       snapshot_store.file_key(os.path.join(sub_dir,ftypes.SNAPSHOT_STOCK_PRICES_FILE)))
+        #the prices file is hashed before downloading, so a frame built while some prices couldn't be downloaded
+        #isn't stored. Otherwise the next run would get the same key, and never try those prices again
+        unfetched_symbols = []
+        def calc_holdings_history():
+            (df,unfetched) = stock_perf_data.calc_stock_history(os.path.join(sub_dir,ftypes.SNAPSHOT_STOCK_PRICES_FILE),config,snapshot_datestr,holdings_df,
+                                                                os.path.join(main_dir,ftypes.STOCK_PRICE_STORE_FILE))
+            unfetched_symbols.extend(unfetched)
+            return df
+        holdings_df = store.get_or_build("holdings-history",holdings_history_key,calc_holdings_history,lambda : not unfetched_symbols)
+        result_stage = "result"
+    else:
+        holdings_history_key = holdings_rules_key
+        unfetched_symbols = []
+        #kept apart from the full result, so creating reports and history don't replace each other's
+        result_stage = "result-no-perf"
+
+    def join_and_convert():
+        res_pd = join_holdings_and_picks(holdings_df,picks_df)
+
+        fill_in_forex(res_pd,load_snapshot_rate_table(sub_dir,main_dir),config)
 
-    #co: PERF: if we have 1000's of rules this may be faster, don't know. Not well tested!
-    # all_rules = system_overrides+user_overrides
-    # forl = rules_parser.create_forl(all_rules)
-    # holdings_df = rules_parser.run_rules_alt_method(all_rules,forl,holdings_df,rules_log)
-    # picks_df = rules_parser.run_rules_alt_method(all_rules,forl,picks_df,rules_log)
-    # events_df = rules_parser.run_rules_alt_method(all_rules,forl,events_df,rules_log)
+        #res_pd = move_columns_to_front(res_pd,match_columns+[ftypes.SpecialColumns.JoinResult.get_col_name(),ftypes.SpecialColumns.JoinAll.get_col_name()])
+        front_columns = [c for c in res_pd.columns if re.match(r'^[A-Z]:',c)]
+        front_columns.sort()
 
-    holdings_df = stock_perf_data.calc_stock_history(sub_dir / ftypes.YAHOO_FINANCE_CACHE_FILE,config,snapshot_datestr,holdings_df)
+        return move_columns_to_front(res_pd,front_columns)
 
-    res_pd = join_holdings_and_picks(holdings_df,picks_df)
+    #done here rather than only in the join, so the frames are the same when the result comes from the store
+    add_join_index_columns(holdings_df,picks_df)
 
-    fill_in_forex(res_pd,sub_dir,config)
+    result_key = snapshot_store.make_key(holdings_history_key,picks_rules_key,config.currency,config.forex_date.name,
+                                         get_snapshot_forex_key(sub_dir))
+    res_pd = store.get_or_build(result_stage,result_key,join_and_convert,lambda : not unfetched_symbols)
 
-    #res_pd = move_columns_to_front(res_pd,match_columns+[ftypes.SpecialColumns.JoinResult.get_col_name(),ftypes.SpecialColumns.JoinAll.get_col_name()])
-    front_columns = [c for c in res_pd.columns if re.match(r'^[A-Z]:',c)]
-    front_columns.sort()
+    returns_df = pd.DataFrame(columns=[RETURNS_GROUP_COLUMN,RETURNS_GROUP])
 
-    res_pd = move_columns_to_front(res_pd,front_columns)
+    #the events are keyed to the holdings they're for, and so to their categories, once the holdings are joined
+    if(not events_df.empty):
+        cat_columns = get_report_cat_columns(config)
+        return_events_key = snapshot_store.make_key(returns.RETURNS_VERSION,events_rules_key,result_key,cat_columns)
+        events_df = store.get_or_build("return-events",return_events_key,lambda : get_return_events_df(events_df,res_pd,cat_columns))
+
+        if(calc_perf and config.hist_perf_periods and not events_df.empty):
+            #the prices are the ones downloaded for the holdings history, so they're part of its key
+            returns_key = snapshot_store.make_key(return_events_key,holdings_history_key)
+            returns_df = store.get_or_build("returns",returns_key,
+                                            lambda : calc_returns_df(events_df,res_pd,config,os.path.join(sub_dir,ftypes.SNAPSHOT_STOCK_PRICES_FILE),
+                                                                     snapshot_datestr,cat_columns),
+                                            lambda : not unfetched_symbols)
 
 
     # print(res_pd.to_csv())
@@ -414,26 +834,25 @@ def build_result_df(sub_dir, snapshot_datestr, rules_log):
     # # print("-"*40)
     # print(picks_df.to_csv())
 
-    return config,picks_df,holdings_df,res_pd
-
-def create_reports(args):
-    sub_dir = get_sub_dir_from_config(args)
-    sub_dir_date = util.extract_subdir_date_from_filepath(sub_dir)
+    return config,picks_df,holdings_df,events_df,res_pd,returns_df
 
+def run_create_reports(args, sub_dir, sub_dir_date):
     if(args.rules_log is not None):
         log_holdings_id = int(args.rules_log)
         rules_log = al.Log({"df": "holdings", "df_index" : log_holdings_id -1})
     else:
         rules_log = al.Log(None,turn_off=True)
 
-    config,picks_df,holdings_df,res_pd = build_result_df(sub_dir, sub_dir_date, rules_log)
-
-    REPORT_OUT_FILE = "report_out.xlsx"
+    config,picks_df,holdings_df,events_df,res_pd,returns_df = build_result_df(sub_dir, sub_dir_date, rules_log, args.rules_engine,
+                                                                              not args.no_cache, parse_workers=args.parse_workers)
 
     report_out_path = os.path.join(sub_dir,REPORT_OUT_FILE)
 
     #TODO, add rules to report:    al.create_df(rules_log)
-    reports.make_report_workbook(res_pd,holdings_df,picks_df,config.currency,rules_log,config,report_out_path)
+    #the report sheets are stored alongside the snapshot's other stages, so only the ones whose inputs changed are rebuilt
+    report_store = snapshot_store.SnapshotStore(os.path.join(sub_dir,ftypes.SNAPSHOT_CACHE_DIR),enabled=not args.no_cache)
+    reports.make_report_workbook(res_pd,holdings_df,picks_df,config.currency,rules_log,config,report_out_path,args.report_writer,
+                                 events_df,report_store,returns_df)
 
     print(f"Report finished! The report is located here {report_out_path}")
 
@@ -443,6 +862,136 @@ def create_reports(args):
         for msg,context in rules_log.get_logs():
             print(f"{context}: {msg}")
 
+def get_watched_files_state(sub_dir):
+    """Returns the name, modification time and size of each input file in sub_dir, to tell when one is saved"""
+    state = []
+    for item in sorted(os.listdir(sub_dir)):
+        #files written by create-reports itself, and the lock files excel keeps next to open workbooks
+        if(item.startswith((REPORT_OUT_FILE,ftypes.SNAPSHOT_STOCK_PRICES_FILE,'~$'))):
+            continue
+        item_path = os.path.join(sub_dir,item)
+        if(os.path.isfile(item_path)):
+            st = os.stat(item_path)
+            state.append((item,st.st_mtime_ns,st.st_size))
+    return state
+
+def watch_create_reports(args, sub_dir, sub_dir_date):
+    """Creates the reports, and then again each time an input file in sub_dir is saved, until interrupted.
+
+    The stages of the last run are kept in memory, so a rerun only recalculates the ones downstream of the changed file.
+    """
+    snapshot_store.keep_frames_in_memory()
+
+    print(f"Watching {sub_dir} for changes, press Ctrl-C to stop")
+    last_state = None
+    try:
+        while(True):
+            state = get_watched_files_state(sub_dir)
+            if(state != last_state):
+                #files are often saved in more than one write, so wait until they stop changing
+                time.sleep(args.watch_interval)
+                if(get_watched_files_state(sub_dir) != state):
+                    continue
+                last_state = state
+
+                start_time = time.monotonic()
+                try:
+                    run_create_reports(args,sub_dir,sub_dir_date)
+                except Exception as e:
+                    #most errors are from a file being edited, so are reported and fixed by the next save
+                    print(f"Report failed: {e}")
+                print(f"Took {time.monotonic() - start_time:.1f}s, watching for changes")
+            time.sleep(args.watch_interval)
+    except KeyboardInterrupt:
+        pass
+
+def create_reports(args):
+    sub_dir = get_sub_dir_from_config(args)
+    sub_dir_date = util.extract_subdir_date_from_filepath(sub_dir)
+
+    if(args.watch):
+        watch_create_reports(args,sub_dir,sub_dir_date)
+    else:
+        run_create_reports(args,sub_dir,sub_dir_date)
+
+def build_snapshot_history_df(sub_dir, rules_engine, use_cache):
+    """Builds the joined df of one snapshot for create-history, without performance data. Run in a worker process
+
+    Returns:
+        config,res_pd
+    """
+    rules_log = al.Log(None,turn_off=True)
+    #the snapshots are already built in parallel, so each one's files are parsed one at a time
+    config,_,_,_,res_pd,_ = build_result_df(sub_dir,os.path.basename(sub_dir),rules_log,rules_engine,use_cache,calc_perf=False,parse_workers=1)
+
+    return config,res_pd
+
+def create_history(args):
+    #latest first, the order the snapshots are built and their logs printed in
+    snapshot_dirs = []
+    for d in get_valid_snapshot_dirs(args.main_dir):
+        try:
+            datetime.datetime.strptime(d.name,'%Y-%m-%d')
+        except ValueError:
+            util.warn(f"skipping snapshot {d}, its name isn't a date (YYYY-MM-DD)")
+            continue
+        snapshot_dirs.append(str(d))
+
+    if(not snapshot_dirs):
+        util.error(f"Cannot find any snapshot directory. Please run (cmd) {CREATE_SNAPSHOT_COMMAND} first")
+
+    print(f"Reading {len(snapshot_dirs)} snapshots")
+
+    snapshot_dfs = []
+    config = None
+    def add_snapshot(d, build_fn):
+        nonlocal config
+        try:
+            snapshot_config,res_pd = build_fn()
+        except Exception as e:
+            util.warn(f"skipping snapshot {d}: {e}")
+            return
+        #the categories are the ones of the latest snapshot's config
+        if(config is None):
+            config = snapshot_config
+        snapshot_dfs.append((os.path.basename(d),res_pd))
+
+    #the snapshots are independent, so are built in parallel. The logs of each are kept by the worker and printed
+    #here in snapshot order, followed by whether it was skipped, same as building them one at a time
+    build_args = [(d,args.rules_engine,not args.no_cache) for d in snapshot_dirs]
+    if(args.workers == 1):
+        for d,a in zip(snapshot_dirs,build_args):
+            add_snapshot(d,lambda: build_snapshot_history_df(*a))
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = [executor.submit(run_in_worker_keeping_logs,build_snapshot_history_df,*a) for a in build_args]
+
+            def get_result(f):
+                try:
+                    (res,records) = f.result()
+                except Exception as e:
+                    replay_log_records(getattr(e,'log_records',[]))
+                    raise
+                replay_log_records(records)
+                return res
+
+            for d,f in zip(snapshot_dirs,futures):
+                add_snapshot(d,lambda: get_result(f))
+
+    if(not snapshot_dfs):
+        util.error("None of the snapshots could be read")
+
+    #the history is oldest first
+    snapshot_dfs.reverse()
+
+    reports_dir = os.path.join(args.main_dir,ftypes.FINANCE_REPORTS_DIR)
+    os.makedirs(reports_dir,exist_ok=True)
+    report_out_path = os.path.join(reports_dir,HISTORY_REPORT_FILE)
+
+    reports.make_history_workbook(snapshot_dfs,config,report_out_path,args.report_writer)
+
+    print(f"History report of {len(snapshot_dfs)} snapshots finished! The report is located here {report_out_path}")
+
 def setup_argparse():
     parser = argparse.ArgumentParser(
         description="joins holdings files with pick files for analysis in a spreadsheet",
@@ -461,24 +1010,60 @@ def setup_argparse():
                                  'the default will always be used.')
     parser_snapshot.add_argument('--no-open-window', default=False,action='store_true', 
                                  help='Normally, a gui window will open up of the snapshot dir created. Using this option prevents this.')
+    parser_snapshot.add_argument('--forex-timeout', type=float, default=ftypes.FOREX_DOWNLOAD_TIMEOUT_SECS,
+                                 help=f"Seconds to wait for the exchange rates to download. If they can't be, the ones already in "
+                                 f"{ftypes.FOREX_STORE_FILE} are used")
     parser_snapshot.set_defaults(func=create_snapshot)
 
     parser_download_capex = subparsers.add_parser(DOWNLOAD_CAPEX_COMMAND, help="Downloads capex portfolio. Make sure to log in prior to calling this")
     parser_download_capex.add_argument('--sub-dir', type=str, 
                                help="The name of the sub-dir to download the capex files into. Defaults to the latest directory.")
-    parser_download_capex.add_argument('browser', type=str, choices=["chrome","firefox","brave"], help="The browser used to login to website")
+    parser_download_capex.add_argument('browser', type=str, choices=CAPEX_BROWSERS, help="The browser used to login to website")
+    parser_download_capex.add_argument('--workers', type=int, default=ftypes.CAPEX_FETCH_WORKERS,
+                                       help="Number of pages to download at the same time")
+    parser_download_capex.add_argument('--timeout', type=float, default=ftypes.CAPEX_FETCH_TIMEOUT_SECS,
+                                       help="Seconds to wait for each page to download, before retrying")
+    parser_download_capex.add_argument('--no-cache', default=False, action='store_true',
+                                       help=f"Download every page and table again, rather than only the ones changed since the "
+                                       f"last download, as remembered in {ftypes.CAPEX_CACHE_FILE}")
     parser_download_capex.set_defaults(func=download_capex)
 
     parser_create_reports = subparsers.add_parser(CREATE_REPORTS_COMMAND, help="Create reports from the provided data")
     parser_create_reports.add_argument('--sub-dir', type=str, 
                                        help="The name of the sub-dir to download the capex files into. Defaults to the latest directory.")
     parser_create_reports.add_argument('--rules-log', type=str, 
-                                       help=f"Turns on rule logs and specifies the row in the {reports.HOLDINGS_WS_TITLE} to print logs for")
-    # PERF: If we have thousands of rules this may be faster
-    # parser_create_reports.add_argument('--run-rules-alt', default=False,action='store_true', 
-    #                                    help=f"If present, the alternative complicated not very well tested bad code for running rules will be used")
+                                       help=f"Turns on rule logs and specifies the row in the {ftypes.HOLDINGS_WS_TITLE} to print logs for")
+    parser_create_reports.add_argument('--rules-engine', type=str, default='compiled', choices=ftypes.RULES_ENGINE_NAMES,
+                                       help="How rules are run. 'compiled' runs each rule over all rows at once, 'rowwise' runs all rules "
+                                       "over one row at a time, 'indexed' is like 'rowwise' but each row jumps to the next rule that matches it. "
+                                       "All produce the same result")
+    parser_create_reports.add_argument('--no-cache', default=False, action='store_true',
+                                       help=f"Don't read or write the parsed config and data frames kept in {ftypes.SNAPSHOT_CACHE_DIR} in the "
+                                       "snapshot dir, and rebuild everything from the input files")
+    parser_create_reports.add_argument('--parse-workers', type=int, default=os.cpu_count(),
+                                       help="Number of input files to parse at once. Files already parsed are read from the cache")
+    parser_create_reports.add_argument('--report-writer', type=str, default='write-only', choices=ftypes.REPORT_WRITER_NAMES,
+                                       help="How the report workbook is written. 'write-only' streams rows into the file, 'openpyxl' builds "
+                                       "the whole workbook in memory first. Both produce the same workbook")
+    parser_create_reports.add_argument('--watch', default=False, action='store_true',
+                                       help="Keep running, and create the reports again each time a file in the snapshot dir is saved. "
+                                       "Only the parts affected by the changed file are recalculated")
+    parser_create_reports.add_argument('--watch-interval', type=float, default=0.25,
+                                       help="Seconds between checks for changed files when watching")
     parser_create_reports.set_defaults(func=create_reports)
 
+    parser_create_history = subparsers.add_parser(CREATE_HISTORY_COMMAND, help="Create a report of how the allocation between categories changed "
+                                                  "over all the snapshots")
+    parser_create_history.add_argument('--rules-engine', type=str, default='compiled', choices=ftypes.RULES_ENGINE_NAMES,
+                                       help=f"How rules are run, see {CREATE_REPORTS_COMMAND}")
+    parser_create_history.add_argument('--no-cache', default=False, action='store_true',
+                                       help=f"Don't read or write the data frames kept in {ftypes.SNAPSHOT_CACHE_DIR} in each snapshot dir")
+    parser_create_history.add_argument('--workers', type=int, default=os.cpu_count(),
+                                       help="Number of snapshots to read at once. Snapshots that are cached are quick to read")
+    parser_create_history.add_argument('--report-writer', type=str, default='write-only', choices=ftypes.REPORT_WRITER_NAMES,
+                                       help=f"How the report workbook is written, see {CREATE_REPORTS_COMMAND}")
+    parser_create_history.set_defaults(func=create_history)
+
     return parser
 
 def is_windows():
@@ -503,6 +1088,9 @@ def in_welcome_bat():
 
 
 if __name__ == '__main__':
+    #the worker processes of a frozen build on windows run this file again, and need to stop here
+    multiprocessing.freeze_support()
+
     if(len(sys.argv) == 1 and is_windows() and not in_welcome_bat()):
         #we think we've been double-clicked in windows
         #in this case we open up a dos-prompt as are impromptu user interface and let the user loose!
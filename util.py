@@ -1,16 +1,38 @@
 import csv
+import hashlib
 from functools import partial
+import importlib.util
 import logging
 import os
 from enum import Enum, auto
 from pathlib import PosixPath
 import re
-import openpyxl as op
-import pandas as pd
 import sys
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 
+def lazy_import(name : str):
+    """Returns the module, which is only actually imported the first time one of its attributes is used. For
+    slow to import modules that not every command needs, so commands that don't use them start quicker.
+
+    PyInstaller can't see these imports, so the modules must also be listed as hidden imports in scripts/pyinstaller.bat
+    """
+    if(name in sys.modules):
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if(spec is None):
+        raise ModuleNotFoundError(f"No module named '{name}'",name=name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+
+    return module
+
+op = lazy_import('openpyxl')
+pd = lazy_import('pandas')
+
 
 
 class ErrorType(Enum):
@@ -84,15 +106,43 @@ def extend_all_row_length(fi,min_len):
     return map(partial(extend_array_to_min_length,min_len),fi)
 
 
-def read_standardized_csv(fp : str = None,wb = None, worksheet_name=None):
+def iter_worksheet_rows(ws):
+    """Yields the values of each row of the worksheet. Works for both regular and read only worksheets
+    """
+    if(hasattr(ws,'reset_dimensions')):
+        #the dimensions stored in some exported files are wrong, so don't let them truncate the data
+        ws.reset_dimensions()
+    return ws.iter_rows(values_only=True)
+
+def iter_xlsx_rows(fp, worksheet_name=None, data_only=False):
+    """Streams the rows of a worksheet in an xlsx file, without loading the whole workbook into memory.
+       The file is closed once all rows are read.
+    """
+    wb = op.load_workbook(fp, read_only=True, data_only=data_only)
+    try:
+        ws = wb[worksheet_name] if worksheet_name is not None else wb.worksheets[0]
+        yield from iter_worksheet_rows(ws)
+    finally:
+        wb.close()
+
+def iter_csv_rows(fp):
+    with open(fp, newline='') as fh:
+        yield from csv.reader(fh)
+
+def read_standardized_csv(fp : str = None,wb = None, worksheet_name=None, data_only=False):
     """Regardless of whether an excel spreadsheet or a csv, reads it like a csv file.
        Trims left and right whitespace of all cells.
 
+       Rows are read lazily. When reading an xlsx file by path, the workbook is opened read only,
+       so it is streamed rather than loaded into memory all at once.
+
        Args:
           fp - file path. Either fp or wb must be specified
-          wb - excel workbook
+          wb - excel workbook, which may be opened read only
           worksheet_name - if reading from a workbook, then the worksheet number to read.
                            Default is the first page
+          data_only - if reading an xlsx by path, return the cached values of formula cells
+                      rather than the formulas themselves
         Returns:
           iteration of lists where each list is a row
     """
@@ -109,17 +159,16 @@ def read_standardized_csv(fp : str = None,wb = None, worksheet_name=None):
 
         return r
         
-    if(wb is not None or fp.endswith(".xlsx")):
-        if(wb is None):
-            wb = op.load_workbook(fp)
+    if(wb is not None):
         if(worksheet_name is not None):
             ws = wb[worksheet_name]
         else:
             ws = wb.worksheets[0]
-        data = list(ws.iter_rows(values_only=True))
+        data = iter_worksheet_rows(ws)
+    elif(fp.endswith(".xlsx")):
+        data = iter_xlsx_rows(fp, worksheet_name, data_only)
     elif(fp.endswith(".csv")):
-        fh = open(fp, newline='')
-        data = csv.reader(fh)
+        data = iter_csv_rows(fp)
     else:
         error(f"don't know how to read {fp}")
     
@@ -266,6 +315,13 @@ def extract_re_groups(regex_str, value_str):
         raise ValueError(f"No match found for regex '{regex_str}' in string '{value_str}'")
     return match.groups()
 
+def get_file_sha256(fp):
+    h = hashlib.sha256()
+    with open(fp,'rb') as f:
+        for chunk in iter(lambda : f.read(1024*1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
 def extract_subdir_date_from_filepath(fp):
     if(isinstance(fp,PosixPath)):
         return fp.name